@@ -0,0 +1,239 @@
+#!/bin/python
+import os
+import re
+import sys
+import timeit
+
+import Sketch_to_Cpp
+
+# Benchmark_Prototypes compares the single-pass declarator scanner in
+#  Sketch_to_Cpp against the line-by-line regex scanner it replaced, for both
+#  speed and output. Run it like so:
+#
+#  python Benchmark_Prototypes.py [sketch.ino ...]
+#
+#  With no arguments, it checks every sketch in Benchmark_Sketches. Either
+#  way, it then times both scanners on a generated sketch with a big lookup
+#  table in it, which is where the old scanner really struggled.
+#
+#  The two scanners don't agree on much (that's why we replaced the old one),
+#  so their differences are only printed. What has to be right is in
+#  expected_functions below: for every sketch in Benchmark_Sketches, the
+#  declarators the new scanner should find and the line the prototypes
+#  should go before. If it gets any of that wrong, nothing gets timed and we
+#  exit with status 1.
+
+# The line numbers count from 1, like an editor does.
+expected_functions = {
+    'Blink.ino': (5, [
+        "void setup()",
+        "void loop()"]),
+    'DefaultArguments.ino': (8, [
+        "static inline int add(int a, int b)",
+        "void report(const char *message, char separator)",
+        "void blink_led(int pin, unsigned long on_time, "
+        "unsigned long off_time)",
+        "void every_second(Callback callback, int (*scale)(int, int))",
+        "void setup()",
+        "void loop()",
+        "void print_value(int value)"]),
+    'LookupTable.ino': (13, [
+        "void setup()",
+        "void loop()",
+        "void start_timer(long frequency)"]),
+    'SerialMenu.ino': (17, [
+        "void setup()",
+        "void loop()",
+        "void print_menu()",
+        "void handle_key(char key)",
+        "void load_settings()",
+        "void save_settings()"]),
+    'StateMachine.ino': (9, [
+        "void setup()",
+        "void loop()",
+        "bool button_pressed()",
+        "bool move_door(int target)",
+        "void change_state(State next)"]),
+}
+
+# This is the old scanner, kept here as the baseline.
+def legacy_scan_declarators(cpp_file):
+    in_comment = False
+
+    parens_stack = 0
+    braces_stack = 0
+
+    Comment_Line_re = re.compile('^\s*(//.*|/\*.*\*/$)')
+    Whitespace_Line_re = re.compile('^\s*$')
+
+    Comment_Opener_re = re.compile('.*/\*.*(?!\*/)')
+    Comment_Closer_re = re.compile('.*\*/')
+
+    Brace_Open_re = re.compile('.*(?<!//).*\{')
+    Brace_Close_re = re.compile('^\s*\}')
+    Nonleading_Brace_Open_re = re.compile('\S+\s*\{')
+    Nonleading_Brace_Close_re = re.compile('(\S+\s*\})|(^\s*\})')
+
+    Preprocessor_re = re.compile('^\s*#')
+
+    Semicolon_no_open_brace_re = re.compile('^\s*\{*[^}].*;')
+
+    Comment_strip_re = \
+    re.compile('(/\*.*\*/)|(/\*.*$)|(//.*$)|(/\*.*$)|(^.*\*/)')
+
+    Open_brace_strip_re = re.compile('\s*\{.*')
+
+    Open_paren_re = re.compile('\(')
+    Close_paren_re = re.compile('\)')
+
+    declarator_line_list = []
+
+    for line in cpp_file:
+
+        if Comment_Line_re.search(line) != None:
+            continue
+
+        if Preprocessor_re.search(line) != None:
+            continue
+
+        if Whitespace_Line_re.search(line) != None:
+            continue
+
+        if in_comment:
+            if Comment_Closer_re.search(line) != None:
+                in_comment = False
+            else:
+                continue
+
+        if Comment_Opener_re.search(line) != None:
+            in_comment = True
+
+        if Comment_Closer_re.search(line) != None:
+            in_comment = False
+
+        if Brace_Open_re.search(line) != None:
+            braces_stack += 1
+
+        if Brace_Close_re.search(line) != None:
+            braces_stack -= 1
+
+        if braces_stack > 0:
+            if (Brace_Open_re.search(line)) != None:
+                if braces_stack > 1:
+                    continue
+            else:
+                continue
+
+        if Semicolon_no_open_brace_re.search(line) != None:
+            continue
+
+        line = Comment_strip_re.sub('', line)
+
+        declarator_line_list.append(line.strip())
+
+    declarator_string = ''.join(declarator_line_list)
+
+    declarator_list = declarator_string.rstrip('{}').split('{}')
+
+    return declarator_list
+
+def normalize(declarator_list):
+    # The two scanners don't agree on whitespace, and the old one leaves an
+    #  empty declarator behind now and then; neither matters to the compiler.
+    return [" ".join(declarator.split()) for declarator in declarator_list
+            if declarator.strip()]
+
+def compare_sketch(sketch_file):
+    with open(sketch_file) as f:
+        cpp_file = list(f)
+    old_list = normalize(legacy_scan_declarators(cpp_file))
+    new_list = normalize(Sketch_to_Cpp.scan_declarators(cpp_file))
+
+    print os.path.basename(sketch_file) + ":",
+    if old_list == new_list:
+        print "same %d declarators as the old scanner" % len(new_list)
+        return True
+    print "differs from the old scanner"
+    for declarator in old_list:
+        if declarator not in new_list:
+            print "  old only: " + declarator
+    for declarator in new_list:
+        if declarator not in old_list:
+            print "  new only: " + declarator
+    return False
+
+def check_sketch(sketch_file):
+    # check_sketch() returns False if the new scanner gets sketch_file wrong,
+    #  and True if it gets it right or we don't know what right is.
+    name = os.path.basename(sketch_file)
+    if name not in expected_functions:
+        print "  (no expected declarators for %s)" % name
+        return True
+    expected_line, expected_list = expected_functions[name]
+    with open(sketch_file) as f:
+        declarator_list, first_function = \
+            Sketch_to_Cpp.scan_functions(list(f))
+    declarator_list = normalize(declarator_list)
+    if first_function is not None:
+        first_function += 1
+
+    correct = True
+    if declarator_list != expected_list:
+        print "  WRONG declarators; expected:"
+        for declarator in expected_list:
+            print "    " + declarator
+        print "  got:"
+        for declarator in declarator_list:
+            print "    " + declarator
+        correct = False
+    if first_function != expected_line:
+        print "  WRONG prototype line; expected %s, got %s" % (expected_line,
+                                                              first_function)
+        correct = False
+    return correct
+
+def generate_sketch(table_lines, function_count):
+    # A sketch with a table_lines line lookup table (the kind you get from
+    #  converting an image or a sound to a C array) and function_count
+    #  ordinary little functions.
+    lines = ["#include <avr/pgmspace.h>\n",
+             "const unsigned char table[] PROGMEM = {\n"]
+    for i in range(table_lines):
+        lines.append("  0x%02x, 0x%02x, 0x%02x, 0x%02x, // row %d\n" %
+                     (i & 255, (i * 3) & 255, (i * 5) & 255, (i * 7) & 255, i))
+    lines.append("};\n\n")
+    for i in range(function_count):
+        lines.append("int function_%d(int a, int b)\n{\n" % i)
+        lines.append("  /* keep it { simple } */\n")
+        lines.append("  return pgm_read_byte(&table[a]) + b + %d;\n}\n\n" % i)
+    return lines
+
+def time_scanners(table_lines=20000, function_count=500, iterations=3):
+    cpp_file = generate_sketch(table_lines, function_count)
+    print "Generated sketch: %d lines" % len(cpp_file)
+    for label, scanner in [("before", legacy_scan_declarators),
+                           ("after", Sketch_to_Cpp.scan_declarators)]:
+        seconds = min(timeit.repeat(lambda: scanner(cpp_file),
+                                    number=1, repeat=iterations))
+        found = len(normalize(scanner(cpp_file)))
+        print "%-8s %10.1f ms  %5d declarators" % (label, seconds * 1000,
+                                                  found)
+
+if __name__ == '__main__':
+    sketch_list = sys.argv[1:]
+    if not sketch_list:
+        corpus_path = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                   "Benchmark_Sketches")
+        sketch_list = [os.path.join(corpus_path, name) for name in
+                       sorted(os.listdir(corpus_path)) if name.endswith(".ino")]
+    wrong_list = []
+    for sketch_file in sketch_list:
+        compare_sketch(sketch_file)
+        if not check_sketch(sketch_file):
+            wrong_list.append(os.path.basename(sketch_file))
+    print
+    if wrong_list:
+        print "The scanner got %d sketch(es) wrong: %s" % (len(wrong_list),
+                ", ".join(wrong_list))
+        sys.exit(1)
+    time_scanners()
@@ -0,0 +1,15 @@
+// Blink: turns an LED on for one second, then off for one second, forever.
+
+#define LED_PIN 13
+
+void setup() {
+  // initialize the digital pin as an output.
+  pinMode(LED_PIN, OUTPUT);
+}
+
+void loop() {
+  digitalWrite(LED_PIN, HIGH);
+  delay(1000);
+  digitalWrite(LED_PIN, LOW);
+  delay(1000);
+}
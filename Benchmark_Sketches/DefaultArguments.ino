@@ -0,0 +1,46 @@
+// DefaultArguments: functions with default arguments. A default can only be
+//  given once, so it stays on the definition and mustn't end up in the
+//  prototype as well. Calls that leave arguments out have to come after the
+//  definition, same as in the IDE.
+
+typedef void (*Callback)(int);
+
+static inline int add(int a, int b = 3) {
+  return a + b;
+}
+
+void report(const char *message = "a, b = c", char separator = ',') {
+  Serial.print(separator);
+  Serial.println(message);
+}
+
+void blink_led(int pin, unsigned long on_time = (1000 >> 1),
+               unsigned long off_time = 500) {
+  digitalWrite(pin, HIGH);
+  delay(on_time);
+  digitalWrite(pin, LOW);
+  delay(off_time);
+}
+
+void every_second(Callback callback = NULL, int (*scale)(int, int) = NULL) {
+  static unsigned long last = 0;
+  if (millis() - last >= 1000) {
+    last = millis();
+    if (callback) callback(scale ? scale(2, 3) : add(2));
+  }
+}
+
+void setup() {
+  Serial.begin(9600);
+  report("ready, waiting");
+}
+
+void loop() {
+  blink_led(13);
+  every_second(print_value);
+}
+
+void print_value(int value) {
+  report("value", ':');
+  Serial.println(value);
+}
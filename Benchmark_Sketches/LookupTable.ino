@@ -0,0 +1,29 @@
+#include <avr/pgmspace.h>
+
+// A sine table for a tone generator, stored in flash.
+const unsigned char sine_table[] PROGMEM = {
+  128, 131, 134, 137, 140, 143, 146, 149,
+  152, 155, 158, 162, 165, 167, 170, 173,
+  176, 179, 182, 185, 188, 190, 193, 196,
+  198, 201, 203, 206, 208, 211, 213, 215
+};
+
+volatile unsigned char phase = 0;
+
+void setup() {
+  pinMode(3, OUTPUT);
+  start_timer(31250);
+}
+
+void loop() {
+}
+
+void start_timer(long frequency) {
+  TCCR2A = _BV(WGM21);
+  OCR2A = F_CPU / 8 / frequency;
+  TIMSK2 = _BV(OCIE2A);
+}
+
+ISR(TIMER2_COMPA_vect) {
+  analogWrite(3, pgm_read_byte(&sine_table[phase++ & 31]));
+}
@@ -0,0 +1,56 @@
+#include <EEPROM.h>
+
+/*
+ * A little serial menu. Settings are saved to EEPROM so they survive a
+ * power cycle.
+ */
+
+struct Settings {
+  int brightness;
+  int speed;
+};
+
+Settings settings = { 128, 10 };
+const char *banner = "Menu { b=brightness, s=speed }";
+char separator = '}';
+
+void setup()
+{
+  Serial.begin(9600);
+  load_settings();
+  print_menu();
+}
+
+void loop()
+{
+  if (Serial.available() > 0) {
+    handle_key(Serial.read());
+  }
+}
+
+void print_menu()
+{
+  Serial.println(banner);
+  Serial.print("brightness: ");
+  Serial.println(settings.brightness);
+}
+
+void handle_key(char key)
+{
+  switch (key) {
+    case 'b': settings.brightness += 16; break;
+    case 's': settings.speed++; break;
+    default: print_menu(); return;
+  }
+  save_settings();
+}
+
+void load_settings()
+{
+  EEPROM.get(0, settings);
+}
+
+void save_settings()
+{
+  EEPROM.put(0, settings);
+}
@@ -0,0 +1,47 @@
+#include <Servo.h>
+
+enum State { IDLE, OPENING, OPEN, CLOSING };
+
+State state = IDLE;
+Servo door;
+unsigned long last_change = 0;
+
+void setup() {
+  door.attach(9);
+  pinMode(2, INPUT_PULLUP);
+}
+
+void loop() {
+  switch (state) {
+    case IDLE:
+      if (button_pressed()) { change_state(OPENING); }
+      break;
+    case OPENING:
+      if (move_door(90)) change_state(OPEN);
+      break;
+    case OPEN:
+      if (millis() - last_change > 5000) { change_state(CLOSING); }
+      break;
+    case CLOSING:
+      if (move_door(0)) change_state(IDLE);
+      break;
+  }
+}
+
+bool button_pressed() {
+  return digitalRead(2) == LOW;
+}
+
+// Moves the door one step toward target; returns true once it's there.
+bool move_door(int target) {
+  int position = door.read();
+  if (position == target) { return true; }
+  door.write(position < target ? position + 1 : position - 1);
+  delay(15);
+  return false;
+}
+
+void change_state(State next) {
+  state = next;
+  last_change = millis();
+}
@@ -0,0 +1,276 @@
+#!/bin/python
+import os
+import os.path
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import subprocess
+import tempfile
+
+import Variable_Loader
+import Sketch_to_Cpp
+import Arduino_Builder_Loader
+from Synthetic_Platform import generate_platform
+
+# Benchmark_Suite times the parts of a build that are down to us rather than
+#  the compiler: parsing boards.txt and platform.txt, expanding recipes,
+#  finding source files, turning the sketch into a .cpp file, and whole
+#  builds from clean and with nothing to do, both the usual way and as a
+#  unity build. It builds against a synthetic platform whose "compiler" is
+#  Stub_Tool, so it runs offline, anywhere Python does, and what it measures
+#  is our overhead and nothing else.
+#
+#  python Benchmark_Suite.py [--boards N] [--libraries N] [--core-files N]
+#                            [--sketch-lines N] [--unity N] [--repeat N]
+#                            [-o FILE]
+#
+# Results are saved as JSON (to benchmark_results/<commit>.json unless -o
+#  says otherwise), so two commits can be compared with:
+#
+#  python Benchmark_Suite.py --compare old.json new.json
+#
+#  which flags anything that got more than --threshold percent slower.
+
+def time_runs(step, repeat, setup=None):
+    # The best run is the one to compare, since everything else is noise
+    #  from the rest of the machine; we keep all of them anyway.
+    runs = []
+    for index in range(repeat):
+        if setup:
+            setup()
+        start = time.time()
+        step()
+        runs.append(time.time() - start)
+    return {'best': min(runs), 'median': sorted(runs)[len(runs) // 2],
+            'runs': runs}
+
+def remove_path(path):
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    elif os.path.exists(path):
+        os.remove(path)
+
+def run_build(settings, cache_path):
+    # Every build runs in a fresh interpreter, just like it would from the
+    #  command line, so nothing we remembered from the last one helps.
+    script = "\n".join(
+        ["import sys", "sys.path.insert(0, %r)" % os.path.dirname(
+             os.path.abspath(__file__)),
+         "import Arduino_Builder_Loader as A"] +
+        ["A.%s = %r" % item for item in sorted(settings.items())] +
+        ["A.cache_path = %r" % cache_path, "A.main([])"])
+    with open(os.devnull, 'w') as devnull:
+        subprocess.check_call([sys.executable, "-c", script],
+                              stdout=devnull, stderr=subprocess.STDOUT)
+
+def run_suite(work_path, boards, libraries, core_files, sketch_lines,
+              repeat, unity=4):
+    settings = generate_platform(work_path, boards, libraries, core_files,
+                                 sketch_lines)
+    platform_path = settings['runtime_platform_path']
+    platform_txt_file = platform_path + "/platform.txt"
+    boards_txt_file = platform_path + "/boards.txt"
+    sketch_path = settings['sketch_path']
+    cache_path = work_path + "/cache"
+    results = {}
+
+    def parse_variables():
+        Variables = Variable_Loader.Variable_Manager(boards_txt_file,
+                                                     settings['board'])
+        Variables.parse_file(platform_txt_file)
+    results['parse_variables'] = time_runs(parse_variables, repeat)
+
+    def parse_patterns():
+        Variable_Loader.Pattern_Manager(platform_txt_file)
+    results['parse_patterns'] = time_runs(parse_patterns, repeat)
+
+    def index_boards():
+        Boards = Variable_Loader.Boards_Index(boards_txt_file)
+        for index in range(boards):
+            Boards.resolve("board%d" % index, {'cpu': 'cpu1'})
+    results['index_boards'] = time_runs(index_boards, repeat)
+
+    # replace_variables on every pattern, the way the old main() did it.
+    Variables = Variable_Loader.Variable_Manager(boards_txt_file,
+                                                 settings['board'])
+    Variables.parse_file(platform_txt_file)
+    for name in ["serial.port", "runtime.ide.path", "runtime.platform.path",
+                 "build.path", "build.project_name", "build.variant.path",
+                 "build.system.path", "runtime.ide.version", "archive_file",
+                 "includes"]:
+        Variables.add_variable([name, "/bench/" + name])
+    Patterns = Variable_Loader.Pattern_Manager(platform_txt_file)
+    pattern_list = [pattern for name, pattern in Patterns.fetch_pattern_list()]
+
+    def replace_variables():
+        # A fresh manager each time would time the parse as well, so we
+        #  throw away what it has already expanded instead.
+        Variables.Expanded.clear()
+        Variables.Dependents.clear()
+        for pattern in pattern_list:
+            Variables.replace_variables(pattern)
+    results['replace_variables'] = time_runs(replace_variables, repeat)
+
+    def find_sources():
+        for path in [platform_path + "/cores/synth",
+                     platform_path + "/libraries",
+                     settings['sketchbook_path'] + "/libraries"]:
+            Arduino_Builder_Loader.build_source_file_list(path, ".cpp")
+    results['build_source_file_list'] = time_runs(find_sources, repeat)
+
+    sketch_file = sketch_path + "/Bench.ino"
+    if not os.path.exists(sketch_path + "/build"):
+        os.makedirs(sketch_path + "/build")
+
+    def forget_sketch():
+        remove_path(sketch_path + "/build/Bench.ino.prototypes.json")
+        remove_path(sketch_path + "/build/Bench.cpp")
+    results['sketch_to_cpp'] = time_runs(
+            lambda: Sketch_to_Cpp.Sketch(sketch_file), repeat, forget_sketch)
+    results['sketch_to_cpp_unchanged'] = time_runs(
+            lambda: Sketch_to_Cpp.Sketch(sketch_file), repeat)
+
+    def forget_build():
+        remove_path(sketch_path + "/build")
+        remove_path(cache_path)
+    results['clean_build'] = time_runs(
+            lambda: run_build(settings, cache_path), repeat, forget_build)
+    results['noop_build'] = time_runs(
+            lambda: run_build(settings, cache_path), repeat)
+
+    # The same again as a unity build, to see what gluing the core's files
+    #  together buys us against the builds above.
+    if unity:
+        unity_settings = dict(settings, unity_build=unity)
+        results['clean_build_unity'] = time_runs(
+                lambda: run_build(unity_settings, cache_path), repeat,
+                forget_build)
+        results['noop_build_unity'] = time_runs(
+                lambda: run_build(unity_settings, cache_path), repeat)
+
+    return results
+
+def fetch_commit():
+    try:
+        with open(os.devnull, 'w') as devnull:
+            return subprocess.check_output(
+                ["git", "rev-parse", "--short", "HEAD"],
+                cwd=os.path.dirname(os.path.abspath(__file__)),
+                stderr=devnull).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+def print_results(report):
+    print "Commit %s, %s" % (report['commit'], report['config'])
+    print "%-26s %12s %12s" % ("", "best (ms)", "median (ms)")
+    for name in sorted(report['results']):
+        result = report['results'][name]
+        print "%-26s %12.2f %12.2f" % (name, result['best'] * 1000,
+                                       result['median'] * 1000)
+
+def compare_reports(old_report, new_report, threshold):
+    '''
+    compare_reports prints old against new, step by step, and returns the
+    number of steps that got more than threshold percent slower.
+    '''
+    print "%s -> %s" % (old_report['commit'], new_report['commit'])
+    if old_report['config'] != new_report['config']:
+        print "Warning: the two runs used different settings:"
+        print "  " + repr(old_report['config'])
+        print "  " + repr(new_report['config'])
+    print "%-26s %12s %12s %9s" % ("", "old (ms)", "new (ms)", "change")
+    regressions = 0
+    for name in sorted(set(old_report['results']) |
+                       set(new_report['results'])):
+        if name not in old_report['results'] or \
+           name not in new_report['results']:
+            print "%-26s (only in one run)" % name
+            continue
+        old_time = old_report['results'][name]['best']
+        new_time = new_report['results'][name]['best']
+        change = (new_time - old_time) / old_time * 100 if old_time else 0
+        flag = ""
+        if change > threshold:
+            flag = "  SLOWER"
+            regressions += 1
+        print "%-26s %12.2f %12.2f %+8.1f%%%s" % (name, old_time * 1000,
+                                                  new_time * 1000, change,
+                                                  flag)
+    return regressions
+
+def parse_arguments(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Time the overhead of building on a synthetic platform.")
+    parser.add_argument("--boards", type=int, default=50)
+    parser.add_argument("--libraries", type=int, default=20)
+    parser.add_argument("--core-files", type=int, default=40)
+    parser.add_argument("--sketch-lines", type=int, default=2000)
+    parser.add_argument("--unity", type=int, default=4, metavar="N",
+                        help="time the builds as unity builds with N groups, "
+                             "too (default: 4; 0 skips them)")
+    parser.add_argument("--repeat", type=int, default=5,
+                        help="run each step N times and keep the best")
+    parser.add_argument("-o", "--output", metavar="FILE",
+                        help="save the results to FILE (default: "
+                             "benchmark_results/<commit>.json)")
+    parser.add_argument("--keep", metavar="DIR",
+                        help="generate the platform in DIR and leave it "
+                             "there, instead of in a temporary folder")
+    parser.add_argument("--compare", nargs=2, metavar=("OLD", "NEW"),
+                        help="compare two saved results instead of running")
+    parser.add_argument("--threshold", type=float, default=10.0,
+                        help="with --compare, how many percent slower "
+                             "counts as a regression (default: 10)")
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    options = parse_arguments(argv)
+
+    if options.compare:
+        with open(options.compare[0]) as f:
+            old_report = json.load(f)
+        with open(options.compare[1]) as f:
+            new_report = json.load(f)
+        if compare_reports(old_report, new_report, options.threshold):
+            sys.exit(1)
+        return
+
+    config = {'boards': options.boards, 'libraries': options.libraries,
+              'core_files': options.core_files,
+              'sketch_lines': options.sketch_lines,
+              'unity': options.unity}
+    if options.keep:
+        work_path = os.path.abspath(options.keep)
+    else:
+        work_path = tempfile.mkdtemp(prefix="arduino_benchmark_")
+    try:
+        results = run_suite(work_path, options.boards, options.libraries,
+                            options.core_files, options.sketch_lines,
+                            options.repeat, options.unity)
+    finally:
+        if not options.keep:
+            shutil.rmtree(work_path, ignore_errors=True)
+
+    report = {'commit': fetch_commit(),
+              'date': time.strftime("%Y-%m-%d %H:%M:%S"),
+              'python': platform.python_version(),
+              'system': platform.platform(),
+              'config': config,
+              'results': results}
+    print_results(report)
+
+    output = options.output
+    if not output:
+        output = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                              "benchmark_results", report['commit'] + ".json")
+    if not os.path.exists(os.path.dirname(os.path.abspath(output))):
+        os.makedirs(os.path.dirname(os.path.abspath(output)))
+    with open(output, 'w') as f:
+        json.dump(report, f, indent=1, sort_keys=True)
+    print "Results saved to " + output
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,135 @@
+#!/bin/python
+import re
+import sys
+import timeit
+
+import Variable_Loader
+
+# Benchmark_Variables times the work Variable_Manager does on every build
+#  (parsing boards.txt and platform.txt, looking variables up, and expanding
+#  every recipe) against the list-based Variable_Manager it replaced, so we
+#  can see what the change bought us on a real platform. Run it like so:
+#
+#  python Benchmark_Variables.py path/to/platform.txt path/to/boards.txt board
+#
+#  An optional fourth argument sets how many times each step is repeated.
+
+class Legacy_Variable_Manager:
+    ''' This is the old Variable_Manager, kept here as the baseline: a list of
+    [name, value] pairs, a linear scan for every lookup, and a fresh regex
+    compile plus a full recursive re-expansion for every replace_variables().
+    '''
+    def __init__(self, filename, board_name=None):
+        self.Variables = []
+        self.parse_file(filename, board_name)
+
+    def parse_file(self, filename, board_name=None):
+        Comment_re = re.compile('\A\s*#')
+        if board_name:
+            Variable_name_string = "(?<=^" + board_name + \
+                    "\.)[\w.]*(?!pattern)(?=\s*=\s*)"
+        else:
+            Variable_name_string = "^\s*[\w.]*(?!pattern)(?=\s*=\s*)"
+        Variable_name_re = re.compile(Variable_name_string)
+        Variable_string_re = re.compile(
+            '((?:^\s*)[.\w]*(?!pattern)\s*=\s*)(?P<the_variable>[^#]*)')
+        with open(filename) as file:
+            for line in file:
+                if Comment_re.match(line) != None:
+                    continue
+                if Variable_name_re.search(line) != None:
+                    tempList = []
+                    for match in Variable_name_re.findall(line):
+                        tempList.append(match)
+                    variable_string = Variable_string_re.match(line).\
+                                    group('the_variable').strip()
+                    tempList.append(variable_string)
+                    self.Variables.append(tempList)
+                    continue
+
+    def fetch_variable(self, variable_name):
+        for item in self.Variables:
+            if item[0] == variable_name:
+                return item[1]
+        return None
+
+    def add_variable(self, new_variable):
+        self.Variables.append(new_variable)
+
+    def replace_variables(self, incomplete_pattern):
+        Variable_re = re.compile('(?<=\{)[\w.]+(?=\})')
+        vars_in_object = Variable_re.findall(incomplete_pattern)
+        if vars_in_object == []:
+            return incomplete_pattern
+        for var_to_replace in vars_in_object:
+            replacement_var = self.fetch_variable(var_to_replace)
+            if replacement_var:
+                if (Variable_re.search(replacement_var) != None):
+                    replacement_var = self.replace_variables(replacement_var)
+                incomplete_pattern = \
+                    incomplete_pattern.replace("{" + var_to_replace + "}",\
+                                                   replacement_var)
+        return incomplete_pattern
+
+def load_manager(manager_class, platform_txt_file, boards_txt_file, board):
+    Variables = manager_class(boards_txt_file, board)
+    Variables.parse_file(platform_txt_file)
+    # The handful of things main() adds before it starts expanding recipes.
+    for name in ["serial.port", "runtime.ide.path", "runtime.platform.path",
+                 "build.path", "build.project_name", "build.variant.path",
+                 "build.system.path", "software", "runtime.ide.version",
+                 "build.includes.path", "archive_file", "includes"]:
+        Variables.add_variable([name, "/bench/" + name])
+    return Variables
+
+def time_step(step, iterations):
+    # Best of three, so one hiccup on a busy machine doesn't decide things.
+    return min(timeit.repeat(step, number=iterations, repeat=3)) / iterations
+
+def run_benchmark(platform_txt_file, boards_txt_file, board, iterations=50):
+    Patterns = Variable_Loader.Pattern_Manager(platform_txt_file)
+    pattern_list = [pattern for name, pattern in Patterns.fetch_pattern_list()]
+
+    results = []
+    for label, manager_class in [("before", Legacy_Variable_Manager),
+                                 ("after", Variable_Loader.Variable_Manager)]:
+        Variables = load_manager(manager_class, platform_txt_file,
+                                 boards_txt_file, board)
+        name_list = [item[0] for item in Variables.Variables] \
+                if isinstance(Variables.Variables, list) \
+                else list(Variables.Variables)
+
+        def parse():
+            load_manager(manager_class, platform_txt_file, boards_txt_file,
+                         board)
+
+        def lookup():
+            for name in name_list:
+                Variables.fetch_variable(name)
+
+        def expand():
+            for pattern in pattern_list:
+                Variables.replace_variables(pattern)
+
+        results.append((label, time_step(parse, iterations),
+                        time_step(lookup, iterations),
+                        time_step(expand, iterations)))
+
+    print "%d variables, %d patterns" % (len(name_list), len(pattern_list))
+    print "%-8s %12s %12s %12s" % ("", "parse (ms)", "lookup (ms)",
+                                   "expand (ms)")
+    for label, parse_time, lookup_time, expand_time in results:
+        print "%-8s %12.3f %12.3f %12.3f" % (label, parse_time * 1000,
+                                             lookup_time * 1000,
+                                             expand_time * 1000)
+    return results
+
+if __name__ == '__main__':
+    if len(sys.argv) < 4:
+        print "usage: Benchmark_Variables.py platform.txt boards.txt board " \
+              "[iterations]"
+        sys.exit(1)
+    iterations = 50
+    if len(sys.argv) > 4:
+        iterations = int(sys.argv[4])
+    run_benchmark(sys.argv[1], sys.argv[2], sys.argv[3], iterations)
@@ -0,0 +1,130 @@
+#!/bin/python
+import os
+import os.path
+
+from Cache_Store import hash_file, load_json_file, store_json_file
+
+manifest_version = 1
+
+class Build_Manifest:
+    ''' Build_Manifest lets us skip the steps after compiling (the link and
+    objcopy) when none of their inputs have changed. For each step it keeps,
+    in build_manifest.json in the build folder:
+        - the exact command we ran
+        - every file the command read: the objects, core.a, linker scripts,
+          any precompiled libraries named in the recipe
+        - every file it wrote: the .elf, the .hex
+    If the command is the same, every input is the same, and every output is
+    still there as we left it, running the step again would only make the
+    same files over again, so we don't.
+
+    We don't have to know what a step reads or writes ahead of time: any
+    argument naming a file is looked at before and after the step runs, and
+    whatever the step changed is an output; the rest are inputs. Inputs are
+    checked by size and mtime first, and only hashed if those changed, so an
+    object recompiled to the very same bytes still counts as unchanged.
+    '''
+    def __init__(self, manifest_file):
+        self.manifest_file = manifest_file
+        manifest = load_json_file(manifest_file)
+        if not isinstance(manifest, dict) or \
+           manifest.get('version') != manifest_version:
+            manifest = {'version': manifest_version, 'steps': {}}
+        self.manifest = manifest
+        self.changed = False
+
+    def fetch_file_names(self, cmd):
+        '''
+        fetch_file_names returns every existing file named in cmd, including
+        linker scripts named with -T or --script=, which may be relative to
+        one of the -L folders.
+        '''
+        library_paths = [arg[2:] for arg in cmd if arg.startswith("-L")]
+        file_names = []
+        for arg in cmd:
+            names = [arg]
+            for prefix in ["-Wl,-T", "-Wl,--script=", "-T", "--script=",
+                           "@"]:
+                if arg.startswith(prefix) and len(arg) > len(prefix):
+                    name = arg[len(prefix):]
+                    names = [name] + [path + "/" + name
+                                      for path in library_paths]
+                    break
+            for name in names:
+                if name not in file_names and os.path.isfile(name):
+                    file_names.append(name)
+                    break
+        return file_names
+
+    def stamp_file(self, filename):
+        try:
+            file_stat = os.stat(filename)
+        except OSError:
+            return None
+        return [file_stat.st_size, file_stat.st_mtime]
+
+    def is_current(self, step_name, cmd):
+        '''
+        is_current returns True if running cmd would just make the files
+        it made last time.
+        '''
+        step = self.manifest['steps'].get(step_name)
+        if not step or step['cmd'] != cmd:
+            return False
+        for filename, stamp in step['outputs'].items():
+            if self.stamp_file(filename) != stamp:
+                return False
+        for filename, (size, mtime, digest) in step['inputs'].items():
+            stamp = self.stamp_file(filename)
+            if stamp is None:
+                return False
+            if stamp == [size, mtime]:
+                continue
+            if hash_file(filename) != digest:
+                return False
+            # Same contents, new mtime (say, an object compiled again from
+            #  a comment change); note the new mtime, so next time we don't
+            #  have to hash it again.
+            step['inputs'][filename] = stamp + [digest]
+            self.changed = True
+        return True
+
+    def run(self, step_name, cmd, call):
+        '''
+        run calls call(cmd), unless the manifest says the step is already
+        done. It returns True if the step ran.
+        '''
+        if self.is_current(step_name, cmd):
+            return False
+
+        # Forget the old record first; a step that fails halfway must never
+        #  look finished.
+        if self.manifest['steps'].pop(step_name, None):
+            self.save(True)
+        before = dict((filename, self.stamp_file(filename))
+                      for filename in self.fetch_file_names(cmd))
+        call(cmd)
+
+        inputs = {}
+        outputs = {}
+        for filename in self.fetch_file_names(cmd):
+            stamp = self.stamp_file(filename)
+            if before.get(filename) == stamp:
+                inputs[filename] = stamp + [hash_file(filename)]
+            else:
+                outputs[filename] = stamp
+        self.manifest['steps'][step_name] = {'cmd': cmd, 'inputs': inputs,
+                                             'outputs': outputs}
+        self.save(True)
+        return True
+
+    def fetch_outputs(self, step_name):
+        step = self.manifest['steps'].get(step_name)
+        if not step:
+            return []
+        return sorted(step['outputs'])
+
+    def save(self, changed=False):
+        if changed or self.changed:
+            store_json_file(self.manifest_file, self.manifest)
+            self.changed = False
@@ -0,0 +1,510 @@
+#!/bin/python
+import os
+import os.path
+import re
+import json
+import subprocess
+import time
+
+from Sketch_Build import Sketch_Build, Platform_Set, normalize_path
+from File_Watcher import File_Watcher
+import Build_Trace
+from Job_Runner import Job_Pool
+from Object_Cache import Object_Cache
+from Core_Cache import Core_Cache
+from Library_Cache import Library_Cache
+from Compile_History import Compile_History
+from Upload_Record import Upload_Record
+from Unity_Build import Unity_Rules
+from Platform_Cache import Platform_Cache
+from Source_Index import Source_Index
+from Variable_Loader import Variable_Cycle_Error
+
+# These are the things that can go wrong with one target without it being
+#  any reason to give up on the others: a missing file or folder, a board or
+#  option that doesn't exist, a broken variable, or a tool that fails.
+Target_Errors = (EnvironmentError, ValueError, KeyError,
+                 subprocess.CalledProcessError)
+
+class Build_Matrix:
+    ''' Build_Matrix builds a list of targets (a sketch, a board, and the
+    board's menu options) in one go. Every platform is parsed just once, every
+    distinct core configuration is compiled just once, and the compile jobs
+    of every target go onto one shared job pool, so the CPUs stay busy from
+    the first object to the last instead of idling through 40 separate
+    start-ups.
+
+    With keep_going set, a target that fails is noted and the rest carry
+    on; otherwise the first failure stops everything, like a plain build
+    always has. Either way, each target's error (None if it built) is kept
+    for print_summary().
+
+    Uploads are skipped when the board on the port already has the same
+    firmware (see Upload_Record), unless force_upload is set. Given an
+    Upload_Farm, each target is uploaded to all of the farm's ports instead
+    of its own serial_port.
+    '''
+    def __init__(self, settings_list, cache_path, index_file, build_jobs=0,
+                 object_cache_size=0, keep_going=False, force_upload=False,
+                 upload_farm=None):
+        self.cache_path = cache_path
+        self.index_file = index_file
+        self.build_jobs = build_jobs
+        self.object_cache_size = object_cache_size
+        self.keep_going = keep_going
+        self.force_upload = force_upload
+        self.upload_farm = upload_farm
+        self.Uploads = Upload_Record(cache_path + "/uploads.json")
+
+        # Only tag messages with the target name if there's more than one.
+        self.targets = []
+        for settings in settings_list:
+            label = settings['name'] if len(settings_list) > 1 else None
+            self.targets.append(Sketch_Build(settings, label))
+        self.cores = {}
+        self.object_caches = []
+        self.failed_items = set()
+        self.History = Compile_History()
+        self.Unity = Unity_Rules(cache_path + "/unity_fallback.json")
+
+    def make_object_cache(self, base_paths):
+        # One Object_Cache per set of base paths, since those are what
+        #  let two build folders share objects; they all share the same store
+        #  on disk.
+        if self.object_cache_size <= 0:
+            return None
+        Objects = Object_Cache(self.cache_path + "/object_cache",
+                               self.object_cache_size * 1024 * 1024,
+                               base_paths)
+        self.object_caches.append(Objects)
+        return Objects
+
+    def fail(self, target, error):
+        target.error = str(error) or error.__class__.__name__
+        print "[" + target.name + "] FAILED: " + target.error
+
+    def run(self):
+        '''
+        run builds every target up to its hex file. It returns True if all
+        of them made it.
+        '''
+        start_time = time.time()
+        Platforms = Platform_Cache(self.cache_path + "/platform_cache")
+        first_settings = self.targets[0].settings
+        self.platform_set = Platform_Set(Platforms,
+                                         first_settings['sketchbook_path'],
+                                         first_settings['runtime_ide_path'],
+                                         self.cache_path +
+                                         "/library_index.json")
+
+        # One walk of the source folders serves every target; a library
+        #  folder that ten targets use is listed once and then just stat()ed.
+        self.Sources = Source_Index(self.index_file)
+
+        # Finished core and library archives are shared between sketches
+        #  and survive a wiped build folder; they're kept alongside the
+        #  object cache, and switched off along with it.
+        if self.object_cache_size > 0:
+            self.Cores = Core_Cache(self.cache_path + "/core_cache")
+            self.Libraries = Library_Cache(self.cache_path +
+                                           "/library_cache")
+        else:
+            self.Cores = None
+            self.Libraries = None
+
+        for target in self.targets:
+            self.prepare_target(target)
+        self.Sources.save()
+
+        # Every compile job, from every core and every target, goes in one
+        #  list. The cores go first, since every target needs its core.
+        builder_list = []
+        for core in self.cores.values():
+            builder_list.extend(core.builder_list)
+        for target in self.targets:
+            if target.error is None:
+                builder_list.extend(target.builder_list)
+
+        self.build(builder_list, [target for target in self.targets
+                                  if target.error is None])
+
+        self.build_time = time.time() - start_time
+        return all(target.error is None for target in self.targets)
+
+    def prepare_target(self, target):
+        target.error = None
+        try:
+            target.prepare(self.platform_set, self.Sources, self.cores,
+                           self.make_object_cache, self.Cores, self.Unity,
+                           self.Libraries)
+        except Target_Errors + (Variable_Cycle_Error,) as e:
+            if not self.keep_going:
+                raise
+            self.fail(target, e)
+        finally:
+            target.end_step()
+
+    def build(self, builder_list, target_list):
+        '''
+        build runs every job in builder_list, then archives any core that
+        isn't archived yet and links every target in target_list.
+        '''
+        # Precompiled headers have to be in place before anything that uses
+        #  them starts compiling. One that won't build is no great loss:
+        #  the objects just read the header the slow way.
+        pch_list = [target.pch_builder for target in target_list
+                    if target.pch_builder and target.pch_builder.fetch_cmd()]
+        if pch_list:
+            print "Precompiling headers..."
+            Pch_Jobs = Job_Pool(self.build_jobs, True)
+            with Build_Trace.phase("Precompiling headers"):
+                for builder in Pch_Jobs.run(pch_list):
+                    print "Couldn't precompile " + \
+                          builder.fetch_out_file() + \
+                          "; compiling without it."
+                    if os.path.exists(builder.fetch_out_file()):
+                        os.remove(builder.fetch_out_file())
+            for builder, seconds in Pch_Jobs.job_times:
+                self.History.record(builder, seconds)
+
+        print "Building object files..."
+
+        # The cores and sketches don't depend on one another at this stage,
+        #  so we can throw them all at the job pool at once and let it keep
+        #  every CPU busy, starting with the files that took longest last
+        #  time.
+        Jobs = Job_Pool(self.build_jobs, self.keep_going, self.History)
+        try:
+            with Build_Trace.phase("Compiling"):
+                failed_items = set(Jobs.run(builder_list))
+        finally:
+            # Even a build that stopped at a broken file has timed the
+            #  ones that finished before it.
+            for builder, seconds in Jobs.job_times:
+                self.History.record(builder, seconds)
+            self.History.save()
+        self.failed_items = failed_items
+
+        # A unity group that only built a file at a time gets built that way
+        #  from now on; unless one of its files failed on its own, too, in
+        #  which case it's that file that's broken, not the group.
+        fallback_count = 0
+        for builder in builder_list:
+            if builder.fallback_list is not None and \
+               not failed_items.intersection(builder.fallback_list):
+                self.Unity.record_fallback(builder.fetch_source_list())
+                fallback_count += len(builder.fallback_list)
+        if fallback_count:
+            print "%d files won't build in a unity group; they'll be " \
+                  "compiled on their own from now on." % fallback_count
+        self.Unity.save()
+
+        self.History.print_report(Jobs.job_times, Jobs.wall_time,
+                                  Jobs.max_jobs)
+        self.report_pch_savings(target_list, Jobs.job_times,
+                                pch_list and Pch_Jobs.job_times)
+
+        with Build_Trace.phase("Trimming the object cache"):
+            self.update_cache_stats()
+
+        print "Placing core files into archive..."
+
+        for core in self.cores.values():
+            failed_count = count_failed(failed_items, core.builder_list)
+            if failed_count:
+                core.error = "%d core files failed to compile" % failed_count
+                continue
+            try:
+                with Build_Trace.phase("Archiving the core", core=core.key):
+                    core.make_archive()
+            except Target_Errors as e:
+                if not self.keep_going:
+                    raise
+                core.error = "archive failed: " + str(e)
+
+        # Failed compiles only ever get this far with keep_going set; without
+        #  it, the job pool has already raised.
+        for target in target_list:
+            if target.error is not None:
+                continue
+            if target.core.error:
+                self.fail(target, RuntimeError(target.core.error))
+                continue
+            failed_count = count_failed(failed_items, target.builder_list)
+            if failed_count:
+                self.fail(target, RuntimeError(
+                    "%d files failed to compile" % failed_count))
+                continue
+            try:
+                target.link()
+            except Target_Errors as e:
+                if not self.keep_going:
+                    raise
+                self.fail(target, e)
+
+    def report_pch_savings(self, target_list, job_times, pch_times):
+        '''
+        report_pch_savings says roughly how much time each target's
+        precompiled header saved. Precompiling the header takes about as
+        long as reading it once the slow way, so every compile that used it
+        saved about that much; if we had to precompile it this time, that
+        costs one of them back.
+        '''
+        compiled = set(builder for builder, seconds in job_times)
+        rebuilt = set(builder for builder, seconds in pch_times or [])
+        for target in target_list:
+            pch_builder = target.pch_builder
+            if not pch_builder or \
+               not os.path.exists(pch_builder.fetch_out_file()):
+                continue
+            record = self.History.fetch_record(pch_builder)
+            if not record:
+                continue
+            uses = len([builder for builder in target.builder_list
+                        if builder.pch_builder and builder in compiled])
+            if not uses:
+                continue
+            saved = record['seconds'] * uses
+            if pch_builder in rebuilt:
+                saved -= record['seconds']
+            target.log("Precompiled header used by %d compiles, saving "
+                       "about %.2f s" % (uses, saved))
+
+    def update_cache_stats(self):
+        if not self.object_caches:
+            return
+        Objects = self.object_caches[0]
+        Objects.hits = sum(cache.hits for cache in self.object_caches)
+        Objects.misses = sum(cache.misses for cache in self.object_caches)
+        Objects.trim()
+        cache_stats = Objects.update_stats()
+        print "Object cache: %d hits, %d misses this build " \
+              "(%d hits, %d misses overall)" % (Objects.hits,
+              Objects.misses, cache_stats['hits'], cache_stats['misses'])
+        # Those are on the books now; start counting afresh, in case
+        #  there's another build (in watch mode, say).
+        for cache in self.object_caches:
+            cache.hits = 0
+            cache.misses = 0
+
+    def upload(self, target_list):
+        for target in target_list:
+            if target.error is not None:
+                continue
+            try:
+                if self.upload_farm:
+                    self.upload_farm.upload(target, self.Uploads,
+                                            self.force_upload)
+                else:
+                    target.upload(self.Uploads, self.force_upload)
+            except Target_Errors as e:
+                if not self.keep_going:
+                    raise
+                self.fail(target, e)
+
+    def watch(self, upload=False):
+        '''
+        watch builds everything once, then sits and waits for files in the
+        sketch and library folders to change, rebuilding (and, if upload is
+        set, uploading) whatever they affect each time, until Ctrl-C. All the
+        parsed platform files, recipes, source listings and the dependency
+        lists from the compiler stay in memory between builds, so after a
+        save, the only real work left is compiling the file that changed and
+        linking.
+        '''
+        self.keep_going = True
+        self.run()
+        self.print_summary()
+        if upload:
+            self.upload(self.targets)
+
+        watch_paths = []
+        ignore_paths = []
+        for target in self.targets:
+            ignore_paths.extend([target.build_path,
+                                 target.sketch_path + "/build",
+                                 target.settings['core_root']])
+            if target.core is not None:
+                for path in target.fetch_watch_paths():
+                    if path not in watch_paths:
+                        watch_paths.append(path)
+
+        Watcher = File_Watcher(watch_paths, ignore_paths)
+        print "Watching %d folders for changes (%s); press Ctrl-C to " \
+              "stop." % (len(watch_paths), Watcher.fetch_mode())
+        try:
+            while True:
+                changed_files = Watcher.wait()
+                self.rebuild(changed_files, upload)
+        except KeyboardInterrupt:
+            print
+        finally:
+            Watcher.close()
+
+    def rebuild(self, changed_files, upload=False):
+        '''
+        rebuild brings every target up to date after changed_files have
+        changed, touching only the objects that depend on them.
+        '''
+        start_time = time.time()
+        changed_files = set(normalize_path(name) for name in changed_files)
+
+        # A new library, or one that's been edited, may change which
+        #  library a header belongs to.
+        if any(os.path.basename(name) == "library.properties" or
+               name.endswith(".h") for name in changed_files):
+            for platform_info in self.platform_set.platforms.values():
+                platform_info['libraries'].refresh()
+
+        # A library that's been edited has a new fingerprint.
+        if self.Libraries:
+            self.Libraries.forget_trees()
+
+        builder_list = []
+        target_list = []
+        for target in self.targets:
+            update_list = None
+            if target.core is not None:
+                update_list = target.refresh(changed_files)
+            if update_list is None:
+                # Something changed that needs a fresh look at the whole
+                #  target (or it never got that far last time).
+                self.prepare_target(target)
+                if target.error is not None:
+                    continue
+                update_list = target.builder_list
+            # Anything that failed to compile last time gets another go.
+            update_list = update_list + [builder for builder in
+                    target.builder_list if builder in self.failed_items and
+                    builder not in update_list]
+            if not update_list:
+                continue
+            target.error = None
+            builder_list.extend(update_list)
+            target_list.append(target)
+        self.Sources.save()
+
+        # A target that's been prepared again might have brought in a core
+        #  we haven't built yet.
+        for core in self.cores.values():
+            if not core.archived:
+                builder_list = core.builder_list + builder_list
+
+        if not target_list:
+            print "Nothing to rebuild for %d changed files." % \
+                  len(changed_files)
+            return
+
+        self.build(builder_list, target_list)
+        if upload:
+            self.upload(target_list)
+        for target in target_list:
+            if target.error is None:
+                target.log("Up to date in %.2f s" % (time.time() -
+                                                     start_time))
+
+    def print_summary(self):
+        print
+        print "%d targets, %d cores, %.1f s" % (len(self.targets),
+                len(self.cores), self.build_time)
+        name_width = max([len(target.name) for target in self.targets] + [6])
+        print "%-*s  %-6s  %8s  %6s  %s" % (name_width, "Target", "Result",
+                                            "Compiled", "Cached", "Core")
+        for target in self.targets:
+            compiled = cached = 0
+            for builder in target.builder_list:
+                if builder.from_cache:
+                    cached += 1
+                elif builder.is_updated():
+                    compiled += 1
+            if target.error is None:
+                result = "ok"
+            else:
+                result = "FAILED"
+            if target.core is None:
+                core_key = "-"
+            elif target.core.from_cache:
+                core_key = target.core.key[0:8] + " (cached)"
+            else:
+                core_key = target.core.key[0:8]
+            print "%-*s  %-6s  %8d  %6d  %s" % (name_width, target.name,
+                                                result, compiled, cached,
+                                                core_key)
+            if target.error is not None:
+                print "%-*s  %s" % (name_width, "", target.error)
+
+
+def count_failed(failed_items, builder_list):
+    # A unity group that fell back is never in failed_items itself; the
+    #  builders it handed its files to are.
+    return len([builder for builder in builder_list
+                if builder in failed_items]) + \
+           len([fallback for builder in builder_list
+                for fallback in builder.fallback_list or []
+                if fallback in failed_items])
+
+def read_matrix_file(matrix_file, defaults, build_path=None):
+    '''
+    read_matrix_file turns a matrix file into a list of settings dicts, one
+    per target, for Build_Matrix. The file is JSON: either a list of targets
+    or a dict with a "targets" list in it. Each target looks like this:
+
+        {"sketch": "path/to/Blink", "board": "uno",
+         "options": {"cpu": "atmega328"}, "name": "blink-uno"}
+
+    Only "sketch" is required. "board", "platform" (the platform folder) and
+    "serial_port" default to the settings in defaults, "options" add to the
+    ones in defaults, and "name" is made up from the sketch, board and
+    options. Relative paths are taken relative to the matrix file. Each
+    target is built in its own folder under build_path (by default, a
+    "build" folder next to the matrix file), and the cores under
+    build_path/cores.
+    '''
+    with open(matrix_file) as f:
+        matrix = json.load(f)
+    if isinstance(matrix, dict):
+        matrix = matrix['targets']
+
+    matrix_path = os.path.dirname(os.path.abspath(matrix_file))
+    if build_path is None:
+        build_path = matrix_path + "/build"
+
+    def full_path(path):
+        path = str(path).replace("\\", "/")
+        if os.path.isabs(path):
+            return path
+        return (matrix_path + "/" + path).replace("\\", "/")
+
+    settings_list = []
+    name_list = []
+    for entry in matrix:
+        settings = dict(defaults)
+        settings['sketch_path'] = full_path(entry['sketch']).rstrip("/")
+        settings['board'] = str(entry.get('board', defaults['board']))
+        settings['board_options'] = dict(defaults['board_options'])
+        for menu, option in entry.get('options', {}).items():
+            settings['board_options'][str(menu)] = str(option)
+        if 'platform' in entry:
+            settings['runtime_platform_path'] = full_path(entry['platform'])
+        if 'serial_port' in entry:
+            settings['serial_port'] = str(entry['serial_port'])
+
+        name = entry.get('name')
+        if not name:
+            name = "-".join([os.path.basename(settings['sketch_path']),
+                             settings['board']] +
+                            [menu + "=" + option for menu, option in
+                             sorted(settings['board_options'].items())])
+        name = str(name)
+        # Two targets with the same name would share a build folder, which
+        #  would end badly.
+        if name in name_list:
+            name = name + "-" + str(len(name_list))
+        name_list.append(name)
+
+        settings['name'] = name
+        settings['build_path'] = build_path + "/" + \
+                re.sub('[^\w.=+-]', "_", name)
+        settings['core_root'] = build_path + "/cores"
+        settings_list.append(settings)
+    return settings_list
@@ -0,0 +1,204 @@
+#!/bin/python
+import os.path
+import json
+import subprocess
+import threading
+import time
+from contextlib import contextmanager
+
+# Build_Trace keeps track of where a build's time goes: how long each phase
+#  took (parsing the platform files, finding sources, compiling, archiving,
+#  linking, uploading...), and how long every command we ran took, what it
+#  was, and how it ended. At the end, it can write all of that out in the
+#  Chrome trace-event format (load it in chrome://tracing or
+#  ui.perfetto.dev) and print a table of the slowest phases and files.
+#
+# Tracing is off until somebody calls start_trace(); until then, phase() and
+#  friends cost next to nothing, so the rest of the code can use them
+#  without checking first.
+_trace = None
+
+class Build_Trace:
+
+    def __init__(self):
+        self.start_time = time.time()
+        self.phases = []
+        self.jobs = []
+        # Each thread gets its own row in the trace viewer; we number them in
+        #  the order they first show up, main thread first.
+        self.thread_ids = {}
+        self.lock = threading.Lock()
+
+    def thread_id(self):
+        name = threading.current_thread().name
+        with self.lock:
+            if name not in self.thread_ids:
+                self.thread_ids[name] = len(self.thread_ids)
+            return self.thread_ids[name]
+
+    def add_phase(self, name, start, end, args):
+        record = {'name': name, 'start': start, 'end': end,
+                  'tid': self.thread_id(), 'args': args}
+        with self.lock:
+            self.phases.append(record)
+
+    def add_job(self, name, cmd, start, end, status, skipped=None,
+                target=None):
+        # skipped is None for a job that really ran; otherwise it's why it
+        #  didn't ("up to date", or "cached" if the object cache had it).
+        record = {'name': name, 'start': start, 'end': end,
+                  'tid': self.thread_id(), 'status': status,
+                  'skipped': skipped, 'target': target,
+                  'cmd': subprocess.list2cmdline(cmd) if cmd else ""}
+        with self.lock:
+            self.jobs.append(record)
+
+    def microseconds(self, timestamp):
+        return int((timestamp - self.start_time) * 1000000)
+
+    def fetch_events(self):
+        '''
+        fetch_events returns everything we've recorded as a list of
+        trace events.
+        '''
+        events = []
+        for name, tid in self.thread_ids.items():
+            events.append({'name': 'thread_name', 'ph': 'M', 'pid': 1,
+                           'tid': tid, 'args': {'name': name}})
+        for record in self.phases:
+            events.append({'name': record['name'], 'cat': 'phase',
+                           'ph': 'X', 'pid': 1, 'tid': record['tid'],
+                           'ts': self.microseconds(record['start']),
+                           'dur': self.microseconds(record['end']) -
+                                  self.microseconds(record['start']),
+                           'args': record['args']})
+        for record in self.jobs:
+            args = {'cmd': record['cmd'], 'status': record['status']}
+            if record['target']:
+                args['target'] = record['target']
+            if record['skipped']:
+                # Skipped jobs show up as instant events, so you can still
+                #  see that we looked at them.
+                args['skipped'] = record['skipped']
+                events.append({'name': record['name'], 'cat': 'skipped',
+                               'ph': 'i', 's': 't', 'pid': 1,
+                               'tid': record['tid'],
+                               'ts': self.microseconds(record['start']),
+                               'args': args})
+                continue
+            events.append({'name': record['name'], 'cat': 'job', 'ph': 'X',
+                           'pid': 1, 'tid': record['tid'],
+                           'ts': self.microseconds(record['start']),
+                           'dur': self.microseconds(record['end']) -
+                                  self.microseconds(record['start']),
+                           'args': args})
+        return events
+
+    def write_chrome_trace(self, filename):
+        with open(filename, 'w') as f:
+            json.dump({'traceEvents': self.fetch_events(),
+                       'displayTimeUnit': 'ms'}, f)
+
+    def print_summary(self, count=10):
+        print
+        print "Build trace: %.2f s total" % (time.time() - self.start_time)
+
+        # Phases with the same name (one per target, say) are added up.
+        phase_totals = {}
+        for record in self.phases:
+            total = phase_totals.setdefault(record['name'], [0.0, 0])
+            total[0] += record['end'] - record['start']
+            total[1] += 1
+        print "%-40s %10s %6s" % ("Slowest phases", "time (s)", "count")
+        for name, total in sorted(phase_totals.items(),
+                                  key=lambda item: -item[1][0])[0:count]:
+            print "%-40s %10.3f %6d" % (name[0:40], total[0], total[1])
+
+        ran = [record for record in self.jobs if not record['skipped']]
+        skipped = len(self.jobs) - len(ran)
+        print
+        print "%d commands run, %d skipped (up to date or cached)" % \
+              (len(ran), skipped)
+        print "%-40s %10s %6s" % ("Slowest commands", "time (s)", "status")
+        for record in sorted(ran, key=lambda record: record['start'] -
+                             record['end'])[0:count]:
+            print "%-40s %10.3f %6s" % (record['name'][0:40],
+                                        record['end'] - record['start'],
+                                        record['status'])
+
+
+def start_trace():
+    global _trace
+    _trace = Build_Trace()
+    return _trace
+
+def fetch_trace():
+    return _trace
+
+@contextmanager
+def phase(name, **args):
+    '''
+    phase times the code in a with block as one phase of the build:
+
+        with Build_Trace.phase("Linking", target="Blink"):
+            ...
+    '''
+    if _trace is None:
+        yield
+        return
+    start = time.time()
+    try:
+        yield
+    finally:
+        _trace.add_phase(name, start, time.time(), args)
+
+def begin_phase(name, **args):
+    # For phases that don't fit neatly in a with block: begin_phase() hands
+    #  back a token, and end_phase() on that token records the phase.
+    return (name, time.time(), args)
+
+def end_phase(token):
+    if _trace:
+        _trace.add_phase(token[0], token[1], time.time(), token[2])
+
+def record_job(builder, cmd, start, end, status, target=None):
+    if _trace:
+        _trace.add_job(job_name(builder, cmd), cmd, start, end, status,
+                       target=target)
+
+def record_skipped(builder, target=None):
+    if _trace:
+        if getattr(builder, 'from_cache', False):
+            reason = "cached"
+        else:
+            reason = "up to date"
+        now = time.time()
+        _trace.add_job(job_name(builder, None), None, now, now, None,
+                       reason, target)
+
+def job_name(builder, cmd):
+    # Name a job after the file it makes, if it makes one; otherwise after
+    #  the program it runs.
+    out_file = builder and builder.fetch_out_file()
+    if out_file:
+        return os.path.basename(out_file)
+    if cmd:
+        return os.path.basename(cmd[0])
+    return "job"
+
+def check_call(cmd, name=None, target=None):
+    '''
+    check_call is subprocess.check_call(), with the command recorded in the
+    trace (if there is one) under name.
+    '''
+    start = time.time()
+    status = None
+    try:
+        status = subprocess.call(cmd)
+    finally:
+        if _trace:
+            _trace.add_job(name or os.path.basename(cmd[0]), cmd, start,
+                           time.time(), status, target=target)
+    if status != 0:
+        raise subprocess.CalledProcessError(status, cmd)
+    return status
@@ -0,0 +1,119 @@
+#!/bin/python
+import os
+import os.path
+import hashlib
+import json
+import tempfile
+
+# These are the little bits of plumbing that every on-disk cache we keep
+#  needs: hashing files without reading them over and over, and writing files
+#  in a way that a second build running at the same time (or a Ctrl-C halfway
+#  through) can never see half of.
+
+# hash_file() returns the SHA-1 of a file's contents, or None if the file
+#  doesn't exist. A build hashes the same core headers over and over, so we
+#  remember each answer along with the size and mtime we saw at the time; as
+#  long as those still match, we don't need to read the file again.
+_hash_cache = {}
+
+def hash_file(filename):
+    try:
+        file_stat = os.stat(filename)
+    except OSError:
+        return None
+    stamp = (file_stat.st_size, file_stat.st_mtime)
+    cached = _hash_cache.get(filename)
+    if cached and cached[0] == stamp:
+        return cached[1]
+
+    digest = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(65536), b''):
+            digest.update(chunk)
+    _hash_cache[filename] = (stamp, digest.hexdigest())
+    return digest.hexdigest()
+
+def hash_string(text):
+    return hashlib.sha1(text).hexdigest()
+
+def replace_file(source, destination):
+    # os.rename() will happily replace an existing file on POSIX, and the
+    #  replace is atomic. Windows refuses to rename over an existing file, so
+    #  there we have to delete it first and accept a tiny window where the
+    #  file is missing. Anybody reading a cache file treats a missing file as
+    #  a miss, so that's okay.
+    try:
+        os.rename(source, destination)
+    except OSError:
+        try:
+            os.remove(destination)
+        except OSError:
+            pass
+        os.rename(source, destination)
+
+def make_temp_file(destination):
+    # The temporary file has to live in the same directory as the final one,
+    #  or the rename won't be atomic (or even possible, across drives).
+    directory = os.path.dirname(destination)
+    if not os.path.exists(directory):
+        try:
+            os.makedirs(directory)
+        except OSError:
+            # Someone else made it between our check and our makedirs().
+            pass
+    handle, temp_name = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    os.close(handle)
+    return temp_name
+
+def write_file_atomically(filename, data):
+    temp_name = make_temp_file(filename)
+    try:
+        with open(temp_name, 'wb') as f:
+            f.write(data)
+        replace_file(temp_name, filename)
+    except:
+        if os.path.exists(temp_name):
+            os.remove(temp_name)
+        raise
+
+def native_strings(data):
+    # json hands back unicode strings, but everything else in here works with
+    #  plain byte strings; mixing the two goes wrong as soon as a path has a
+    #  non-ASCII character in it. So, convert the whole lot back.
+    if isinstance(data, unicode):
+        return data.encode('utf-8')
+    if isinstance(data, list):
+        return [native_strings(item) for item in data]
+    if isinstance(data, dict):
+        return dict((native_strings(key), native_strings(value))
+                    for key, value in data.items())
+    return data
+
+# normalize_paths() swaps any of base_paths in text for a placeholder, so two
+#  build folders (or two checkouts of the same sketch) hash the same, and the
+#  caches that hash them get to share what they've stored; denormalize_paths()
+#  puts them back. Longest first, so a build folder inside a sketch folder
+#  gets recognized as such.
+def normalize_paths(text, base_paths):
+    for index, base_path in enumerate(sorted(base_paths, key=len,
+                                             reverse=True)):
+        text = text.replace(base_path, "{base_" + str(index) + "}")
+    return text
+
+def denormalize_paths(text, base_paths):
+    for index, base_path in enumerate(sorted(base_paths, key=len,
+                                             reverse=True)):
+        text = text.replace("{base_" + str(index) + "}", base_path)
+    return text
+
+def load_json_file(filename, default=None):
+    # A cache file that's missing, truncated, or from some older version of
+    #  this script is just a miss; never an error.
+    try:
+        with open(filename) as f:
+            return native_strings(json.load(f))
+    except (IOError, ValueError):
+        return default
+
+def store_json_file(filename, data):
+    write_file_atomically(filename, json.dumps(data, sort_keys=True))
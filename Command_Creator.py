@@ -1,11 +1,88 @@
 #!/bin/python
 import os.path
 import subprocess
-import shlex
 import re
 
+# Every object in a build tends to include the same couple dozen core headers,
+#  so we remember the mtimes we've already looked up rather than asking the
+#  filesystem hundreds of times for the same file. A missing file is stored
+#  as None.
+_mtime_cache = {}
+
+def fetch_mtime(filename):
+    if filename not in _mtime_cache:
+        try:
+            _mtime_cache[filename] = os.path.getmtime(filename)
+        except OSError:
+            _mtime_cache[filename] = None
+    return _mtime_cache[filename]
+
+def clear_mtime_cache():
+    _mtime_cache.clear()
+
+def forget_mtime(filename):
+    # For when we know a file has changed, and the mtime we've got for it is
+    #  stale; see Build_Matrix.watch().
+    _mtime_cache.pop(filename, None)
+
+# parse_dependency_file() reads a make-style dependency file, as written by
+#  gcc's -MMD/-MF flags, and returns the list of files the object depends on.
+#  If there's no such file, we get None back, which is NOT the same thing as
+#  an empty list: it means we don't know what the object depends on.
+Dependency_Target_re = re.compile(r':(?:\s|$)')
+Dependency_Split_re = re.compile(r'(?<!\\)\s+')
+
+def parse_dependency_file(dep_file):
+    try:
+        with open(dep_file) as f:
+            contents = f.read()
+    except IOError:
+        return None
+
+    # Long rules are split over several lines with a trailing backslash; glue
+    #  them back together so each rule is on a single line.
+    contents = contents.replace('\\\r\n', ' ').replace('\\\n', ' ')
+
+    # The first rule is the one for the object file. Anything after that is
+    #  the empty "header.h:" rules that -MP adds, which we don't care about.
+    rule = contents.split('\n', 1)[0]
+
+    # Windows paths have colons in them (c:/foo), so we can't just split on
+    #  the first colon we see; the one we want has whitespace after it.
+    split_rule = Dependency_Target_re.split(rule, 1)
+    if len(split_rule) < 2:
+        return []
+
+    dependency_list = []
+    for dependency in Dependency_Split_re.split(split_rule[1].strip()):
+        if dependency:
+            dependency_list.append(dependency.replace('\\ ', ' ').\
+                                   replace('$$', '$'))
+    return dependency_list
+
+def write_stand_in(filename, contents):
+    # The little generated sources (see Pch_Builder and Unity_Builder) are
+    #  only written when what goes in them changes; a new mtime alone would
+    #  mean compiling them, and everything that depends on them, again.
+    try:
+        with open(filename) as f:
+            old_contents = f.read()
+    except IOError:
+        old_contents = None
+    if contents != old_contents:
+        if not os.path.exists(os.path.dirname(filename)):
+            os.makedirs(os.path.dirname(filename))
+        with open(filename, 'w') as f:
+            f.write(contents)
+        forget_mtime(filename)
+
 class Cmd_Builder:
 
+    # The name of the target this job is run for, so the build trace can
+    #  tell which target each job belongs to in a matrix build. The target
+    #  fills it in; see Sketch_Build.prepare().
+    target_name = None
+
     def __init__(self):
         pass
 
@@ -25,38 +102,294 @@ class Cmd_Builder:
         return self.cmd_arg_list
 
     def fetch_cmd(self):
+        # The command comes back as an argument list, ready for subprocess.
         if self.cmd_arg_list:
-            return " ".join(self.cmd_arg_list)
+            return self.cmd_arg_list
         else:
             return None
 
+    def build_complete(self):
+        # Called once the command has run successfully. Most builders have
+        #  nothing to do here.
+        pass
+
+    def fetch_fallback(self):
+        # Called if the command fails. A builder with another way to get the
+        #  job done hands back a list of builders to run instead; most just
+        #  fail.
+        return None
+
 class Obj_Builder(Cmd_Builder):
 
-    def __init__(self, build_path, source_file, build_cmd_pattern):
+    out_suffix = '.o'
+
+    # The builders that took over from this one after its command failed,
+    #  if it had any to hand over to; see Unity_Builder.
+    fallback_list = None
+
+    def __init__(self, build_path, source_file, build_recipe,
+                 object_cache=None, object_path=None, pch_builder=None):
+        # The object goes in object_path, a folder somewhere under the build
+        #  folder that mirrors where the source lives (see make_builders()),
+        #  so two sources with the same name never fight over one object.
         self.in_file = source_file
-        self.out_file = build_path + "/" +\
-                source_file.rsplit("/",1)[1] + '.o'
-
-        if ((os.path.exists(self.out_file) == False) or
-           (os.path.exists(self.out_file) and
-           (os.path.getmtime(source_file) > os.path.getmtime(self.out_file)))):
-            self.cmd_arg_list = shlex.split(build_cmd_pattern.\
-                    replace('{source_file}', source_file).\
-                    replace('{object_file}', self.out_file))
+        self.build_path = build_path
+        if object_path is None:
+            object_path = build_path
+        self.out_file = object_path + "/" +\
+                source_file.rsplit("/",1)[1] + self.out_suffix
+        self.object_cache = object_cache
+        self.pch_builder = pch_builder
+
+        # Alongside each object we keep two more files: the dependency file
+        #  the compiler writes for us, listing every header the source pulled
+        #  in, and a copy of the command line we built the object with. Between
+        #  them, they let us tell if the object is stale even though the
+        #  source file itself hasn't been touched.
+        out_name = os.path.splitext(self.out_file)[0]
+        self.dep_file = out_name + '.d'
+        self.recipe_file = out_name + '.cmd'
+
+        # build_recipe is a Recipe_Template; all we have to do is put our file
+        #  names into it.
+        cmd_arg_list = self.fill_recipe(build_recipe)
+
+        # With a precompiled header, gcc looks for Arduino.h.gch next to the
+        #  Arduino.h we -include, and uses it if it's there and fits; if it
+        #  isn't, or doesn't, it reads Arduino.h the slow way, and the result
+        #  is the same either way.
+        if pch_builder:
+            cmd_arg_list.extend(["-include", pch_builder.fetch_source_file()])
+
+        # Lots of platform.txt files already ask for -MMD; if this one didn't,
+        #  we ask for it ourselves. We always want to know where the file is
+        #  going to land, though, so if the recipe doesn't name it with -MF,
+        #  we do.
+        if "-MMD" not in cmd_arg_list and "-MD" not in cmd_arg_list:
+            cmd_arg_list.append("-MMD")
+        if "-MF" in cmd_arg_list:
+            self.dep_file = cmd_arg_list[cmd_arg_list.index("-MF") + 1]
+        else:
+            cmd_arg_list.extend(["-MF", self.dep_file])
+
+        self.full_cmd = subprocess.list2cmdline(cmd_arg_list)
+        self.build_cmd = cmd_arg_list
+        self.dependency_list = None
+        self.refresh()
+
+    def refresh(self):
+        '''
+        refresh works out (again) whether this object needs building. A
+        builder that sticks around between builds, like the ones in watch
+        mode, calls this when one of the files it depends on has changed.
+        '''
+        self.dependency_list = None
+
+        # Even if the object is out of date, somebody may have built this
+        #  exact file with this exact command before, in another sketch or
+        #  another build folder. If so, the cache hands us their object and
+        #  we've got nothing left to do.
+        self.from_cache = False
+        if self.is_out_of_date():
+            if self.object_cache and self.object_cache.fetch(self):
+                # The cache wrote us a new dependency file, too.
+                self.from_cache = True
+                self.dependency_list = None
+                self.cmd_arg_list = None
+            else:
+                self.cmd_arg_list = self.build_cmd
         else:
             self.cmd_arg_list = None
 
+    def is_updated(self):
+        # True if this object is new this build, whether we're about to
+        #  compile it or the cache already put it in place.
+        return self.cmd_arg_list is not None or self.from_cache
+
+    def is_out_of_date(self):
+        out_mtime = fetch_mtime(self.out_file)
+
+        # No object file at all, or one older than its source, is the easy
+        #  case.
+        if out_mtime is None:
+            return True
+        if fetch_mtime(self.in_file) > out_mtime:
+            return True
+
+        # If the command we'd run now isn't the one we ran last time (say, the
+        #  include path list or the board flags changed), the old object can't
+        #  be trusted.
+        try:
+            with open(self.recipe_file) as f:
+                if f.read() != self.full_cmd:
+                    return True
+        except IOError:
+            return True
+
+        # Finally, check every header the compiler told us the object depends
+        #  on. If we don't have a dependency file, we don't know what the
+        #  object depends on, so we rebuild it to find out.
+        dependency_list = self.fetch_dependencies()
+        if dependency_list is None:
+            return True
+        for dependency in dependency_list:
+            dependency_mtime = fetch_mtime(dependency)
+            if dependency_mtime is None or dependency_mtime > out_mtime:
+                return True
+
+        return False
+
+    def fill_recipe(self, build_recipe):
+        return build_recipe.fill({'source_file': self.in_file,
+                                  'object_file': self.out_file})
+
+    def fetch_source_list(self):
+        # Every source file that goes into the object.
+        return [self.in_file]
+
+    def fetch_object_list(self):
+        # Every object file to link (or archive) in place of this one.
+        return [self.out_file]
+
+    def fetch_dependencies(self):
+        # The files the compiler says this object was built from, as of the
+        #  last build, or None if we don't know. We only read the dependency
+        #  file once per build.
+        if self.dependency_list is None:
+            self.dependency_list = parse_dependency_file(self.dep_file)
+            # Headers that came in through the precompiled header don't show
+            #  up in our own dependency file, so we borrow its list.
+            if self.dependency_list is not None and self.pch_builder:
+                self.dependency_list = self.dependency_list + \
+                        (self.pch_builder.fetch_dependencies() or [])
+        return self.dependency_list
+
+    def record_cmd(self):
+        # The object is now built with full_cmd, so remember that for next time.
+        with open(self.recipe_file, 'w') as f:
+            f.write(self.full_cmd)
+
+    def build_complete(self):
+        # The compiler actually produced this object (as opposed to the cache
+        #  handing it to us), so hand it on to the cache for other builds.
+        self.record_cmd()
+        self.dependency_list = None
+        if self.object_cache:
+            self.object_cache.store(self)
+
+class Pch_Builder(Obj_Builder):
+    ''' Pch_Builder precompiles a header (Arduino.h, really) for the objects
+    of one target. The header isn't compiled where it sits: we put a one-line
+    stand-in that #includes it in build_path/pch, and compile that into
+    Arduino.h.gch right next to it, so it's the stand-in the objects
+    -include. It's compiled with the very same recipe as the .cpp files that
+    use it, since gcc only takes a precompiled header built with the same
+    flags; it's just told the source is a header.
+    '''
+
+    out_suffix = '.gch'
+
+    def __init__(self, build_path, header_file, build_recipe):
+        pch_path = build_path + "/pch"
+        stand_in = pch_path + "/" + os.path.basename(header_file)
+        write_stand_in(stand_in, '#include "' + header_file + '"\n')
+        Obj_Builder.__init__(self, build_path, stand_in, build_recipe, None,
+                             pch_path)
+
+    def fill_recipe(self, build_recipe):
+        cmd_arg_list = Obj_Builder.fill_recipe(self, build_recipe)
+        if self.in_file in cmd_arg_list:
+            index = cmd_arg_list.index(self.in_file)
+        else:
+            index = len(cmd_arg_list)
+        cmd_arg_list[index:index] = ["-x", "c++-header"]
+        return cmd_arg_list
+
+class Unity_Builder(Obj_Builder):
+    ''' Unity_Builder compiles a group of sources as one: a generated file
+    that #includes each of them in turn, so the compiler gets started once,
+    and reads the headers they share once, for the whole group. Errors still
+    point at the real files, and the dependency file lists every one of them,
+    so editing any file in the group rebuilds the group.
+
+    Not every pile of sources survives being glued together; two files that
+    each have a static helper of the same name is enough to break it. If the
+    compile fails, fetch_fallback() calls make_fallback() for an ordinary
+    Obj_Builder per file, and the job pool builds those instead.
+    '''
+
+    def __init__(self, build_path, unity_file, source_file_list, build_recipe,
+                 object_cache, object_path, pch_builder, make_fallback):
+        self.source_file_list = source_file_list
+        self.make_fallback = make_fallback
+        write_stand_in(unity_file,
+                       "".join('#include "' + source_file + '"\n'
+                               for source_file in source_file_list))
+        Obj_Builder.__init__(self, build_path, unity_file, build_recipe,
+                             object_cache, object_path, pch_builder)
+
+    def fetch_fallback(self):
+        if self.fallback_list is None:
+            self.fallback_list = self.make_fallback()
+            for builder in self.fallback_list:
+                builder.target_name = self.target_name
+        return self.fallback_list
+
+    def fetch_source_list(self):
+        return self.source_file_list
+
+    def fetch_object_list(self):
+        if self.fallback_list is not None:
+            return [builder.fetch_out_file()
+                    for builder in self.fallback_list]
+        return [self.out_file]
+
+
 class Archive_Builder(Cmd_Builder):
+    ''' Archive_Builder turns an archive recipe and a list of object files into
+    as few archiver commands as it can. Most recipes have a lone
+    "{object_file}" argument, and ar will take as many objects as we care to
+    give it there, so we hand it the whole list, split into chunks short
+    enough to stay under the command line length limit. A recipe that uses
+    {object_file} in some other way (glued onto a flag, say, or more than
+    once) gets one command per object, like it always did.
+    '''
+
+    # Windows is the tightest here: cmd.exe tops out at 8191 characters. We
+    #  don't go through cmd.exe, but the tools we run sometimes do.
+    max_cmd_length = 8000
 
-    def __init__(self, build_path, source_file, build_cmd_pattern):
-        self.obj_file = build_path + "/" +\
-                source_file.rsplit("/",1)[1] + '.o'
+    def __init__(self, archive_recipe, object_file_list):
+        self.in_file = None
+        self.out_file = None
+        self.cmd_list = []
 
-        if ((os.path.exists(self.obj_file) == False) or
-           (os.path.exists(self.obj_file) and
-           (os.path.getmtime(source_file) > os.path.getmtime(self.obj_file)))):
-            self.cmd_arg_list = shlex.split(build_cmd_pattern.\
-                    replace('{source_file}', source_file).\
-                    replace('{object_file}', self.obj_file))
+        if archive_recipe.is_lone_slot('object_file'):
+            base_length = len(subprocess.list2cmdline(
+                    archive_recipe.fill({'object_file': []})))
+            chunk = []
+            chunk_length = base_length
+            for obj in object_file_list:
+                obj_length = len(subprocess.list2cmdline([obj])) + 1
+                if chunk and chunk_length + obj_length > self.max_cmd_length:
+                    self.cmd_list.append(archive_recipe.fill(
+                            {'object_file': chunk}))
+                    chunk = []
+                    chunk_length = base_length
+                chunk.append(obj)
+                chunk_length += obj_length
+            if chunk:
+                self.cmd_list.append(archive_recipe.fill(
+                        {'object_file': chunk}))
+        else:
+            for obj in object_file_list:
+                self.cmd_list.append(archive_recipe.fill(
+                        {'object_file': obj}))
+
+        if self.cmd_list:
+            self.cmd_arg_list = self.cmd_list[0]
         else:
             self.cmd_arg_list = None
+
+    def fetch_cmd_list(self):
+        return self.cmd_list
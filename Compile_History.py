@@ -0,0 +1,126 @@
+#!/bin/python
+import os
+import os.path
+
+from Cache_Store import load_json_file, store_json_file
+
+history_version = 1
+
+# Until we've timed at least one compile, we guess that the compiler gets
+#  through about 50 kB of source a second. It's only ever used to put files
+#  in order, so it just has to be the right shape.
+default_seconds_per_byte = 1.0 / 50000
+
+class Compile_History:
+    ''' Compile_History remembers how long each object file took to compile,
+    in a compile_times.json file in the build folder, so the next build can
+    start the slowest files first. With one job per CPU, a big file that
+    happens to come last in the list leaves every other CPU idle while it
+    finishes; started first, it runs alongside everything else.
+
+    A file we've never timed (a new one, or the first build in a folder)
+    gets an estimate from its size, at the rate the files we have timed
+    went at.
+    '''
+    def __init__(self):
+        # The history of each build folder we've looked at, by folder.
+        self.folders = {}
+        self.changed = set()
+
+    def history_file(self, path):
+        return path + "/compile_times.json"
+
+    def fetch_folder(self, path):
+        if path not in self.folders:
+            history = load_json_file(self.history_file(path))
+            if not isinstance(history, dict) or \
+               history.get('version') != history_version:
+                history = {'version': history_version, 'files': {}}
+            self.folders[path] = history
+        return self.folders[path]['files']
+
+    def fetch_key(self, builder):
+        # Each build folder has one history, for all the objects in the tree
+        #  under it, filed by their path inside the folder.
+        out_file = builder.fetch_out_file()
+        build_path = getattr(builder, 'build_path', os.path.dirname(out_file))
+        return build_path, os.path.relpath(out_file, build_path).replace(
+                "\\", "/")
+
+    def fetch_record(self, builder):
+        path, name = self.fetch_key(builder)
+        return self.fetch_folder(path).get(name)
+
+    def seconds_per_byte(self):
+        total_seconds = 0.0
+        total_size = 0
+        for history in self.folders.values():
+            for record in history['files'].values():
+                total_seconds += record['seconds']
+                total_size += record['size']
+        if total_seconds <= 0 or total_size <= 0:
+            return default_seconds_per_byte
+        return total_seconds / total_size
+
+    def source_size(self, builder):
+        try:
+            return os.path.getsize(builder.fetch_source_file())
+        except OSError:
+            return 0
+
+    def estimate(self, builder, seconds_per_byte=None):
+        '''
+        estimate returns how many seconds we expect builder's compile to
+        take: what it took last time, or a guess from its size.
+        '''
+        record = self.fetch_record(builder)
+        if record:
+            return record['seconds']
+        if seconds_per_byte is None:
+            seconds_per_byte = self.seconds_per_byte()
+        return self.source_size(builder) * seconds_per_byte
+
+    def sort_jobs(self, builder_list):
+        '''
+        sort_jobs puts builder_list in place in the order we want to start
+        them: longest first.
+        '''
+        # Load every folder's history before working out the rate, so the
+        #  rate is the same for every file.
+        for builder in builder_list:
+            self.fetch_record(builder)
+        seconds_per_byte = self.seconds_per_byte()
+        builder_list.sort(key=lambda builder:
+                          -self.estimate(builder, seconds_per_byte))
+
+    def record(self, builder, seconds):
+        path, name = self.fetch_key(builder)
+        self.fetch_folder(path)[name] = {
+            'seconds': round(seconds, 4), 'size': self.source_size(builder)}
+        self.changed.add(path)
+
+    def save(self):
+        for path in self.changed:
+            if os.path.isdir(path):
+                store_json_file(self.history_file(path), self.folders[path])
+        self.changed = set()
+
+    def print_report(self, job_times, wall_time, job_count):
+        '''
+        print_report says how long the compiles took against the best any
+        schedule could have done. The objects don't depend on one another,
+        so the critical path is just the slowest single file; with fewer
+        CPUs than that allows for, the floor is the total work spread
+        evenly over every job instead.
+        '''
+        if not job_times or wall_time <= 0:
+            return
+        slowest_builder, slowest_time = max(job_times,
+                                            key=lambda item: item[1])
+        total_time = sum(seconds for builder, seconds in job_times)
+        best_time = max(slowest_time, total_time / job_count)
+        print "Compiled %d files in %.2f s on %d jobs; critical path %.2f s " \
+              "(%s), best possible %.2f s (%d%% efficient)" % (
+              len(job_times), wall_time, job_count, slowest_time,
+              os.path.basename(slowest_builder.fetch_out_file()), best_time,
+              round(best_time / wall_time * 100))
@@ -0,0 +1,125 @@
+#!/bin/python
+import os
+import os.path
+import shutil
+
+from Cache_Store import hash_file, hash_string, make_temp_file, replace_file
+
+class Core_Cache:
+    ''' Core_Cache keeps finished core archives (core.a) outside of any
+    sketch folder, so every sketch built for the same board, and every build
+    after the build folder has been wiped, can link against an archive that's
+    already there instead of compiling the whole core again.
+
+    An archive is filed under a key made from:
+        - the board name
+        - the expanded c, cpp and S recipes the core is compiled with, which
+          carry every flag and include path that goes into the objects
+        - the contents of every file in the core and variant folders
+    If any of those changes, so does the key, and the core gets built (and
+    published here) afresh. Archives are written under a temporary name and
+    renamed into place, so a build linking against one never sees half of
+    it. Only the max_entries most recently used archives are kept.
+    '''
+    def __init__(self, cache_path, max_entries=64):
+        self.cache_path = cache_path
+        self.max_entries = max_entries
+        # Folder fingerprints we've already worked out this run; a matrix
+        #  build asks about the same core over and over.
+        self.tree_hashes = {}
+
+        self.hits = 0
+        self.misses = 0
+
+    def fingerprint_tree(self, path):
+        '''
+        fingerprint_tree returns a hash of the name and contents of every
+        file under path. hash_file() remembers files it has already read, so
+        asking about the same tree twice in one run is cheap.
+        '''
+        if path in self.tree_hashes:
+            return self.tree_hashes[path]
+        file_list = []
+        for dir_path, dir_names, file_names in os.walk(path):
+            dir_names.sort()
+            for file_name in sorted(file_names):
+                full_name = os.path.join(dir_path, file_name)
+                file_list.append(os.path.relpath(full_name, path) + "=" +
+                                 str(hash_file(full_name)))
+        tree_hash = hash_string("\n".join(file_list))
+        self.tree_hashes[path] = tree_hash
+        return tree_hash
+
+    def forget_trees(self):
+        # For when files may have changed since we fingerprinted their
+        #  folders; see Build_Matrix.rebuild().
+        self.tree_hashes.clear()
+
+    def make_key(self, board, recipe_key, tree_list):
+        return hash_string("\0".join([board, recipe_key] +
+                [path + "=" + self.fingerprint_tree(path)
+                 for path in tree_list]))
+
+    def archive_file(self, key):
+        return self.cache_path + "/" + key + ".a"
+
+    def fetch(self, key):
+        '''
+        fetch returns the cached archive filed under key, or None if there
+        isn't one.
+        '''
+        cached_archive = self.archive_file(key)
+        try:
+            # Touching the archive is how we keep track of which ones have
+            #  been used recently; see trim().
+            os.utime(cached_archive, None)
+        except OSError:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return cached_archive
+
+    def store(self, key, archive_file):
+        '''
+        store publishes archive_file under key, unless there's already an
+        archive there, and returns the cached copy's name (or None if it
+        couldn't be stored).
+        '''
+        cached_archive = self.archive_file(key)
+        if os.path.exists(cached_archive):
+            return cached_archive
+        temp_name = make_temp_file(cached_archive)
+        try:
+            shutil.copyfile(archive_file, temp_name)
+            replace_file(temp_name, cached_archive)
+        except (IOError, OSError):
+            if os.path.exists(temp_name):
+                os.remove(temp_name)
+            return None
+        self.trim()
+        return cached_archive
+
+    def trim(self):
+        # Throw out the least recently used archives until we're back down to
+        #  max_entries. Returns how many we threw out.
+        try:
+            name_list = [name for name in os.listdir(self.cache_path)
+                         if name.endswith(".a")]
+        except OSError:
+            return 0
+        archive_list = []
+        for name in name_list:
+            try:
+                archive_list.append((os.stat(self.cache_path + "/" +
+                                             name).st_mtime, name))
+            except OSError:
+                pass
+        archive_list.sort(reverse=True)
+        removed = 0
+        for mtime, name in archive_list[self.max_entries:]:
+            try:
+                os.remove(self.cache_path + "/" + name)
+                removed += 1
+            except OSError:
+                pass
+        return removed
@@ -0,0 +1,186 @@
+#!/bin/python
+import os
+import os.path
+import errno
+import select
+import struct
+import time
+
+# On Linux, inotify tells us the moment a file changes, without us having to
+#  look at anything. We get at it through ctypes, so there's nothing extra
+#  to install; anywhere it isn't available, File_Watcher falls back to
+#  walking the folders and comparing mtimes every so often.
+try:
+    import ctypes
+    import ctypes.util
+    _libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6',
+                        use_errno=True)
+    _inotify_init = _libc.inotify_init
+    _inotify_add_watch = _libc.inotify_add_watch
+    _inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p,
+                                   ctypes.c_uint32]
+except (ImportError, OSError, AttributeError):
+    _inotify_init = None
+
+# The inotify events we care about: a file written and closed, changed,
+#  created, deleted or renamed, and the same for folders.
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_ISDIR = 0x40000000
+Watch_mask = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | \
+             IN_MOVED_TO | IN_CREATE | IN_DELETE
+
+class File_Watcher:
+    ''' File_Watcher watches every file in a list of folders, and all of
+    their subfolders, and hands back the names of the files that changed.
+    Anything under one of the ignore_paths (our build folders, say, which we
+    write to ourselves) is left out.
+
+    wait() blocks until something changes. Editors tend to save a file in
+    several steps (write a temporary file, rename it, fix up its
+    attributes), so once the first change comes in, we keep gathering
+    changes until things have been quiet for settle_time seconds, and hand
+    them all back at once.
+    '''
+    def __init__(self, path_list, ignore_paths=(), poll_interval=0.5,
+                 settle_time=0.1):
+        self.path_list = [path for path in path_list if os.path.isdir(path)]
+        self.ignore_paths = [os.path.normpath(path) for path in ignore_paths]
+        self.poll_interval = poll_interval
+        self.settle_time = settle_time
+
+        self.inotify_fd = None
+        if _inotify_init:
+            fd = _inotify_init()
+            if fd >= 0:
+                self.inotify_fd = fd
+                self.watches = {}
+                for path in self.path_list:
+                    self.add_watches(path)
+        if self.inotify_fd is None:
+            self.snapshot = self.take_snapshot()
+
+    def fetch_mode(self):
+        if self.inotify_fd is None:
+            return "polling"
+        return "inotify"
+
+    def is_ignored(self, path):
+        path = os.path.normpath(path)
+        for ignore_path in self.ignore_paths:
+            if path == ignore_path or \
+               path.startswith(ignore_path + os.sep):
+                return True
+        return False
+
+    def add_watches(self, base_path):
+        for dir_path, dir_names, file_names in os.walk(base_path):
+            if self.is_ignored(dir_path):
+                dir_names[:] = []
+                continue
+            wd = _inotify_add_watch(self.inotify_fd, dir_path, Watch_mask)
+            if wd >= 0:
+                self.watches[wd] = dir_path
+
+    def take_snapshot(self):
+        # For polling: the mtime and size of every file we're watching.
+        snapshot = {}
+        for base_path in self.path_list:
+            for dir_path, dir_names, file_names in os.walk(base_path):
+                if self.is_ignored(dir_path):
+                    dir_names[:] = []
+                    continue
+                for file_name in file_names:
+                    full_name = os.path.join(dir_path, file_name)
+                    try:
+                        file_stat = os.stat(full_name)
+                    except OSError:
+                        continue
+                    snapshot[full_name] = (file_stat.st_mtime,
+                                           file_stat.st_size)
+        return snapshot
+
+    def poll(self, timeout):
+        '''
+        poll returns the set of files that changed within timeout seconds
+        (or right away, if any already have), which may be empty.
+        '''
+        if self.inotify_fd is not None:
+            return self.read_events(timeout)
+
+        time.sleep(timeout)
+        snapshot = self.take_snapshot()
+        changed = set(name for name in snapshot
+                      if self.snapshot.get(name) != snapshot[name])
+        changed.update(name for name in self.snapshot
+                       if name not in snapshot)
+        self.snapshot = snapshot
+        return changed
+
+    def read_events(self, timeout):
+        changed = set()
+        try:
+            ready = select.select([self.inotify_fd], [], [], timeout)[0]
+        except select.error as e:
+            if e.args[0] == errno.EINTR:
+                return changed
+            raise
+        if not ready:
+            return changed
+
+        data = os.read(self.inotify_fd, 65536)
+        offset = 0
+        while offset + 16 <= len(data):
+            wd, mask, cookie, name_length = struct.unpack_from("iIII", data,
+                                                               offset)
+            name = data[offset + 16:offset + 16 + name_length].rstrip("\0")
+            offset += 16 + name_length
+
+            if mask & IN_Q_OVERFLOW:
+                # We missed some events; the best we can do is say that
+                #  everything might have changed.
+                changed.update(self.path_list)
+                continue
+            dir_path = self.watches.get(wd)
+            if dir_path is None or not name:
+                continue
+            full_name = os.path.join(dir_path, name)
+            if self.is_ignored(full_name):
+                continue
+            if mask & IN_ISDIR:
+                # A new folder (a library just unpacked, say) needs watching,
+                #  and anything already in it counts as changed.
+                if mask & (IN_CREATE | IN_MOVED_TO):
+                    self.add_watches(full_name)
+                    for sub_path, dir_names, file_names in \
+                            os.walk(full_name):
+                        changed.update(os.path.join(sub_path, file_name)
+                                       for file_name in file_names)
+                continue
+            changed.add(full_name)
+        return changed
+
+    def wait(self):
+        '''
+        wait blocks until at least one file changes, then returns the set of
+        all the files that changed, as full paths.
+        '''
+        changed = set()
+        while not changed:
+            changed = self.poll(self.poll_interval)
+        while True:
+            more_changes = self.poll(self.settle_time)
+            if not more_changes:
+                return changed
+            changed.update(more_changes)
+
+    def close(self):
+        if self.inotify_fd is not None:
+            os.close(self.inotify_fd)
+            self.inotify_fd = None
@@ -0,0 +1,246 @@
+#!/bin/python
+import subprocess
+import threading
+import multiprocessing
+import sys
+import time
+from time import sleep
+
+import Build_Trace
+
+
+def detect_job_count():
+    '''
+    detect_job_count() returns the number of jobs we should run at once if the
+    user didn't tell us. One per CPU is what make -j and friends settle on, so
+    we do the same. If Python can't figure out how many CPUs we have, we play
+    it safe and run one job at a time.
+    '''
+    try:
+        return multiprocessing.cpu_count()
+    except NotImplementedError:
+        return 1
+
+
+def check_call_with_retry(cmd, attempts=6, delay=0.05, target=None):
+    '''
+    check_call_with_retry() is subprocess.check_call() for commands that can
+    fail for reasons that go away if you wait a moment. The one we know about
+    is the archiver on Windows: antivirus programs like to snuffle around a
+    freshly written archive file, and while they hold it open, the next
+    gcc-ar on it fails. Rather than sleeping after every single call, we only
+    wait when a call actually fails, and we wait a little longer each time.
+    '''
+    for attempt in range(attempts):
+        try:
+            return Build_Trace.check_call(cmd, target=target)
+        except subprocess.CalledProcessError:
+            if attempt == attempts - 1:
+                raise
+            with Build_Trace.phase("Waiting to retry", cmd=cmd[0],
+                                   target=target):
+                sleep(delay)
+            delay *= 2
+
+
+def fetch_target_name(builder_item):
+    # The target a job belongs to, for the build trace; see Cmd_Builder.
+    return getattr(builder_item, 'target_name', None)
+
+
+class Job_Pool:
+    ''' Job_Pool runs the commands held by a list of builder objects (anything
+    with a fetch_cmd() method, like Obj_Builder) on a pool of worker threads.
+    Each worker spawns one compiler process at a time, so the number of
+    workers caps the number of compiles running at once. The output of each
+    job is captured and printed in one piece when the job finishes, so the
+    warnings from two files never get shuffled together. The first job to
+    fail stops the whole pool: nothing new gets started, everything still
+    running gets killed, and run() raises the CalledProcessError for it.
+
+    With keep_going set (like make -k), a failed job doesn't stop anything
+    else; the pool carries on with the rest, and run() hands back the items
+    that failed. That's what we want when building a pile of unrelated
+    targets at once: one broken sketch shouldn't cost us the other 39.
+
+    A job that fails but has a fallback (see Unity_Builder) doesn't count
+    as failed: its output is dropped, and the builders it hands back go to
+    the front of the queue in its place.
+
+    Given a Compile_History, the pool starts the jobs it expects to take
+    longest first. Either way, job_times ends up holding how long each job
+    that succeeded took, and wall_time how long the whole run took.
+    '''
+    def __init__(self, max_jobs=None, keep_going=False, history=None):
+        if not max_jobs or max_jobs < 1:
+            max_jobs = detect_job_count()
+        self.max_jobs = max_jobs
+        self.keep_going = keep_going
+        self.history = history
+        self.job_times = []
+        self.wall_time = 0
+
+        # Only one thread at a time gets to touch the job queue, the list of
+        # running processes, or stdout.
+        self.lock = threading.Lock()
+
+    def run(self, builder_list):
+        '''
+        run() builds every item in builder_list that has a command to run and
+        returns once they've all finished. Items whose fetch_cmd() returns
+        None are already up to date and are skipped. It returns the list of
+        items that failed, which is always empty unless keep_going is set.
+        '''
+        self.pending = []
+        for item in builder_list:
+            if item.fetch_cmd():
+                self.pending.append(item)
+            else:
+                Build_Trace.record_skipped(item, fetch_target_name(item))
+        self.running = []
+        self.failure = None
+        self.failed_items = []
+        self.job_times = []
+        self.wall_time = 0
+
+        if self.pending == []:
+            return self.failed_items
+        if self.history:
+            self.history.sort_jobs(self.pending)
+
+        start_time = time.time()
+
+        self.workers = []
+        with self.lock:
+            self._add_workers()
+
+        # Thread.join() with no timeout blocks Ctrl-C in Python 2, so we poll
+        # instead. If the user does hit Ctrl-C, treat it like a failed job so
+        # the compilers we spawned don't outlive us. A fallback can add
+        # workers while we wait; the loop picks those up as well.
+        try:
+            for worker in self.workers:
+                while worker.is_alive():
+                    worker.join(0.1)
+        except KeyboardInterrupt:
+            self._stop_all(KeyboardInterrupt())
+            for worker in self.workers:
+                worker.join()
+        self.wall_time = time.time() - start_time
+
+        if self.failure:
+            raise self.failure
+        return self.failed_items
+
+    def _add_workers(self):
+        # Starts enough workers to take on every pending job, up to max_jobs
+        #  of them at once. Called with the lock held.
+        alive_count = len([worker for worker in self.workers
+                           if worker.is_alive()])
+        for i in range(min(self.max_jobs - alive_count, len(self.pending))):
+            worker = threading.Thread(target=self._worker)
+            worker.daemon = True
+            worker.start()
+            self.workers.append(worker)
+
+    def _next_job(self):
+        with self.lock:
+            if self.failure or self.pending == []:
+                return None
+            return self.pending.pop(0)
+
+    def _worker(self):
+        while True:
+            builder_item = self._next_job()
+            if builder_item is None:
+                return
+            builder_cmd = builder_item.fetch_cmd()
+            target_name = fetch_target_name(builder_item)
+            start_time = time.time()
+
+            try:
+                process = subprocess.Popen(builder_cmd,
+                                           stdout=subprocess.PIPE,
+                                           stderr=subprocess.STDOUT)
+            except OSError as e:
+                Build_Trace.record_job(builder_item, builder_cmd, start_time,
+                                       time.time(), None, target_name)
+                # A compiler that isn't there is as failed as one that
+                #  exits with an error, and with keep_going set, gets the
+                #  same treatment.
+                if self.keep_going:
+                    with self.lock:
+                        self.failed_items.append(builder_item)
+                        sys.stdout.write("Failed (couldn't start: %s): %s\n" %
+                                (e, subprocess.list2cmdline(builder_cmd)))
+                    continue
+                self._stop_all(e)
+                return
+
+            with self.lock:
+                # Somebody may have failed while we were spawning; if so, don't
+                # let this one run on unattended.
+                if self.failure:
+                    process.kill()
+                self.running.append(process)
+
+            output = process.communicate()[0]
+            end_time = time.time()
+            Build_Trace.record_job(builder_item, builder_cmd, start_time,
+                                   end_time, process.returncode, target_name)
+
+            fallback_list = None
+            if process.returncode != 0:
+                fallback_list = builder_item.fetch_fallback()
+
+            with self.lock:
+                self.running.remove(process)
+                if fallback_list is not None:
+                    sys.stdout.write("Couldn't build %s in one go; building "
+                                     "its %d files one at a time.\n" %
+                                     (builder_item.fetch_out_file(),
+                                      len(fallback_list)))
+                    fallback_jobs = []
+                    for item in fallback_list:
+                        if item.fetch_cmd():
+                            fallback_jobs.append(item)
+                        else:
+                            Build_Trace.record_skipped(item, target_name)
+                    if not self.failure:
+                        self.pending[0:0] = fallback_jobs
+                        self._add_workers()
+                elif output:
+                    sys.stdout.write(output)
+                if process.returncode == 0:
+                    self.job_times.append((builder_item,
+                                           end_time - start_time))
+
+            if fallback_list is not None:
+                continue
+            if process.returncode != 0:
+                if self.keep_going:
+                    with self.lock:
+                        self.failed_items.append(builder_item)
+                        sys.stdout.write("Failed (exit status %d): %s\n" %
+                                (process.returncode,
+                                 subprocess.list2cmdline(builder_cmd)))
+                    continue
+                self._stop_all(subprocess.CalledProcessError(
+                    process.returncode, builder_cmd))
+                return
+
+            builder_item.build_complete()
+
+    def _stop_all(self, failure):
+        with self.lock:
+            # Only the first failure gets reported; anything after that is
+            # probably just the fallout from us killing the other jobs.
+            if self.failure:
+                return
+            self.failure = failure
+            self.pending = []
+            for process in self.running:
+                try:
+                    process.kill()
+                except OSError:
+                    pass
@@ -0,0 +1,152 @@
+#!/bin/python
+import os
+import os.path
+
+from Cache_Store import hash_file, hash_string, load_json_file, \
+        store_json_file, normalize_paths, denormalize_paths
+from Core_Cache import Core_Cache
+
+class Library_Cache(Core_Cache):
+    ''' Library_Cache keeps each library's compiled archive where every
+    sketch can get at it, so a sketch using the same libraries as one built
+    before only has to compile its own code. It's a Core_Cache underneath
+    (same folder of archives, same trimming), but a library's objects depend
+    on more than its own folder, so archives are found in two steps, the way
+    Object_Cache finds objects:
+
+    1. The board, the library's name, version and folder contents, and the
+       compile recipes (expanded, with the build and sketch folders taken
+       out) are hashed together. That hash names a manifest.
+    2. The manifest lists every set of headers from outside the library that
+       it has been compiled against (the core's, other libraries', even the
+       sketch's own, for libraries that want a config header from there),
+       along with the hash of each one and the archive that came out. If all
+       of the headers in one of those entries still hash the same, and every
+       one of them is still the header the compiler would find first on
+       today's include path, that archive is the one we want.
+
+    The recipes in the key are the ones the core is built with, so only the
+    core's headers are on their include path; which other libraries a
+    sketch happens to use only matters through the headers in step 2. That
+    way, two sketches share a library's archive even if the rest of their
+    libraries differ.
+    '''
+    def __init__(self, cache_path, max_entries=256):
+        Core_Cache.__init__(self, cache_path, max_entries)
+        self.manifest_path = cache_path + "/manifests"
+
+    def make_library_key(self, board, library, recipe_key):
+        return hash_string("\0".join([
+                board, library['name'], library['version'], recipe_key,
+                self.fingerprint_tree(library['path'])]))
+
+    def manifest_file(self, manifest_key):
+        return self.manifest_path + "/" + manifest_key + ".json"
+
+    def fetch_library(self, manifest_key, include_path_list, base_paths):
+        '''
+        fetch_library returns the cached archive for manifest_key that fits
+        include_path_list, and the list of headers outside the library it
+        was built from; or None and None, if there isn't one.
+        '''
+        manifest = load_json_file(self.manifest_file(manifest_key), [])
+        for entry in manifest:
+            header_list = [denormalize_paths(header, base_paths)
+                           for header, header_hash in entry['headers']]
+            if not all(hash_file(header) == header_hash for
+                       header, (name, header_hash) in
+                       zip(header_list, entry['headers'])):
+                continue
+            if not all(is_first_found(header, include_path_list)
+                       for header in header_list):
+                continue
+            cached_archive = self.archive_file(entry['archive'])
+            try:
+                # Touching the archive is how we keep track of which ones
+                #  have been used recently; see trim().
+                os.utime(cached_archive, None)
+            except OSError:
+                continue
+            self.hits += 1
+            return cached_archive, header_list
+        self.misses += 1
+        return None, None
+
+    def store_library(self, manifest_key, library, archive_file,
+                      dependency_list, base_paths):
+        '''
+        store_library publishes archive_file, built from the library's
+        sources and the files in dependency_list, under manifest_key.
+        '''
+        header_list = []
+        for header in sorted(set(dependency_list)):
+            # The library's own files are in the key already.
+            if header.startswith(library['path'] + "/"):
+                continue
+            header_hash = hash_file(header)
+            if header_hash is None:
+                return
+            header_list.append([normalize_paths(header, base_paths),
+                                header_hash])
+
+        archive_key = hash_string(manifest_key + repr(header_list))
+        if not self.store(archive_key, archive_file):
+            return
+
+        # Newest entry first, since it's the likeliest to match next time;
+        #  see Object_Cache.store().
+        manifest_file = self.manifest_file(manifest_key)
+        manifest = load_json_file(manifest_file, [])
+        if manifest and manifest[0]['archive'] == archive_key:
+            return
+        manifest = [entry for entry in manifest
+                    if entry['archive'] != archive_key]
+        manifest.insert(0, {'headers': header_list, 'archive': archive_key})
+        store_json_file(manifest_file, manifest[0:8])
+
+    def trim(self):
+        '''
+        trim throws out the least recently used archives, like
+        Core_Cache.trim(), and then any manifest left without a single
+        archive to point at. A library whose contents, version or board
+        change gets a new manifest, and the old one would otherwise stay
+        around for good.
+        '''
+        removed = Core_Cache.trim(self)
+        if removed == 0:
+            return 0
+        try:
+            name_list = [name for name in os.listdir(self.manifest_path)
+                         if name.endswith(".json")]
+        except OSError:
+            return removed
+        for name in name_list:
+            manifest_file = self.manifest_path + "/" + name
+            manifest = load_json_file(manifest_file, [])
+            if not isinstance(manifest, list):
+                manifest = []
+            if any(os.path.exists(self.archive_file(entry['archive']))
+                   for entry in manifest):
+                continue
+            try:
+                os.remove(manifest_file)
+            except OSError:
+                pass
+        return removed
+
+
+def is_first_found(header, include_path_list):
+    '''
+    is_first_found returns True if header is in one of the folders in
+    include_path_list, and no folder before that one has a file of the same
+    name; that is, if an #include of it would still find this very file.
+    A header in a library that isn't on the list any more, or one that
+    another library now hides, means the archive was built against something
+    other than what we'd build it against today.
+    '''
+    for index, include_path in enumerate(include_path_list):
+        if header.startswith(include_path + "/"):
+            name = header[len(include_path) + 1:]
+            return not any(os.path.isfile(path + "/" + name)
+                           for path in include_path_list[0:index])
+    return False
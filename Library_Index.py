@@ -0,0 +1,180 @@
+#!/bin/python
+import os
+import os.path
+import time
+
+from Cache_Store import load_json_file, store_json_file
+
+class Library_Index:
+    ''' Library_Index maps every header a library exports to the library that
+    exports it, across all of the library folders we know about. It's built
+    once and saved to index_file; after that, only the library folders whose
+    mtimes have changed get looked at again.
+
+    library_roots is the list of folders holding libraries, best first. When
+    two libraries export the same header, the one in the earlier root wins,
+    just like the old search order. Within one root, a library whose folder
+    is named after the header beats one that merely happens to have it.
+
+    Each library is described by a dict:
+        name          - from library.properties, or the folder name
+        version       - from library.properties, or ""
+        path          - the library folder
+        include_path  - the folder to add to the include list, and to build
+                        sources from: src/ for the 1.5 library format, the
+                        library folder itself for the old one
+        headers       - the headers it exports
+        depends       - other libraries it names in library.properties
+    '''
+    # Bump this whenever the shape of a library entry changes.
+    version = 1
+
+    def __init__(self, library_roots, index_file=None):
+        self.library_roots = [root.replace("\\", "/") for root in
+                              library_roots if root]
+        self.index_file = index_file
+
+        index = None
+        if index_file:
+            index = load_json_file(index_file)
+        if not index or index.get('version') != self.version:
+            index = {'version': self.version, 'roots': {}}
+        self.index = index
+
+        self.refresh()
+
+    def refresh(self):
+        '''
+        refresh brings the index up to date with what's on disk and rebuilds
+        the header map. Only library folders that have changed are re-read.
+        '''
+        self.header_map = {}
+        for root in self.library_roots:
+            root_entry = self.refresh_root(root)
+            if root_entry is None:
+                continue
+
+            # Folder-name matches first, so they take precedence over any
+            #  other library in this root that exports the same header.
+            root_header_map = {}
+            for library in root_entry['libraries'].values():
+                folder_header = os.path.basename(library['path']) + ".h"
+                if folder_header in library['headers']:
+                    root_header_map[folder_header] = library
+            for folder_name in sorted(root_entry['libraries']):
+                library = root_entry['libraries'][folder_name]
+                for header in library['headers']:
+                    root_header_map.setdefault(header, library)
+
+            # Earlier roots win over later ones.
+            for header, library in root_header_map.items():
+                self.header_map.setdefault(header, library)
+
+    def refresh_root(self, root):
+        try:
+            root_mtime = os.stat(root).st_mtime
+        except OSError:
+            self.index['roots'].pop(root, None)
+            return None
+
+        old_entry = self.index['roots'].get(root, {'mtime': None,
+                                                   'libraries': {}})
+
+        # If the root hasn't changed, the set of libraries in it hasn't
+        #  either; otherwise, list it again.
+        if old_entry['mtime'] == root_mtime:
+            folder_list = list(old_entry['libraries'])
+        else:
+            folder_list = [name for name in os.listdir(root)
+                           if os.path.isdir(root + "/" + name)]
+
+        libraries = {}
+        for folder_name in folder_list:
+            library = self.refresh_library(root + "/" + folder_name,
+                    old_entry['libraries'].get(folder_name))
+            if library:
+                libraries[folder_name] = library
+
+        root_entry = {'mtime': root_mtime, 'libraries': libraries}
+        if not self.is_settled(root_mtime):
+            # Too fresh to trust next time; see is_settled().
+            root_entry['mtime'] = None
+        self.index['roots'][root] = root_entry
+        return root_entry
+
+    def refresh_library(self, path, old_library):
+        # A library's headers live in its folder (or its src/ folder), and its
+        #  name and version in library.properties. Editing that file doesn't
+        #  touch the folder's mtime, so we check all three.
+        stamp = [self.fetch_mtime(path), self.fetch_mtime(path + "/src"),
+                 self.fetch_mtime(path + "/library.properties")]
+        if stamp[0] is None:
+            return None
+        if old_library and old_library['stamp'] == stamp:
+            return old_library
+
+        properties = read_library_properties(path + "/library.properties")
+        if properties is not None and os.path.isdir(path + "/src"):
+            include_path = path + "/src"
+        else:
+            include_path = path
+        properties = properties or {}
+
+        headers = sorted(name for name in os.listdir(include_path)
+                         if name.endswith(".h"))
+
+        depends = [name.strip() for name in
+                   properties.get('depends', "").split(",") if name.strip()]
+
+        if not all(self.is_settled(mtime) for mtime in stamp if mtime):
+            stamp = None
+        return {'name': properties.get('name', os.path.basename(path)),
+                'version': properties.get('version', ""),
+                'path': path,
+                'include_path': include_path,
+                'headers': headers,
+                'depends': depends,
+                'stamp': stamp}
+
+    def fetch_mtime(self, path):
+        try:
+            return os.stat(path).st_mtime
+        except OSError:
+            return None
+
+    def is_settled(self, mtime):
+        # On filesystems with coarse timestamps, a folder changed in the last
+        #  couple of seconds could change again without its mtime moving, so
+        #  we don't rely on the mtime of anything that recent.
+        return time.time() - mtime > 2
+
+    def resolve(self, header):
+        '''
+        resolve returns the library that exports header (say, "Wire.h"), or
+        None if no library we know of does.
+        '''
+        return self.header_map.get(header)
+
+    def save(self):
+        if self.index_file:
+            store_json_file(self.index_file, self.index)
+
+def read_library_properties(filename):
+    '''
+    read_library_properties returns the name=value pairs in a
+    library.properties file as a dict, or None if there's no such file.
+    '''
+    try:
+        with open(filename) as f:
+            lines = list(f)
+    except IOError:
+        return None
+
+    properties = {}
+    for line in lines:
+        line = line.strip()
+        if not line or line.startswith("#") or "=" not in line:
+            continue
+        name, value = line.split("=", 1)
+        properties[name.strip()] = value.strip()
+    return properties
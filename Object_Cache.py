@@ -0,0 +1,210 @@
+#!/bin/python
+import os
+import os.path
+import shutil
+
+from Cache_Store import hash_file, hash_string, make_temp_file, \
+        replace_file, load_json_file, store_json_file, normalize_paths, \
+        denormalize_paths
+
+class Object_Cache:
+    ''' Object_Cache is a ccache-style store of compiled object files, shared
+    by every sketch and every build directory on this machine. Objects are
+    found in two steps, the same way ccache's "direct mode" does it:
+
+    1. The compile command (with the build directory taken out, so it's the
+       same for every checkout) and the contents of the source file are
+       hashed together. That hash names a manifest.
+    2. The manifest lists every set of headers this source has been compiled
+       against, along with the hash of each header and the object that came
+       out. If all of the headers in one of those entries still hash the
+       same, that object is the one we want, and we copy it into place instead
+       of running the compiler.
+
+    The store (objects and manifests both) is capped at max_size bytes; once
+    it grows past that, the objects that were used least recently are thrown
+    away, along with any manifest left without an object to point at.
+    '''
+    def __init__(self, cache_path, max_size, base_paths=None):
+        self.cache_path = cache_path
+        self.object_path = cache_path + "/objects"
+        self.manifest_path = cache_path + "/manifests"
+        self.stats_file = cache_path + "/stats.json"
+        self.max_size = max_size
+
+        # Any path in base_paths is swapped for a placeholder in everything we
+        #  hash, so two build folders (or two checkouts of the same sketch)
+        #  get to share objects; see normalize_paths().
+        self.base_paths = list(base_paths or [])
+
+        self.hits = 0
+        self.misses = 0
+
+    def manifest_key(self, builder):
+        source_hash = hash_file(builder.fetch_source_file())
+        if source_hash is None:
+            return None
+        return hash_string(normalize_paths(builder.full_cmd,
+                                           self.base_paths) + "\0" +
+                           source_hash)
+
+    def fetch(self, builder):
+        '''
+        fetch() tries to satisfy builder from the cache. If it can, the
+        object, its dependency file, and its recorded command are all put in
+        place, just as if the compiler had run, and we return True.
+        '''
+        manifest_key = self.manifest_key(builder)
+        if manifest_key:
+            manifest = load_json_file(self.manifest_file(manifest_key), [])
+            for entry in manifest:
+                if self.restore(builder, entry):
+                    self.hits += 1
+                    return True
+        self.misses += 1
+        return False
+
+    def restore(self, builder, entry):
+        header_list = []
+        for header, header_hash in entry['headers']:
+            header = denormalize_paths(header, self.base_paths)
+            if hash_file(header) != header_hash:
+                return False
+            header_list.append(header)
+
+        cached_object = self.object_file(entry['object'])
+        try:
+            shutil.copyfile(cached_object, builder.fetch_out_file())
+            # Touching the cached copy is how we keep track of which objects
+            #  have been used recently; see trim().
+            os.utime(cached_object, None)
+        except (IOError, OSError):
+            # Evicted out from under us (or never finished being written).
+            return False
+
+        # The dependency file we write is the one the compiler *would* have
+        #  written, so the next incremental build sees the same thing either
+        #  way.
+        dependency_list = [builder.fetch_source_file()] + header_list
+        with open(builder.dep_file, 'w') as f:
+            f.write(builder.fetch_out_file().replace(' ', '\\ ') + ":")
+            for dependency in dependency_list:
+                f.write(" \\\n " + dependency.replace(' ', '\\ '))
+            f.write("\n")
+        builder.record_cmd()
+        return True
+
+    def store(self, builder):
+        '''
+        store() files away the object builder just finished compiling, along
+        with a manifest entry describing the headers it was compiled against.
+        '''
+        manifest_key = self.manifest_key(builder)
+        dependency_list = builder.fetch_dependencies()
+        if manifest_key is None or dependency_list is None:
+            return
+
+        header_list = []
+        for header in dependency_list:
+            if header == builder.fetch_source_file():
+                continue
+            header_hash = hash_file(header)
+            if header_hash is None:
+                return
+            header_list.append([normalize_paths(header, self.base_paths),
+                                header_hash])
+
+        object_key = hash_string(manifest_key + repr(header_list))
+        cached_object = self.object_file(object_key)
+        if not os.path.exists(cached_object):
+            temp_name = make_temp_file(cached_object)
+            try:
+                shutil.copyfile(builder.fetch_out_file(), temp_name)
+                replace_file(temp_name, cached_object)
+            except (IOError, OSError):
+                if os.path.exists(temp_name):
+                    os.remove(temp_name)
+                return
+
+        # Newest entry first, since it's the likeliest to match next time.
+        #  We don't need to keep every header combination a file has ever
+        #  been built against; a handful covers flipping between branches.
+        manifest_file = self.manifest_file(manifest_key)
+        manifest = load_json_file(manifest_file, [])
+        manifest = [entry for entry in manifest
+                    if entry['object'] != object_key]
+        manifest.insert(0, {'headers': header_list, 'object': object_key})
+        store_json_file(manifest_file, manifest[0:8])
+
+    def manifest_file(self, manifest_key):
+        return self.manifest_path + "/" + manifest_key[0:2] + "/" + \
+               manifest_key[2:] + ".json"
+
+    def object_file(self, object_key):
+        return self.object_path + "/" + object_key[0:2] + "/" + \
+               object_key[2:] + ".o"
+
+    def trim(self):
+        '''
+        trim() throws away the least recently used objects until the store
+        is back under 90% of max_size. We go below the cap, rather than right
+        to it, so we aren't trimming after every single build.
+
+        Manifests count toward the size too. Every edit to a source file, or
+        change to its flags, makes a new one, and the old one stays behind
+        until the last of its objects is thrown away; then it goes as well.
+        '''
+        object_list = []
+        manifest_list = []
+        total_size = 0
+        for file_list, path in [(object_list, self.object_path),
+                                (manifest_list, self.manifest_path)]:
+            for dir_path, dir_names, file_names in os.walk(path):
+                for file_name in file_names:
+                    file_name = os.path.join(dir_path, file_name)
+                    try:
+                        file_stat = os.stat(file_name)
+                    except OSError:
+                        continue
+                    file_list.append((file_stat.st_mtime, file_stat.st_size,
+                                      file_name))
+                    total_size += file_stat.st_size
+
+        if total_size <= self.max_size:
+            return
+
+        object_list.sort()
+        for mtime, size, file_name in object_list:
+            if total_size <= self.max_size * 0.9:
+                break
+            try:
+                os.remove(file_name)
+                total_size -= size
+            except OSError:
+                pass
+
+        for mtime, size, file_name in manifest_list:
+            # A .tmp file is a manifest some other build is still writing.
+            if not file_name.endswith(".json"):
+                continue
+            manifest = load_json_file(file_name, [])
+            if not isinstance(manifest, list):
+                manifest = []
+            if any(os.path.exists(self.object_file(entry['object']))
+                   for entry in manifest):
+                continue
+            try:
+                os.remove(file_name)
+            except OSError:
+                pass
+
+    def update_stats(self):
+        '''
+        update_stats() adds this run's hits and misses to the running totals
+        kept in the cache folder and returns the totals.
+        '''
+        stats = load_json_file(self.stats_file, {})
+        stats['hits'] = stats.get('hits', 0) + self.hits
+        stats['misses'] = stats.get('misses', 0) + self.misses
+        store_json_file(self.stats_file, stats)
+        return stats
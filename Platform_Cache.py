@@ -0,0 +1,55 @@
+#!/bin/python
+import os
+import os.path
+import hashlib
+
+from Cache_Store import load_json_file, store_json_file
+
+class Platform_Cache:
+    ''' Platform_Cache keeps the tables we parse out of boards.txt and
+    platform.txt on disk, so a build that has nothing to compile doesn't have
+    to run every line of those files through a pile of regexes first. Each
+    table is filed under the path of the file it came from (plus whatever
+    else the parse depended on, like the board name), and carries the size,
+    mtime and content hash of that file. If any of those has changed, the
+    table is thrown away and the file parsed afresh.
+
+    Entries are written atomically, so two builds sharing a cache can only
+    ever see a whole entry or no entry; the worst that can happen is that
+    they both parse the file and the second one's entry wins.
+    '''
+    # Bump this whenever the shape of a parsed table changes, so we don't
+    #  load tables written by an older version of the parser.
+    version = 1
+
+    def __init__(self, cache_path):
+        self.cache_path = cache_path
+
+    def fingerprint(self, filename):
+        file_stat = os.stat(filename)
+        with open(filename, 'rb') as f:
+            content_hash = hashlib.sha1(f.read()).hexdigest()
+        return [os.path.abspath(filename), file_stat.st_size,
+                file_stat.st_mtime, content_hash]
+
+    def load(self, filename, kind, parser, extra=""):
+        '''
+        load returns the table for filename, either from the cache or, if
+        the cache doesn't have a current one, by calling parser() and storing
+        what it returns. kind and extra tell apart different tables parsed
+        from the same file.
+        '''
+        fingerprint = self.fingerprint(filename)
+        entry_file = self.cache_path + "/" + hashlib.sha1(
+                "\0".join([fingerprint[0], kind, extra])).hexdigest() + ".json"
+
+        entry = load_json_file(entry_file)
+        if entry and entry.get('version') == self.version and \
+                entry.get('fingerprint') == fingerprint:
+            return entry['table']
+
+        table = parser()
+        store_json_file(entry_file, {'version': self.version,
+                                     'fingerprint': fingerprint,
+                                     'table': table})
+        return table
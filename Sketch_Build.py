@@ -0,0 +1,1034 @@
+#!/bin/python
+import os
+import os.path
+import shutil
+import subprocess
+import time
+from platform import system
+
+import Variable_Loader
+import Sketch_to_Cpp
+import Build_Trace
+from Command_Creator import Obj_Builder, Pch_Builder, Unity_Builder, \
+                            Archive_Builder, forget_mtime
+from Job_Runner import check_call_with_retry
+from Cache_Store import hash_file, hash_string
+from Build_Manifest import Build_Manifest
+from Library_Index import Library_Index
+from Source_Index import source_extensions
+from Unity_Build import group_sources
+
+# This is everything that goes into building one sketch for one board: what
+#  main() used to do start to finish, split up so that a Build_Matrix can run
+#  the compile step for lots of these at once, on one job pool.
+#
+# A build is described by a settings dict:
+#  name                   - what to call this target in messages
+#  sketch_path            - the folder holding the main .ino file
+#  board, board_options   - the board, and the picks from its menus
+#  serial_port            - where to upload to
+#  runtime_platform_path, runtime_ide_path, sketchbook_path,
+#  runtime_ide_version    - same as the settings in Arduino_Builder_Loader
+#  build_path             - where this target's objects and hex file go
+#  core_root              - where the compiled cores go; every target built
+#                           for the same core configuration shares one
+#  precompiled_header     - (optional) True to precompile Arduino.h for the
+#                           sketch and library .cpp files
+#  unity_build            - (optional) how many unity groups to split each
+#                           core and library folder's .c files, and its .cpp
+#                           files, into; 0 (the default) builds every file
+#                           on its own
+#  unity_rules_file       - (optional) which files may go into a unity
+#                           build, per platform; see Unity_Rules
+
+class Platform_Set:
+    ''' Platform_Set hands out the parsed boards.txt, platform.txt and library
+    index for a platform, parsing each one just once however many targets
+    are built against it.
+    '''
+    def __init__(self, Platforms, sketchbook_path, runtime_ide_path,
+                 library_index_file):
+        self.Platforms = Platforms
+        self.sketchbook_path = sketchbook_path
+        self.runtime_ide_path = runtime_ide_path
+        self.library_index_file = library_index_file
+        self.platforms = {}
+
+    def fetch_platform(self, runtime_platform_path):
+        '''
+        fetch_platform returns a dict holding the Boards_Index, the list of
+        platform.txt variables, the Pattern_Manager and the Library_Index for
+        the platform in runtime_platform_path.
+        '''
+        if runtime_platform_path in self.platforms:
+            return self.platforms[runtime_platform_path]
+
+        platform_txt_file = runtime_platform_path + "/platform.txt"
+        boards_txt_file = runtime_platform_path + "/boards.txt"
+        if self.Platforms:
+            variable_list = self.Platforms.load(platform_txt_file,
+                    'variables',
+                    lambda: Variable_Loader.read_variable_file(
+                            platform_txt_file), "")
+        else:
+            variable_list = Variable_Loader.read_variable_file(
+                    platform_txt_file)
+
+        # The library index knows every header exported by every library in
+        #  our library folders, best folder first: the platform's own
+        #  libraries should overtake any other library of the same name, then
+        #  come the sketchbook libraries (this is where the library manager
+        #  puts things), and finally the ones in the IDE folder, which are
+        #  only really reliable for super normal boards released by or cloned
+        #  from Arduino designs. It's saved in the cache folder and only the
+        #  libraries that changed get looked at again.
+        Libraries = Library_Index([runtime_platform_path + "/libraries",
+                                   self.sketchbook_path + "/libraries",
+                                   self.runtime_ide_path + "/libraries"],
+                                  self.library_index_file)
+        Libraries.save()
+
+        platform_info = {
+            'boards': Variable_Loader.Boards_Index(boards_txt_file,
+                                                   self.Platforms),
+            'variables': variable_list,
+            'patterns': Variable_Loader.Pattern_Manager(platform_txt_file,
+                                                        self.Platforms),
+            'libraries': Libraries}
+        self.platforms[runtime_platform_path] = platform_info
+        return platform_info
+
+
+def make_builders(build_path, source_lists, recipes, object_cache,
+                  source_roots=(), pch_builder=None):
+    '''
+    make_builders returns an Obj_Builder for every file in source_lists (as
+    handed back by Source_Index.find_sources()), using the recipe in recipes
+    for its extension.
+
+    The objects are laid out in a tree that mirrors the sources: source_roots
+    is a list of (root, folder) pairs, and a source somewhere under root gets
+    its object in the same place under build_path/folder. That way a
+    library's utility.cpp and another library's utility.cpp (or the core's
+    main.cpp and a sketch's main.cpp) each get an object of their own, and
+    keep it from one build to the next.
+
+    Given a pch_builder (a Pch_Builder), the .cpp files are compiled with
+    its precompiled header.
+    '''
+    # Longest root first, so a root inside another root wins.
+    source_roots = sorted(source_roots, key=lambda item: len(item[0]),
+                          reverse=True)
+    made_paths = set()
+    builder_list = []
+    for extension in source_extensions:
+        for source_file in source_lists.get(extension, []):
+            object_path = fetch_object_path(build_path, source_file,
+                                            source_roots)
+            if object_path not in made_paths:
+                if not os.path.exists(object_path):
+                    os.makedirs(object_path)
+                made_paths.add(object_path)
+            builder_list.append(Obj_Builder(build_path, source_file,
+                                            recipes[extension], object_cache,
+                                            object_path,
+                                            pch_builder if extension == ".cpp"
+                                            else None))
+
+    # At least once, I've seen a recipe in a platforms.txt file that has a
+    #  hardcoded parameter in it which collides with an automatically
+    #  generated parameter. Apparently, the Arduino IDE can cope with this,
+    #  so we must, too.
+    for command in builder_list:
+        command.remove_duplicate_args()
+    return builder_list
+
+def make_unity_builders(build_path, groups, recipes, object_cache,
+                        source_roots=(), pch_builder=None):
+    '''
+    make_unity_builders returns a Unity_Builder for each group that
+    group_sources() came up with. A group's file and object go in a unity
+    folder in the group's folder under build_path. If a group won't compile
+    as one, its files get built one at a time with make_builders(), into the
+    same places they'd have gone without unity builds.
+    '''
+    builder_list = []
+    for folder, extension, index, file_list in groups:
+        unity_path = build_path + "/" + folder + "/unity"
+        unity_file = "%s/unity_%d%s" % (unity_path, index, extension)
+        group_pch_builder = pch_builder if extension == ".cpp" else None
+
+        def make_fallback(extension=extension, file_list=file_list,
+                          group_pch_builder=group_pch_builder):
+            return make_builders(build_path, {extension: file_list}, recipes,
+                                 object_cache, source_roots,
+                                 group_pch_builder)
+        builder_list.append(Unity_Builder(build_path, unity_file, file_list,
+                                          recipes[extension], object_cache,
+                                          unity_path, group_pch_builder,
+                                          make_fallback))
+    for command in builder_list:
+        command.remove_duplicate_args()
+    return builder_list
+
+def fetch_object_path(build_path, source_file, source_roots):
+    # The folder source_file's object goes in; see make_builders().
+    for root, folder in source_roots:
+        if source_file.startswith(root + "/"):
+            sub_path = os.path.dirname(source_file[len(root) + 1:])
+            return "/".join(path for path in [build_path, folder, sub_path]
+                            if path)
+    return build_path
+
+def make_library_roots(library_path_list):
+    '''
+    make_library_roots returns a (root, folder) pair for make_builders() for
+    each library: libraries/<name of the library>. Two libraries of the same
+    name (from different library folders, say) get a bit of a hash of their
+    path tacked on, to tell them apart.
+    '''
+    source_roots = []
+    folders = set()
+    for library_path in library_path_list:
+        # 1.5 libraries keep their sources in src/; the name we want is the
+        #  one above that.
+        name = os.path.basename(library_path)
+        if name == "src":
+            name = os.path.basename(os.path.dirname(library_path))
+        folder = "libraries/" + name
+        if folder in folders:
+            folder += "-" + hash_string(library_path)[0:8]
+        folders.add(folder)
+        source_roots.append((library_path, folder))
+    return source_roots
+
+
+class Core_Build:
+    ''' Core_Build is one compiled core: the core folder and the variant,
+    built with one set of recipes into one folder and packed into core.a.
+    The core only ever sees its own headers, never the sketch's or any
+    library's, so every target with the same board, options and recipes can
+    share it.
+
+    With a Core_Cache, a core that has been built before (by any sketch) is
+    taken straight from there and nothing gets compiled at all; a core we do
+    have to build is published there once its archive is done.
+    '''
+    def __init__(self, key, build_path, builder_list, archive_recipe,
+                 core_cache=None, cache_key=None):
+        self.key = key
+        self.build_path = build_path
+        self.builder_list = builder_list
+        self.archive_recipe = archive_recipe
+        self.archive_file = build_path + "/core.a"
+        self.core_cache = core_cache
+        self.cache_key = cache_key
+        self.from_cache = False
+        self.error = None
+        self.archived = False
+        # The target that set this archive up, for the build trace.
+        self.target_name = None
+
+    def use_cached_archive(self, archive_file):
+        # The cache already has this core, so there's nothing to build; we
+        #  link against the cached archive where it sits.
+        self.archive_file = archive_file
+        self.from_cache = True
+        self.archived = True
+
+    def fetch_archive_list(self):
+        '''
+        fetch_archive_list returns the objects to put in the archive. ar
+        files each object under its bare name, and adding a second object
+        with the same name replaces the first, so any object whose name is
+        already taken goes in as a copy with a name of its own, made from
+        its path.
+        '''
+        names = set()
+        archive_list = []
+        for object_file in fetch_object_list(self.builder_list):
+            name = os.path.basename(object_file)
+            if name in names:
+                name = os.path.relpath(object_file, self.build_path).replace(
+                       "\\", "_").replace("/", "_")
+                alias_file = self.build_path + "/aliases/" + name
+                if not os.path.exists(self.build_path + "/aliases"):
+                    os.makedirs(self.build_path + "/aliases")
+                shutil.copyfile(object_file, alias_file)
+                object_file = alias_file
+            names.add(name)
+            archive_list.append(object_file)
+        return archive_list
+
+    def make_archive(self):
+        '''
+        make_archive brings core.a up to date. We must put all core object
+        files into an archive file; we can't just directly link the files
+        because the line length of all the object files would be way too long
+        for most operating systems to manage.
+        '''
+        if self.archived:
+            return
+        self.archived = True
+
+        # If any core object changed, or the list of objects did, we start
+        #  the archive over from scratch, so objects whose source has gone
+        #  away don't linger in it. The list we archived last time is kept
+        #  next to the archive. Archive_Builder packs the objects into as few
+        #  archiver calls as the command line length allows, so that's only
+        #  a handful of calls even for a big core.
+        archive_list = self.fetch_archive_list()
+        list_file = self.archive_file + ".list"
+        try:
+            with open(list_file) as f:
+                old_archive_list = f.read().splitlines()
+        except IOError:
+            old_archive_list = None
+        core_archive_valid = archive_list == old_archive_list and \
+                not any(builder.is_updated() for builder in self.builder_list)
+        if not core_archive_valid or not os.path.exists(self.archive_file):
+            if os.path.exists(self.archive_file):
+                os.remove(self.archive_file)
+            Archiver = Archive_Builder(self.archive_recipe, archive_list)
+            for ar_cmd in Archiver.fetch_cmd_list():
+                check_call_with_retry(ar_cmd, target=self.target_name)
+            with open(list_file, 'w') as f:
+                f.write("".join(name + "\n" for name in archive_list))
+
+        # Whether we just built it or it was already sitting here, make sure
+        #  the next build of this core can find it.
+        self.publish()
+
+    def publish(self):
+        if self.core_cache:
+            self.core_cache.store(self.cache_key, self.archive_file)
+
+
+class Library_Build(Core_Build):
+    ''' Library_Build is one library, as used by one target: its objects,
+    compiled in the target's build folder, packed into an archive of their
+    own (libraries/<name>.a), and shared through a Library_Cache. A library
+    that some earlier build compiled against the same headers is linked
+    straight from the cache, and none of its files get compiled at all.
+
+    The archive is linked with --whole-archive, so every object in it goes
+    into the elf file, just as if we'd listed them one by one. Normally the
+    linker only takes an object out of an archive if something else needs a
+    symbol from it, and a file that's only there for its interrupt handler
+    or its static constructor would quietly go missing.
+    '''
+    def __init__(self, library, target_build_path, object_path,
+                 builder_list, archive_recipe, library_cache, cache_key,
+                 base_paths):
+        Core_Build.__init__(self, cache_key, object_path, builder_list,
+                            archive_recipe, library_cache, cache_key)
+        self.library = library
+        self.archive_file = object_path + ".a"
+        self.target_build_path = target_build_path
+        self.base_paths = base_paths
+        # For a cached archive, the headers from outside the library it was
+        #  built from; see Sketch_Build.refresh().
+        self.header_set = set()
+
+    def make_archive(self):
+        # Unlike a core, which only ever gets archived once, a library is
+        #  archived before every link of its target, since in watch mode its
+        #  objects can change from one link to the next.
+        if not self.from_cache:
+            self.archived = False
+        Core_Build.make_archive(self)
+
+    def publish(self):
+        # The cache needs to know every header the objects were compiled
+        #  against. The generated files in the build folder (a unity file,
+        #  or the stand-in for a precompiled header) only ever #include
+        #  files that are on that list already.
+        dependency_list = []
+        for builder in self.builder_list:
+            for item in builder.fallback_list or [builder]:
+                item_dependencies = item.fetch_dependencies()
+                if item_dependencies is None:
+                    return
+                dependency_list.extend(item_dependencies)
+        self.core_cache.store_library(self.cache_key, self.library,
+                self.archive_file,
+                [dependency for dependency in dependency_list if not
+                 dependency.startswith(self.target_build_path + "/")],
+                self.base_paths)
+
+    def fetch_link_list(self):
+        return ["-Wl,--whole-archive", self.archive_file,
+                "-Wl,--no-whole-archive"]
+
+
+class Sketch_Build:
+    ''' Sketch_Build takes one sketch for one board from its .ino files to a
+    hex file (and, if asked, onto the board). prepare() does all the thinking
+    and leaves the compile jobs in builder_list; somebody else runs those,
+    and then link() and upload() finish the job.
+    '''
+    def __init__(self, settings, label=None):
+        self.settings = settings
+        self.name = settings['name']
+        self.sketch_path = settings['sketch_path']
+        self.build_path = settings['build_path']
+        # In a matrix build, every message gets the target's name on it, so
+        #  we can tell who said what.
+        self.label = label
+
+        self.core = None
+        self.builder_list = []
+        self.sketch_builder_list = []
+        self.libraries = []
+        self.error = None
+        self.current_phase = None
+        self.Manifest = None
+        self.pch_builder = None
+
+    def log(self, message):
+        if self.label:
+            print "[" + self.label + "] " + message
+        else:
+            print message
+
+    def step(self, message, phase_name):
+        # Each step of the build prints its banner and starts a new phase in
+        #  the build trace, ending the one before it.
+        self.end_step()
+        self.log(message)
+        self.current_phase = Build_Trace.begin_phase(phase_name,
+                                                     target=self.name)
+
+    def end_step(self):
+        if self.current_phase:
+            Build_Trace.end_phase(self.current_phase)
+            self.current_phase = None
+
+    def prepare(self, platform_set, Sources, cores, make_object_cache,
+                core_cache=None, unity_rules=None, library_cache=None):
+        '''
+        prepare works out every command needed to build this target. The
+        core it needs is looked up in (or added to) the cores dict, keyed by
+        its configuration, so targets that can share a core do, and then in
+        core_cache (a Core_Cache), if we have one.
+        make_object_cache(base_paths) returns the Object_Cache to use for
+        objects built under base_paths, or None. unity_rules (a Unity_Rules)
+        says which files may go into unity builds, if they're turned on.
+        With library_cache (a Library_Cache), each library is built into an
+        archive of its own, shared with other sketches through the cache.
+        '''
+        settings = self.settings
+        sketch_path = self.sketch_path
+        build_path = self.build_path
+        board = settings['board']
+        runtime_platform_path = settings['runtime_platform_path']
+
+        # We'll need the sketch name, at times, to do stuff, and we can
+        #  identify that from the sketch path.
+        sketch_name = os.path.basename(sketch_path) + ".ino"
+        build_system_path = runtime_platform_path + "/system"
+
+        # We may need to create a folder to store all of our temporary files
+        #  in. We don't want to pollute our sketch folder with that crap.
+        for path in [sketch_path + "/build", build_path]:
+            if not os.path.exists(path):
+                os.makedirs(path)
+
+        self.step("Retrieving variables from platform.txt and boards.txt...",
+                  "Parsing platform files")
+
+        # We need to retrieve from the boards.txt and platform.txt files a
+        #  bunch of information. They contain all we need to know to build
+        #  and upload our sketch.
+        platform_info = platform_set.fetch_platform(runtime_platform_path)
+        Variables = Variable_Loader.Variable_Manager(
+                cache=platform_set.Platforms)
+        Variables.load_variables(platform_info['boards'].resolve(board,
+                settings['board_options']).items(), 'boards')
+        Variables.load_variables(platform_info['variables'], 'platform')
+        Patterns = platform_info['patterns']
+        self.Variables = Variables
+        self.Patterns = Patterns
+
+        self.step("Initializing variables...", "Initializing variables")
+
+        # These are things that are normally provided by the IDE.
+        Variables.add_variable(["serial.port", settings['serial_port']])
+        build_variant_path = runtime_platform_path + "/variants/" + board
+        Variables.add_variable(["runtime.ide.path",
+                                settings['runtime_ide_path']])
+        Variables.add_variable(["runtime.platform.path",
+                                runtime_platform_path])
+        Variables.add_variable(["build.path", build_path])
+        Variables.add_variable(["build.project_name",
+                                sketch_name[0:-4] + R'.cpp'])
+        Variables.add_variable(["build.variant.path", build_variant_path])
+        Variables.add_variable(["build.system.path", build_system_path])
+        Variables.add_variable(["software", "ARDUINO"])
+        Variables.add_variable(["runtime.ide.version",
+                                settings['runtime_ide_version']])
+
+        build_includes_path = runtime_platform_path + "/cores/" + \
+                Variables.fetch_variable("build.core")
+        Variables.add_variable(["build.includes.path", build_includes_path])
+        Variables.add_variable(["archive_file", "core.a"])
+
+        self.step("Converting .ino files to .cpp...", "Converting sketch")
+
+        # Here's the part where we convert the .ino files into a .cpp file.
+        #  We concatenate the ino files, magic up some function declarations,
+        #  and then return a list of likely library includes (according to
+        #  Arduino standards). Note that library includes are expected to all
+        #  be above everything that is not a comment or preproc statement;
+        #  that's kinda dumb but it *does* make turning a #include into a path
+        #  to find a library easier.
+        Sketch_Info = Sketch_to_Cpp.Sketch(sketch_path + "/" + sketch_name)
+        library_includes = Sketch_Info.fetch_include_file_list()
+        self.library_includes = library_includes
+
+        self.step("Assembling include file path list...", "Finding libraries")
+
+        # Now, we don't *know* that these are all actually libraries; the
+        #  only way we can find out is to look and see if they exist as
+        #  #include files in the sketch folder.
+        Libraries = platform_info['libraries']
+        library_path_list = []
+        library_info_map = {}
+        for library in library_includes:
+            # Of course, no library is likely to have a subdirectory in its
+            #  include; we can discard anything that does.
+            if "/" not in library:
+                # If we don't find it in the sketch path, we expect to find it
+                #  in one of our library paths.
+                if not os.path.exists(sketch_path + "/" + library + ".h"):
+                    library_info = Libraries.resolve(library + ".h")
+                    if library_info and \
+                       library_info['include_path'] not in library_path_list:
+                        library_path_list.append(library_info['include_path'])
+                        library_info_map[library_info['include_path']] = \
+                                library_info
+
+        core_path_list = [build_includes_path, build_variant_path]
+        include_path_list = library_path_list + core_path_list + [sketch_path]
+        self.library_path_list = library_path_list
+
+        self.step("Creating build commands...", "Setting up the core")
+
+        # The core gets built first, with nothing but its own headers on the
+        #  include path, the way the IDE does it. That, and the recipes it's
+        #  built with, is everything the core objects depend on, so it's also
+        #  how we tell whether some other target has already asked for this
+        #  very same core.
+        Variables.add_variable(["includes", make_includes(core_path_list)])
+        core_recipes = self.compile_recipes()
+        core_archive_pattern = Patterns.fetch_pattern('recipe.ar.pattern')
+        key_recipes = [core_recipes[extension] for extension in
+                       sorted(core_recipes)]
+        key_recipes.append(Variables.compile_recipe(core_archive_pattern))
+        key_text = repr([subprocess.list2cmdline(recipe.argv)
+                         for recipe in key_recipes if recipe])
+        # The build folder shows up in the archive recipe, at least, and is
+        #  different for every target, so it can't be part of the key.
+        core_key = hash_string(key_text.replace(build_path, "{build.path}"))
+        # Unity builds don't come into it, either: the core does the same
+        #  thing whether its files were compiled one by one or in groups, so
+        #  a core built one way does for targets that asked for the other.
+
+        # Finding sources is timed, and the directories listed and reused
+        #  counted, for this target alone; Sources is shared by all of them.
+        discovery_time = 0.0
+        listed_before = Sources.listed
+        reused_before = Sources.reused
+
+        self.core = cores.get(core_key)
+        cache_key = None
+        cached_archive = None
+        if self.core is None and core_cache:
+            cache_key = core_cache.make_key(board, core_key, core_path_list)
+            cached_archive = core_cache.fetch(cache_key)
+        core_build_path = settings['core_root'] + "/" + core_key[0:16]
+        if self.core is None and cached_archive:
+            self.log("Using the cached core archive")
+            self.core = Core_Build(core_key, core_build_path, [], None)
+            # If we built this very archive here ourselves, keep linking
+            #  against our own copy; a new path in the link command would
+            #  mean linking (and uploading) again for nothing.
+            local_archive = core_build_path + "/core.a"
+            if hash_file(local_archive) == hash_file(cached_archive):
+                cached_archive = local_archive
+            self.core.use_cached_archive(cached_archive)
+            cores[core_key] = self.core
+        elif self.core is None:
+            if not os.path.exists(core_build_path):
+                os.makedirs(core_build_path)
+            Variables.add_variable(["build.path", core_build_path])
+            core_recipes = self.compile_recipes()
+            discovery_start = time.time()
+            core_sources = Sources.find_sources(build_includes_path)
+            variant_sources = Sources.find_sources(build_variant_path)
+            discovery_time += time.time() - discovery_start
+            for extension, file_list in variant_sources.items():
+                core_sources[extension].extend(file_list)
+            core_roots = [(build_includes_path, "core"),
+                          (build_variant_path, "variant")]
+            core_object_cache = make_object_cache([core_build_path])
+            core_sources, core_groups = self.group_sources(core_sources,
+                    core_roots, unity_rules)
+            core_builder_list = make_unity_builders(core_build_path,
+                    core_groups, core_recipes, core_object_cache,
+                    core_roots) + \
+                make_builders(core_build_path, core_sources, core_recipes,
+                              core_object_cache, core_roots)
+            self.core = Core_Build(core_key, core_build_path,
+                                   core_builder_list,
+                                   Variables.compile_recipe(
+                                       core_archive_pattern),
+                                   core_cache, cache_key)
+            # A core shared by several targets shows up in the build trace
+            #  under the one that set it up.
+            self.core.target_name = self.name
+            for builder in core_builder_list:
+                builder.target_name = self.name
+            cores[core_key] = self.core
+            Variables.add_variable(["build.path", build_path])
+
+        # include_path_list has a nice list of paths, but gcc doesn't *want*
+        #  a list of paths; see make_includes().
+        Variables.add_variable(["includes", make_includes(include_path_list)])
+
+        # We now know everything we need to build our sketch into a hex file.
+        #  Each recipe gets expanded and split into an argument list just
+        #  once, here; every Obj_Builder then only has to drop its own source
+        #  and object file names into the template.
+        recipes = self.compile_recipes()
+
+        self.step("Aggregating source file list...", "Finding sources")
+
+        # Here's the crappy part: we have to identify *all* the various files
+        #  that must be built into object files. There are *so many* places
+        #  they could be: in the sketch folder or the build subdirectory
+        #  thereof, in any of the library folders we included, in the
+        #  appropriate core directory, maybe even the variants subfolder or
+        #  any of its subfolders! The core we dealt with above; the rest are
+        #  built into this target's own build folder and linked in directly.
+        #  The folders inside sketch_path/build are ours, though, and the
+        #  sources we generate in there (the unity files) aren't the
+        #  sketch's; the .cpp made from the .ino files is right in
+        #  sketch_path/build itself.
+        source_lists = dict((extension, []) for extension in
+                            source_extensions)
+        generated_path = sketch_path + "/build/"
+        discovery_start = time.time()
+        for path in library_path_list + [sketch_path]:
+            for extension, file_list in Sources.find_sources(path).items():
+                source_lists[extension].extend(source_file
+                        for source_file in file_list
+                        if not source_file.startswith(generated_path) or
+                        "/" not in source_file[len(generated_path):])
+        discovery_time += time.time() - discovery_start
+        self.log("Found %d source files in %.3f s (%d directories listed, "
+                 "%d unchanged); %d in the core" %
+                 (sum(len(file_list) for file_list in source_lists.values()),
+                  discovery_time, Sources.listed - listed_before,
+                  Sources.reused - reused_before,
+                  sum(len(builder.fetch_source_list())
+                      for builder in self.core.builder_list)))
+
+        # Every .cpp file of the sketch and its libraries starts by reading
+        #  Arduino.h and the pile of core headers behind it. Asked to, we
+        #  compile that once, with the same flags, and let them all share it.
+        self.pch_builder = None
+        arduino_h = build_includes_path + "/Arduino.h"
+        if settings.get('precompiled_header') and os.path.isfile(arduino_h):
+            self.pch_builder = Pch_Builder(build_path, arduino_h,
+                                           recipes['.cpp'])
+            self.pch_builder.target_name = self.name
+
+        # Objects that some other build has already compiled with exactly
+        #  the same command, source, and headers can just be copied out of
+        #  the cache.
+        self.step("Checking for out of date objects...", "Checking objects")
+        # The sketch's own .cpp file is made in sketch_path/build, so that
+        #  counts as the top of the sketch, too. Only the libraries get unity
+        #  builds; the sketch is what we're editing, and we'd rather
+        #  recompile just the file that changed.
+        library_roots = make_library_roots(library_path_list)
+        source_roots = library_roots + [(sketch_path, "sketch"),
+                                        (sketch_path + "/build", "sketch")]
+        base_paths = [build_path, sketch_path]
+        object_cache = make_object_cache(base_paths)
+
+        # With a library cache, each library gets an archive of its own (see
+        #  Library_Build). One that's in the cache, built against the same
+        #  headers we'd build it against, doesn't get compiled at all. Its
+        #  key uses the recipes the core is built with, which have nothing
+        #  on the include path but the core; core_key is their hash.
+        self.libraries = []
+        built_libraries = []
+        for root, folder in library_roots:
+            if not library_cache:
+                break
+            library_info = library_info_map[root]
+            library_key = library_cache.make_library_key(board, library_info,
+                                                         core_key)
+            Library = Library_Build(library_info, build_path,
+                                    build_path + "/" + folder, [], None,
+                                    library_cache, library_key, base_paths)
+            Library.target_name = self.name
+            self.libraries.append(Library)
+            cached_archive, header_list = library_cache.fetch_library(
+                    library_key, include_path_list, base_paths)
+            if cached_archive:
+                # Same as the core: if it's the very archive we built here
+                #  last time, keep linking against our own copy.
+                if hash_file(Library.archive_file) == \
+                   hash_file(cached_archive):
+                    cached_archive = Library.archive_file
+                Library.use_cached_archive(cached_archive)
+                Library.header_set = set(normalize_path(header)
+                                         for header in header_list)
+                for extension, file_list in source_lists.items():
+                    source_lists[extension] = [source_file for source_file
+                            in file_list if not
+                            source_file.startswith(root + "/")]
+            else:
+                Variables.add_variable(["archive_file", folder + ".a"])
+                Library.archive_recipe = Variables.compile_recipe(
+                        core_archive_pattern)
+                built_libraries.append((root, Library))
+        if self.libraries:
+            self.log("Using cached archives for %d of %d libraries" %
+                     (len(self.libraries) - len(built_libraries),
+                      len(self.libraries)))
+
+        source_lists, library_groups = self.group_sources(source_lists,
+                library_roots, unity_rules)
+        self.builder_list = make_unity_builders(build_path, library_groups,
+                recipes, object_cache, source_roots, self.pch_builder) + \
+            make_builders(build_path, source_lists, recipes, object_cache,
+                          source_roots, self.pch_builder)
+        self.source_set = set(normalize_path(source_file)
+                              for builder in self.builder_list
+                              for source_file in builder.fetch_source_list())
+        for builder in self.builder_list:
+            builder.target_name = self.name
+
+        # Every builder is either one of the libraries' or the sketch's own.
+        self.sketch_builder_list = []
+        for builder in self.builder_list:
+            source_file = builder.fetch_source_list()[0]
+            for root, Library in built_libraries:
+                if source_file.startswith(root + "/"):
+                    Library.builder_list.append(builder)
+                    break
+            else:
+                self.sketch_builder_list.append(builder)
+
+        # The link recipe looks for the archive in the build folder, so point
+        #  it at the shared core from there.
+        try:
+            archive_file = os.path.relpath(self.core.archive_file, build_path)
+        except ValueError:
+            # The core is on another drive (Windows), so there's no relative
+            #  path to it; link() copies it over instead.
+            archive_file = "core.a"
+        Variables.add_variable(["archive_file", archive_file])
+        self.end_step()
+
+    def group_sources(self, source_lists, source_roots, unity_rules):
+        # With unity builds turned on, this takes the files under
+        #  source_roots out of source_lists and into unity groups; see
+        #  group_sources() in Unity_Build.
+        group_count = self.settings.get('unity_build', 0)
+        if not group_count or unity_rules is None:
+            return source_lists, []
+        is_allowed = unity_rules.make_filter(
+                self.settings.get('unity_rules_file'),
+                self.settings['runtime_platform_path'])
+        return group_sources(source_lists, source_roots, group_count,
+                             is_allowed)
+
+    def fetch_watch_paths(self):
+        # The folders whose files go into this target, apart from the core:
+        #  the sketch and the libraries it uses.
+        return self.library_path_list + [self.sketch_path]
+
+    def refresh(self, changed_files):
+        '''
+        refresh is for watch mode: given the set of files that changed (as
+        normalize_path() names), it works out which of this target's objects
+        need building now, and returns their builders. We hang on to every
+        builder, and the dependency list each one got from the compiler last
+        time, so this only has to look at the objects that use one of the
+        changed files. It returns None if the change is one that needs
+        prepare() again: a source file that's come or gone, or a change to
+        the libraries the sketch includes.
+        '''
+        # A unity group that had to be built a file at a time last build
+        #  won't be grouped again; that takes a fresh prepare(). So does a
+        #  change to a header that a cached library archive was built
+        #  against, since we'll have to build that library after all.
+        if any(builder.fallback_list is not None
+               for builder in self.builder_list):
+            return None
+        if any(changed_file in Library.header_set
+               for Library in self.libraries
+               for changed_file in changed_files):
+            return None
+
+        sketch_path = normalize_path(self.sketch_path)
+        for changed_file in changed_files:
+            if os.path.splitext(changed_file)[1] in source_extensions and \
+               (changed_file in self.source_set) != \
+               os.path.exists(changed_file):
+                return None
+            if os.path.basename(changed_file) == "library.properties":
+                return None
+
+        if any(changed_file.endswith(".ino") and
+               os.path.dirname(changed_file) == sketch_path
+               for changed_file in changed_files):
+            sketch_name = os.path.basename(self.sketch_path) + ".ino"
+            Sketch_Info = Sketch_to_Cpp.Sketch(self.sketch_path + "/" +
+                                               sketch_name)
+            if Sketch_Info.fetch_include_file_list() != self.library_includes:
+                return None
+            # The .cpp we made from the .ino files may or may not have
+            #  changed; the object's own mtime check will tell.
+            changed_files = changed_files | set([normalize_path(
+                    self.sketch_path + "/build/" + sketch_name[0:-3] +
+                    "cpp")])
+
+        # The precompiled header goes first, since the objects' dependency
+        #  lists include its own. Build_Matrix.build() builds it if need be.
+        builder_list = self.builder_list
+        if self.pch_builder:
+            builder_list = [self.pch_builder] + builder_list
+
+        update_list = []
+        for builder in builder_list:
+            dependency_list = builder.fetch_dependencies() or []
+            if normalize_path(builder.fetch_source_file()) in \
+               changed_files or any(normalize_path(dependency) in \
+               changed_files for dependency in dependency_list):
+                # The mtimes we looked up last time are stale now.
+                for dependency in dependency_list:
+                    forget_mtime(dependency)
+                forget_mtime(builder.fetch_source_file())
+                forget_mtime(builder.fetch_out_file())
+                builder.refresh()
+                if builder.is_updated() and builder is not self.pch_builder:
+                    update_list.append(builder)
+        return update_list
+
+    def compile_recipes(self):
+        # compile_recipe() hands back None for a pattern that doesn't exist,
+        #  so we'll know not to build on it.
+        Variables = self.Variables
+        Patterns = self.Patterns
+        s_build_recipe = Variables.compile_recipe(
+                Patterns.fetch_pattern("recipe.S.o.pattern"))
+        return {'.c': Variables.compile_recipe(
+                    Patterns.fetch_pattern("recipe.c.o.pattern")),
+                '.cpp': Variables.compile_recipe(
+                    Patterns.fetch_pattern("recipe.cpp.o.pattern")),
+                '.s': s_build_recipe,
+                '.S': s_build_recipe}
+
+    def fetch_all_builders(self):
+        return self.core.builder_list + self.builder_list
+
+    def link(self):
+        '''
+        link turns the objects and the core archive into the hex file. Either
+        step is skipped if the build manifest shows nothing it reads has
+        changed since it last ran.
+        '''
+        # Only copy the core archive if it's different; a fresh copy would
+        #  have a fresh mtime, and that alone would make us hash it.
+        if self.Variables.fetch_variable("archive_file") == "core.a" and \
+           self.core.archive_file != self.build_path + "/core.a" and \
+           hash_file(self.core.archive_file) != \
+           hash_file(self.build_path + "/core.a"):
+            shutil.copyfile(self.core.archive_file,
+                            self.build_path + "/core.a")
+
+        # Each library's objects go into its own archive, which the cache
+        #  gets a copy of for the next sketch that uses it.
+        if self.libraries:
+            self.step("Placing library files into archives...",
+                      "Archiving libraries")
+            for Library in self.libraries:
+                Library.make_archive()
+
+        Manifest = Build_Manifest(self.build_path + "/build_manifest.json")
+        self.Manifest = Manifest
+
+        self.step("Linking files...", "Linking")
+
+        # Time to link. By and large, the recipe contains most of the stuff
+        #  that needs to get linked, either in the form of pre-built archive
+        #  files, the core archive, or something else. However, any object
+        #  files created from the sketch and its libraries won't be on the
+        #  list, so we drop the object_file_list into the {object_files} slot
+        #  in the link recipe, one argument per object. We only make the list
+        #  now, since a unity group that fell back to one object per file
+        #  has changed its mind about which objects it made.
+        self.object_file_list = fetch_object_list(self.sketch_builder_list)
+        for Library in self.libraries:
+            self.object_file_list.extend(Library.fetch_link_list())
+        link_recipe = self.Variables.compile_recipe(
+                      self.Patterns.fetch_pattern('recipe.c.combine.pattern'),
+                      ('object_files',))
+        if not Manifest.run("link", link_recipe.fill({'object_files':
+                                                      self.object_file_list}),
+                            lambda cmd: Build_Trace.check_call(cmd, "link",
+                                                               self.name)):
+            self.log("Nothing to link; the elf file is up to date.")
+
+        self.step("Creating hex file...", "Creating hex file")
+
+        hex_recipe = self.Variables.compile_recipe(
+                     self.Patterns.fetch_pattern('recipe.objcopy.hex.pattern'),
+                     ())
+        if not Manifest.run("objcopy", hex_recipe.fill({}),
+                            lambda cmd: Build_Trace.check_call(cmd, "objcopy",
+                                                               self.name)):
+            self.log("The hex file is up to date.")
+        Manifest.save()
+        self.end_step()
+
+    def fetch_firmware_hash(self):
+        '''
+        fetch_firmware_hash returns a hash of the files objcopy made the
+        last time we linked (the hex file, on most platforms), or None if we
+        don't know what they are.
+        '''
+        if self.Manifest is None:
+            return None
+        output_list = self.Manifest.fetch_outputs("objcopy")
+        hash_list = sorted(hash_file(filename) for filename in output_list)
+        if not hash_list or None in hash_list:
+            return None
+        return hash_string("\n".join(hash_list))
+
+    def fetch_board_id(self):
+        settings = self.settings
+        return "%s:%s:%s" % (settings['runtime_platform_path'],
+                             settings['board'],
+                             ",".join("%s=%s" % item for item in
+                                      sorted(settings['board_options'].items())))
+
+    def fetch_upload_recipe(self):
+        '''
+        fetch_upload_recipe returns the upload tool's pattern, expanded, with
+        {serial.port} (and {serial.port.file}, the port's bare name, which
+        some tools want) left as slots, so the same recipe can be filled in
+        for any number of ports.
+        '''
+        Variables = self.Variables
+        upload_tool_var_name = "upload.tool"
+        upload_tool_name = Variables.fetch_variable(upload_tool_var_name)
+        upload_tool_prefix = "tools." + upload_tool_name
+        system_os = system().lower()
+
+        # Like the IDE, we make every tools.<tool>.something variable
+        #  available to the upload pattern as plain {something}: {path},
+        #  {cmd}, {config.path}, {upload.params.verbose} and the rest.
+        for name, value in Variables.fetch_variable_list():
+            if name.startswith(upload_tool_prefix + "."):
+                Variables.add_variable([name[len(upload_tool_prefix) + 1:],
+                                        value])
+
+        script_name = ""
+        cmd_name = ""
+
+        if "windows" in system_os:
+            script_name = Variables.fetch_variable(upload_tool_prefix
+                                                   + ".script.windows")
+            cmd_name = Variables.fetch_variable(upload_tool_prefix +
+                                                ".cmd.windows")
+        elif "mac" in system_os:
+            script_name = Variables.fetch_variable(upload_tool_prefix
+                                                   + ".script")
+            cmd_name = Variables.fetch_variable(upload_tool_prefix +
+                                                ".cmd.macosx")
+        elif "linux" in system_os:
+            script_name = Variables.fetch_variable(upload_tool_prefix
+                                                   + ".script")
+            cmd_name = Variables.fetch_variable(upload_tool_prefix +
+                                                ".cmd.linux")
+
+        # The OS-specific names win, but a tool that only has a plain cmd
+        #  keeps it.
+        if cmd_name:
+            Variables.add_variable(["cmd", cmd_name])
+        if script_name:
+            Variables.add_variable(["script", script_name])
+        upload_tool_pattern_name = "tools." + upload_tool_name + \
+                                   ".upload.pattern"
+        upload_tool_pattern = self.Patterns.fetch_pattern(
+                upload_tool_pattern_name)
+        return Variables.compile_recipe(upload_tool_pattern,
+                                        ('serial.port', 'serial.port.file'))
+
+    def fetch_upload_cmd(self, upload_recipe, port):
+        upload_tool_cmd = upload_recipe.fill({
+                'serial.port': port,
+                'serial.port.file': os.path.basename(port)})
+        if system().lower() == "windows":
+            upload_tool_cmd = ["cmd", "/c"] + upload_tool_cmd
+        return upload_tool_cmd
+
+    def upload(self, upload_record=None, force=False):
+        '''
+        upload flashes the hex file onto the board. Given an Upload_Record,
+        it skips the upload if the board on this port already has this exact
+        firmware, unless force is set.
+        '''
+        self.step("Uploading...", "Uploading")
+        port = self.settings['serial_port']
+        firmware_hash = self.fetch_firmware_hash()
+        board_id = self.fetch_board_id()
+        if upload_record and not force and \
+           upload_record.is_current(port, firmware_hash, board_id):
+            self.log("The board on " + port + " already has this firmware; "
+                     "skipping the upload.")
+            self.end_step()
+            return
+
+        upload_tool_cmd = self.fetch_upload_cmd(self.fetch_upload_recipe(),
+                                                port)
+        try:
+            if upload_record:
+                upload_record.forget(port)
+            Build_Trace.check_call(upload_tool_cmd, "upload", self.name)
+            if upload_record:
+                upload_record.remember(port, firmware_hash, board_id,
+                                       self.name)
+        finally:
+            self.end_step()
+
+def fetch_object_list(builder_list):
+    # Every object builder_list made, in order.
+    return [object_file for builder in builder_list
+            for object_file in builder.fetch_object_list()]
+
+def make_includes(include_path_list):
+    # gcc doesn't *want* a list of paths. It wants each path formatted like
+    #  this:
+    #  -I"/path/to/include/files"
+    #  That's a problem, because Python is going to want to strip out those
+    #  quotes when printing those strings. So, we make a string, with escaped
+    #  quotation marks (to protect against the shell stripping them away) and
+    #  store THAT as the includes variable instead.
+    includes = ""
+    for path in include_path_list:
+        includes = includes + R'\"-I' + path + R'\" '
+    return includes
+
+def normalize_path(path):
+    # Paths reach us spelled all sorts of ways (from the compiler's
+    #  dependency files, from the file watcher, from our own settings), so
+    #  before we compare two, we tidy them up the same way.
+    return os.path.normcase(os.path.normpath(path))
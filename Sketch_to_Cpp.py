@@ -2,6 +2,267 @@
 import re
 import os
 import sys
+import hashlib
+
+from Cache_Store import load_json_file, store_json_file
+
+# We do need to find SOME #include statements and keep the file name, as those
+#  represent directories that we'll need to search for library files later.
+#  Arduino only expects those to be on lines that are right at the top of the
+#  file, so we can limit our search range by that fact.
+Include_re = \
+    re.compile('^\s*#include\s*(<|")(?P<include_name>[\w/-]*)\.h("|>)')
+
+# These are the only things in a sketch that the declarator scanner needs to
+#  stop and look at; everything in between is just code, which we either
+#  keep (outside of any braces) or skip right over (inside them). Comments,
+#  string and character literals, and preprocessor lines are matched whole,
+#  so a brace or semicolon inside one of them can't throw off our count.
+#  One regex does the lot, so the whole scan is a single pass over the text
+#  that never looks at the same character twice.
+Token_re = re.compile(
+    r'(?P<comment>//[^\n]*|/\*.*?(?:\*/|\Z))'
+    r'|(?P<string>R"(?P<delimiter>[^()\\\s"]{0,16})\(.*?\)(?P=delimiter)"'
+    r'|"(?:\\.|[^"\\\n])*"|' + r"'(?:\\.|[^'\\\n])*')"
+    r'|(?P<preprocessor>^[ \t]*#(?:\\\r?\n|[^\n])*)'
+    r'|(?P<punctuation>[{};])',
+    re.S | re.M)
+
+# A declarator is done once we reach its closing paren; after that, all that
+#  can follow are qualifiers like const or noexcept.
+Declarator_tail_re = re.compile(r'^[\w\s]*$')
+
+# The name of the function is the identifier right before the parameter list,
+#  or an operator, for the odd sketch that overloads one.
+Function_name_re = re.compile(
+    r'(?P<name>\boperator\s*[^\w\s(]+|[A-Za-z_]\w*)\s*$')
+
+# The pieces of a parameter list that matter when we're looking for default
+#  arguments: literals (whole, so nothing inside them counts), brackets of
+#  every kind, commas, and equals signs. Comparisons and arrows are matched
+#  whole too, so their = and > aren't mistaken for anything else.
+Parameter_token_re = re.compile(
+    r'"(?:\\.|[^"\\])*"|' + r"'(?:\\.|[^'\\])*'"
+    r'|->|<<|[=!<>]=|[(){}\[\]<>,=]')
+
+# Top-level statements starting with these open braces that aren't function
+#  bodies.
+Not_a_function_words = set(['struct', 'class', 'union', 'enum', 'namespace',
+                            'typedef', 'extern'])
+
+# Declarators are cached between builds (see Sketch); bump this whenever
+#  scan_declarators() changes what it finds, so old results get thrown away.
+scanner_version = 4
+
+# scan_declarators() takes a list of lines of sketch code and returns a list of
+#  the function declarators in it (everything but the semicolon), so we can
+#  write prototypes for them into the generated .cpp file.
+def scan_declarators(cpp_file):
+    return scan_functions(cpp_file)[0]
+
+# scan_functions() does the actual scanning for scan_declarators(). It also
+#  returns the line number (counting from 0) of the first function definition
+#  in cpp_file, or None if there isn't one. That's where the prototypes go,
+#  like the IDE puts them: below the includes, and below any struct or enum
+#  the sketch declares before its first function, since the prototypes may
+#  well use those types, but above any code that might call a function the
+#  sketch defines further down.
+def scan_functions(cpp_file):
+
+    # First, let's try to describe what a function
+    # declarator looks like. Broadly, it looks like this:
+    #
+    # return_type function_name(type0 arg0, type1 arg1, ..., typen argn)
+    #
+    # HOWEVER, there are *exceptions* to this. For instance, the return
+    # type could be a pointer. Putting a space between the function name
+    # and the first paren is valid. The brace could be on this line, or the
+    # next, or several lines later. A newline can be inserted in the
+    # declarator, with or without comments. So many options! We could even
+    # have a function *pointer*!!!! I *am* going to make an assumption,
+    # here: the programmer should be following some kind of decent style
+    # and not doing two things: 
+    # 1. Putting comments (or anything other than whitespace) before the
+    #    declarator; 
+    # 2. Returning anything other than a value or a pointer. No references!
+    #
+    # So, where does that leave us? Well, there are three basic elements we
+    # need to discover: return type, function name, and parameters. The
+    # return type may or may not be in parens, but *must* be a valid C++
+    # identifier, meaning it must start with an underscore or alpha and can
+    # only contain alphas, underscores, and numbers. After the return type,
+    # there may or may not be white space, may or may not be stars, and may
+    # or may not be a close paren. Then, there may or may not be whitespace
+    # (there MUST be whitespace if there are no parens or stars), and the
+    # function name (which also must be a valid C++ identifier) can be in
+    # parens, and may be preceded by whitespace and one or more stars.
+    # Lastly we come to the parameters, a paren-enclosed group of comma
+    # separated items, each of which must have at least some white space in
+    # it.  Ugh.  Let's take it in pieces. It's easier to say something
+    # *isn't* a declarator than that it is. For instance, no line ending in
+    # a semicolon is a declarator, or starting with a left brace, or with a
+    # comment identifier, or having a # at the beginning, or *within* a
+    # comment block.
+
+    #
+    # The way we tell is this: we walk through the code, keeping track of how
+    # deep in braces we are. Anything outside of all braces is kept, up until
+    # a semicolon (which means it was a declaration or a statement, not a
+    # function) or an open brace. When we reach an open brace, what we've
+    # kept since the last semicolon or close brace is whatever the brace
+    # belongs to, and if that looks like a function declarator, it is one.
+    text = "".join(cpp_file)
+
+    declarator_list = []
+    braces_stack = 0
+    statement = []
+    # Where the first bit of actual code in statement starts.
+    statement_start = None
+    first_function = None
+    position = 0
+
+    for token in Token_re.finditer(text):
+        if braces_stack == 0:
+            code = text[position:token.start()]
+            statement.append(code)
+            if statement_start is None and code.strip():
+                statement_start = position + len(code) - len(code.lstrip())
+        position = token.end()
+
+        kind = token.lastgroup
+        if kind == 'string':
+            # Strings can show up in a declarator as default arguments, so we
+            #  keep them.
+            if braces_stack == 0:
+                statement.append(token.group())
+                if statement_start is None:
+                    statement_start = token.start()
+        elif kind != 'punctuation':
+            # A comment or preprocessor line is as good as whitespace.
+            if braces_stack == 0:
+                statement.append(" ")
+        elif token.group() == "{":
+            if braces_stack == 0:
+                statement_text = "".join(statement)
+                declarator = make_declarator(statement_text)
+                if declarator:
+                    declarator_list.append(declarator)
+                # Anything with a body that can call a function counts as
+                #  the first function, even if it's one we can't write a
+                #  prototype for, like ISR(TIMER1_vect) or a class's method.
+                if first_function is None and statement_start is not None \
+                   and (declarator or is_function_body(statement_text)):
+                    first_function = text.count("\n", 0, statement_start)
+                statement = []
+                statement_start = None
+            braces_stack += 1
+        elif token.group() == "}":
+            if braces_stack > 0:
+                braces_stack -= 1
+            statement = []
+            statement_start = None
+        elif braces_stack == 0:
+            # A semicolon, outside of any function.
+            statement = []
+            statement_start = None
+
+    return declarator_list, first_function
+
+def is_function_body(statement):
+    # is_function_body() tells whether the braces after statement hold code,
+    #  rather than the members of a struct or the values of an array.
+    words = statement.split()
+    return ")" in statement and bool(words) and \
+        words[0].split("<", 1)[0] not in Not_a_function_words
+
+def make_declarator(statement):
+    # make_declarator() returns statement, tidied up, if it's a function
+    #  declarator, or None if it isn't.
+    declarator = " ".join(statement.split())
+    if not declarator.endswith(")") and \
+       not Declarator_tail_re.match(declarator[declarator.rfind(")") + 1:]):
+        return None
+    if ")" not in declarator or declarator.split(" ", 1)[0].split("<", 1)[0] \
+            in Not_a_function_words:
+        return None
+
+    # Find the paren that opens the parameter list: the match for the last
+    #  close paren.
+    close_paren = declarator.rfind(")")
+    depth = 0
+    open_paren = None
+    for index in range(close_paren, -1, -1):
+        if declarator[index] == ")":
+            depth += 1
+        elif declarator[index] == "(":
+            depth -= 1
+            if depth == 0:
+                open_paren = index
+                break
+    if open_paren is None:
+        return None
+
+    # There has to be a name before the parameter list, and a return type
+    #  before that. No return type means it's something like a macro call
+    #  (ISR(TIMER1_vect), say), and a name with a :: in front of it belongs
+    #  to a class, so we can't declare it out here.
+    prefix = declarator[0:open_paren]
+    name_match = Function_name_re.search(prefix)
+    if name_match is None:
+        return None
+    return_type = prefix[0:name_match.start()].strip()
+    if return_type == "" or return_type.endswith("::"):
+        return None
+
+    # An = outside the parameter list means this is a variable being
+    #  initialized (with a lambda, say), not a function. Operators are the
+    #  exception: operator== has every right to be there.
+    if "=" in return_type:
+        return None
+
+    # Default arguments belong in the first declaration only, and that's
+    #  our prototype, so they come out of the definition's copy. The
+    #  compiler won't have them twice.
+    return declarator[0:open_paren + 1] + \
+        strip_default_arguments(declarator[open_paren + 1:close_paren]) + \
+        declarator[close_paren:]
+
+def strip_default_arguments(parameters):
+    # strip_default_arguments() returns a parameter list with the "= value"
+    #  taken off of every parameter that has one. Only an = outside of any
+    #  brackets starts a default argument; one inside parens, braces or
+    #  template brackets (int (*f)(int) = NULL, Pair<A, B> p = Pair<A, B>())
+    #  belongs to something else, and so does a comma.
+    kept = []
+    depth = 0
+    angle_depth = 0
+    position = 0
+    default_start = None
+    for token in Parameter_token_re.finditer(parameters):
+        text = token.group()
+        if text in "([{":
+            depth += 1
+        elif text in ")]}":
+            depth -= 1
+        elif text == "<":
+            angle_depth += 1
+        elif text == ">":
+            # Outside of a template, > is just greater-than.
+            if angle_depth > 0:
+                angle_depth -= 1
+        elif depth == 0 and angle_depth == 0:
+            if text == "=" and default_start is None:
+                default_start = token.start()
+            elif text == ",":
+                if default_start is not None:
+                    kept.append(parameters[position:default_start].rstrip())
+                    position = token.start()
+                    default_start = None
+    if default_start is not None:
+        kept.append(parameters[position:default_start].rstrip())
+    else:
+        kept.append(parameters[position:])
+    return "".join(kept)
 
 
 class Sketch:
@@ -27,266 +288,125 @@ class Sketch:
         path_only = os.path.dirname(sketch_file)
         sketch_name = os.path.basename(sketch_file)
 
-        # Make a list out of the lines in the main .ino file. This makes
-        #  inserting and removing stuff easier along the way. The reason for
-        #  doing this here, separately, is because we want the sketch name ino
-        #  to be the first, and then the rest to be concatenated in
-        #  alphabetical order.
-        with open(sketch_file) as f:
-            cpp_file = list(f)
-            
-
-        # We want to snoop through the main directory and look at all the files
-        #  present. If the file is a .ino file, we want to cat the contents
-        #  onto the list we started above. If the file is a CPP file, we can
-        #  ignore it; we'll deal with those later in the process.
-        for code_file in os.listdir(path_only):
+        # We want the sketch name ino to be the first, and then the rest to be
+        #  concatenated in alphabetical order. While we're snooping through
+        #  the directory, we note any .cpp files; we'll deal with those later
+        #  in the process.
+        ino_file_list = [sketch_name]
+        for code_file in sorted(os.listdir(path_only)):
             if code_file.endswith(".ino"):
                 # Make sure we don't grab the main ino file again. Remember, 
                 #  we need to put that one at the top, then the others after
                 #  it, in alphabetical order, or things may get wonky.
-                if code_file not in sketch_name:
-                    with open(path_only + "/" + code_file) as f:
-                        cpp_file.extend(list(f))
+                if code_file != sketch_name:
+                    ino_file_list.append(code_file)
             elif code_file.endswith(".cpp"):
                 self.cpp_file_list.append(code_file)
 
-        # At this point, cpp_file contains all the sketch files concatenated
-        # into one file. We need to do a couple of things to make this ready to
-        # compile: adding in #include<Arduino.h> and scan the file to find all
-        # function definitions so we can construct declarations for them.
-
-        # First, let's try to describe what a function
-        # declarator looks like. Broadly, it looks like this:
-        #
-        # return_type function_name(type0 arg0, type1 arg1, ..., typen argn)
-        #
-        # HOWEVER, there are *exceptions* to this. For instance, the return
-        # type could be a pointer. Putting a space between the function name
-        # and the first paren is valid. The brace could be on this line, or the
-        # next, or several lines later. A newline can be inserted in the
-        # declarator, with or without comments. So many options! We could even
-        # have a function *pointer*!!!! I *am* going to make an assumption,
-        # here: the programmer should be following some kind of decent style
-        # and not doing two things: 
-        # 1. Putting comments (or anything other than whitespace) before the
-        #    declarator; 
-        # 2. Returning anything other than a value or a pointer. No references!
-        #
-        # So, where does that leave us? Well, there are three basic elements we
-        # need to discover: return type, function name, and parameters. The
-        # return type may or may not be in parens, but *must* be a valid C++
-        # identifier, meaning it must start with an underscore or alpha and can
-        # only contain alphas, underscores, and numbers. After the return type,
-        # there may or may not be white space, may or may not be stars, and may
-        # or may not be a close paren. Then, there may or may not be whitespace
-        # (there MUST be whitespace if there are no parens or stars), and the
-        # function name (which also must be a valid C++ identifier) can be in
-        # parens, and may be preceded by whitespace and one or more stars.
-        # Lastly we come to the parameters, a paren-enclosed group of comma
-        # separated items, each of which must have at least some white space in
-        # it.  Ugh.  Let's take it in pieces. It's easier to say something
-        # *isn't* a declarator than that it is. For instance, no line ending in
-        # a semicolon is a declarator, or starting with a left brace, or with a
-        # comment identifier, or having a # at the beginning, or *within* a
-        # comment block.
-
-        # This lets us track whether we're in a multi-line comment or not.
-        in_comment = False
-
-        # It's useful to know how deep we are into a parenthesis nesting. 
-        # ( causes an increment, ) causes a decrement.
-        parens_stack = 0
-        braces_stack = 0
-
-        # These regular expressions are helpful in telling what kind of line
-        # you are looking at.
-
-        # Any line with any amount of whitespace followed by either // or by /*
-        # ... */ with nothing after the close block comment could be stripped
-        # out. Maybe not?
-        Comment_Line_re = re.compile('^\s*(//.*|/\*.*\*/$)')
-        
-        # Any pure whitespace line can be ignored.
-        Whitespace_Line_re = re.compile('^\s*$')
-
-        # /* on a line without */ means you've opened a block comment.
-        Comment_Opener_re = re.compile('.*/\*.*(?!\*/)')
-        # */ on a line means a block comment was closed, there.
-        Comment_Closer_re = re.compile('.*\*/')
-
-        # if we have seen a { without a corresponding }, we aren't seeing a
-        # declarator, as we're currently IN a function.
-        Brace_Open_re = re.compile('.*(?<!//).*\{')
-        Brace_Close_re = re.compile('^\s*\}')
-        Nonleading_Brace_Open_re = re.compile('\S+\s*\{')
-        Nonleading_Brace_Close_re = re.compile('(\S+\s*\})|(^\s*\})')
-
-        # Obviously, any line with a leading sharp is a preprocessor directive
-        # and can be ignored. I'm not even going to try to cope with preproc
-        # conditionals. That's just too much. It does mean, though, that we
-        # may generate an unnecessary function prototype for a function that
-        # gets eliminated by the preprocessor. Oh well.
-        Preprocessor_re = re.compile('^\s*#')
-
-        # HOWEVER! We do need to find SOME #include statements and keep the file
-        # name, as those represent directories that we'll need to search for 
-        # library files later. Arduino only expects those to be on lines that are
-        # right at the top of the file, so we can limit our search range by that
-        # fact. We'll also make sure the files names aren't located in the sketch
-        # directory.
-        Include_re = \
-            re.compile('^\s*#include\s*(<|")(?P<include_name>[\w/-]*)\.h("|>)')
-
-        # If a line has a semicolon at the end, but no open brace, we can skip
-        # it.
-        Semicolon_no_open_brace_re = re.compile('^\s*\{*[^}].*;')
-
-        # We'll want to strip out any unclosed block comments, any one-line
-        #  comments, everything up to a block comment close,  and any fully 
-        #  closed block comments. Here are regexes for doing just that.
-        Comment_strip_re = \
-        re.compile('(/\*.*\*/)|(/\*.*$)|(//.*$)|(/\*.*$)|(^.*\*/)')
-
-        # We'll want to strip off any rogue open braces, too.
-        Open_brace_strip_re = re.compile('\s*\{.*')
-
-        # RegEx to discover parens. All we need to do is make sure all opens
-        # have a close with them.
-        Open_paren_re = re.compile('\(')
-        Close_paren_re = re.compile('\)')
-
-        # That's all that we can easily detect; once we've chewed through all
-        #  these, we shouldn't have much that *can't* be glued together to form
-        #  a declarator.
-        declarator_line_list = []
-
-        # We'll iterate over the file, saving nothing but stuff that we can't
-        #  rule out as possibly being part of a declarator.
-        for line in cpp_file:
-
-            # This line is nothing but comments; don't save it.
-            if Comment_Line_re.search(line) != None:
-                continue
-
-            # This line is a preprocessor statement; don't save it.
-            if Preprocessor_re.search(line) != None:
-                continue
-
-            # This line is whitespace only. Skip it.
-            if Whitespace_Line_re.search(line) != None:
-                continue
-
-            # This line is *in* a comment block. Check to see if the comment is
-            # closed on this line, and if not, don't save it.
-            if in_comment:
-                if Comment_Closer_re.search(line) != None:
-                    in_comment = False
-                else:
-                    continue
-
-            # This line opens a comment, but doesn't close it. Mark that.
-            if Comment_Opener_re.search(line) != None:
-                in_comment = True
-
-            # This line *closes* a comment. Mark it.
-            if Comment_Closer_re.search(line) != None:
-                in_comment = False
-
-            # This line opens braces; mark that.
-            if Brace_Open_re.search(line) != None:
-                braces_stack += 1
-
-            # This line closes braces; mark that.
-            if Brace_Close_re.search(line) != None:
-                braces_stack -= 1
-
-            # Now, if we are inside a brace set, what do we do?
-            if braces_stack > 0:
-                if (Brace_Open_re.search(line)) != None:
-                    if braces_stack > 1:
-                        continue
-                else:
-                    continue
-
-            # IF we reach this point, we can make several suppositions about 
-            #  this line of code.
-            # 1. It's not in a function.
-            # 2. It's not in a comment block.
-            # 3. It's not a comment.
-            # 4. It's not a preprocessor directive.
-
-            # Okay, what can we winnow out now? Well, anything that has a 
-            #  semicolon at the end of the line, but not an open brace, is 
-            #  probably not a declarator.
-            if Semicolon_no_open_brace_re.search(line) != None:
-                continue
-
-            # The current line should be a declarator, but *could* have some
-            # cruft left in it.
-            # Things that may be removed from the string at this point: any
-            #  fully closed comment, any open comment that isn't closed before
-            #  the end of the line, any one-line comment, and anything up to a
-            #  close block comment.
-            line = Comment_strip_re.sub('', line)
-
-            # At this point, we should be 100% declarators or subsections
-            #  thereof. 
-            declarator_line_list.append(line.strip())
-
-        ##### End of file parsing.
-
-        # Join the whole thing up. We've eliminated everything but each
-        # function's declarator and its open and close braces.
-        declarator_string = ''.join(declarator_line_list)
-
-        # Declarator string is all the declarators, separated by {}. We can
-        #  easily break them up.
-        declarator_list = declarator_string.rstrip('{}').split('{}')
+        # Scanning for function declarators is the slow part of all this, and
+        #  most of the time, most (if not all) of the .ino files haven't
+        #  changed since last time. So, we keep a hash of each .ino file along
+        #  with the declarators we found in it, in the build folder, and only
+        #  scan the files whose hash has changed.
+        self.sketch_cpp_file_name = sketch_name[0:-3] + "cpp"
+        self.cpp_file_list.append(self.sketch_cpp_file_name)
+        build_path = path_only + "/build"
+        cache_file = build_path + "/" + sketch_name + ".prototypes.json"
+        old_cache = load_json_file(cache_file, {})
+        if old_cache.get('scanner_version') != scanner_version:
+            old_cache = {}
+        new_cache = {'scanner_version': scanner_version}
+
+        # cpp_file is all the sketch files concatenated into one file, as a
+        #  list of lines. We need to do a couple of things to make this ready
+        #  to compile: adding in #include<Arduino.h> and finding all function
+        #  definitions so we can construct declarations for them.
+        cpp_file = []
+        declarator_list = []
+        # The line in cpp_file the prototypes go before; see scan_functions().
+        prototype_line = None
+        for ino_file in ino_file_list:
+            with open(path_only + "/" + ino_file) as f:
+                contents = f.read()
+            ino_hash = hashlib.sha1(contents).hexdigest()
+            ino_lines = contents.splitlines(True)
+
+            cached = old_cache.get('files', {}).get(ino_file)
+            if cached and cached['hash'] == ino_hash:
+                ino_declarators = cached['declarators']
+                first_function = cached['first_function']
+            else:
+                ino_declarators, first_function = scan_functions(ino_lines)
+                ino_declarators = [declaration for declaration in
+                                   ino_declarators if declaration]
+            new_cache.setdefault('files', {})[ino_file] = {'hash': ino_hash,
+                                   'declarators': ino_declarators,
+                                   'first_function': first_function}
+            declarator_list.extend(ino_declarators)
+            if prototype_line is None and first_function is not None:
+                prototype_line = len(cpp_file) + first_function
+            cpp_file.extend(ino_lines)
+
+        if new_cache != old_cache:
+            store_json_file(cache_file, new_cache)
 
         # cpp_file is a list of the lines in the .ino files found in the
         #  sketch directory. Insertion at the top of a list is slow; we
         #  could use the deque type to speed it up, but that's not really
         #  necessary; the better way is just to iterate over cpp_file and
-        #  stick the data into a file object, inserting other data as we go
-        #  as needed.
-        self.sketch_cpp_file_name = sketch_name[0:-3] + "cpp"
-        self.cpp_file_list.append(self.sketch_cpp_file_name)
-        with open(path_only + "/build/" + self.sketch_cpp_file_name, 'w') as f_out:
-            # The very first thing that needs to happen, bar none, is the
-            # insertion of the Arduino.h header include. Failure to do this
-            # could cause poorly written libraries to break.
-            f_out.write("#include<Arduino.h>\n")
-
-            # We assume that we're inside the "include section" at the top of
-            # the sketch. Of course, a normal C++ program can have includes
-            # anywhere, but part of the tyranny of the arduino IDE is that
-            # includes must be at the top or all hell will break loose. I'm not
-            # going to hold myself to higher standards than the official IDE.
-            include_section = True
-
-            for line in cpp_file:
-                # While we're in the include section, we want to create a list of
-                # all the various files that are included. These will give us clues
-                # later as to where we should look for libraries that this sketch
-                # depends upon.
-                if include_section:
-                    # Capture the includes and write the line to the file.
-                    if "include" in line:
-                        f_out.write(line)
-                        self.include_file_list.append(Include_re.search(line).group('include_name'))
-                        continue
-                    # Once we've see our last include, we want to build our
-                    # function prototypes and insert them into the cpp file.
-                    else:
-                        include_section = False
-                        for declaration in declarator_list:
-                            f_out.write(declaration + ";\n")
-                # Once we're past the include section, and we've made all our
-                # function prototypes, we can just tack the rest of the files
-                # on.
+        #  stick the data into a list of output lines, inserting other data as
+        #  we go as needed.
+        #
+        # The very first thing that needs to happen, bar none, is the
+        # insertion of the Arduino.h header include. Failure to do this
+        # could cause poorly written libraries to break.
+        out_lines = ["#include<Arduino.h>\n"]
+
+        # We assume that we're inside the "include section" at the top of
+        # the sketch. Of course, a normal C++ program can have includes
+        # anywhere, but part of the tyranny of the arduino IDE is that
+        # includes must be at the top or all hell will break loose. I'm not
+        # going to hold myself to higher standards than the official IDE.
+        include_section = True
+
+        for line_number, line in enumerate(cpp_file):
+            # The function prototypes go right before the first function
+            #  definition. Not straight after the includes: a sketch's own
+            #  types are usually declared in between, and the prototypes
+            #  can't use them before that.
+            if line_number == prototype_line:
+                for declaration in declarator_list:
+                    out_lines.append(declaration + ";\n")
+            # While we're in the include section, we want to create a list of
+            # all the various files that are included. These will give us clues
+            # later as to where we should look for libraries that this sketch
+            # depends upon.
+            if include_section:
+                # Capture the includes and write the line to the file.
+                if "include" in line:
+                    out_lines.append(line)
+                    self.include_file_list.append(Include_re.search(line).group('include_name'))
+                    continue
                 else:
-                   f_out.write(line) 
+                    include_section = False
+            # Once we're past the include section, we can just tack the rest
+            # of the files on.
+            if not include_section:
+               out_lines.append(line) 
+
+        # Only write the .cpp file if it's actually going to change. Writing
+        #  it anyway would bump its mtime, and that would make us recompile
+        #  the sketch, usually the biggest file in the build, for nothing.
+        out_contents = "".join(out_lines)
+        out_file = build_path + "/" + self.sketch_cpp_file_name
+        try:
+            with open(out_file) as f:
+                unchanged = (f.read() == out_contents)
+        except IOError:
+            unchanged = False
+        if not unchanged:
+            with open(out_file, 'w') as f_out:
+                f_out.write(out_contents)
 
     def fetch_sketch_cpp_files(self):
         # cpp_file_list is all of the source files which aren't .ino files. We
@@ -0,0 +1,109 @@
+#!/bin/python
+import os
+import os.path
+import time
+
+from Cache_Store import load_json_file, store_json_file
+
+# os.scandir() (Python 3.5 and up, or the scandir package before that) hands
+#  us each entry's type along with its name, which saves a stat() per file.
+#  If neither is around, we fall back to listdir() and stat() ourselves.
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+# These are the files we know how to build.
+source_extensions = ('.c', '.cpp', '.s', '.S')
+
+class Source_Index:
+    ''' Source_Index finds the source files under a directory tree in one
+    walk, sorting them by extension as it goes. It remembers what it saw in
+    each directory, along with the directory's mtime, in index_file. A
+    directory's mtime changes whenever a file is added to it, removed from it
+    or renamed in it, so as long as the mtime matches, the listing we have is
+    still good and we don't need to list the directory again; we only stat
+    it. That makes walking a big library tree that hasn't changed cheap.
+    '''
+    def __init__(self, index_file=None):
+        self.index_file = index_file
+        self.directories = {}
+        if index_file:
+            self.directories = load_json_file(index_file, {})
+
+        # How many directories we had to list, and how many listings we
+        #  could reuse, for the timing report.
+        self.listed = 0
+        self.reused = 0
+
+    def list_directory(self, path):
+        '''
+        list_directory returns the entry for path: its mtime, the source files
+        in it, and its subdirectories. Returns None if path isn't a directory.
+        '''
+        try:
+            mtime = os.stat(path).st_mtime
+        except OSError:
+            return None
+
+        entry = self.directories.get(path)
+        if entry and entry['mtime'] == mtime:
+            self.reused += 1
+            return entry
+
+        self.listed += 1
+        file_list = []
+        dir_list = []
+        # Like os.walk(), we don't follow symlinks to directories.
+        if scandir:
+            for dir_entry in scandir(path):
+                if dir_entry.is_dir(follow_symlinks=False):
+                    dir_list.append(dir_entry.name)
+                elif os.path.splitext(dir_entry.name)[1] in source_extensions:
+                    file_list.append(dir_entry.name)
+        else:
+            for name in os.listdir(path):
+                full_name = os.path.join(path, name)
+                if os.path.isdir(full_name) and not os.path.islink(full_name):
+                    dir_list.append(name)
+                elif os.path.splitext(name)[1] in source_extensions:
+                    file_list.append(name)
+
+        entry = {'mtime': mtime, 'files': sorted(file_list),
+                 'dirs': sorted(dir_list)}
+
+        # A directory changed within the last couple of seconds could change
+        #  again without its mtime moving, on filesystems with coarse
+        #  timestamps. Don't trust a listing like that next time.
+        if time.time() - mtime > 2:
+            self.directories[path] = entry
+        else:
+            self.directories.pop(path, None)
+        return entry
+
+    def find_sources(self, base_path, extensions=source_extensions):
+        '''
+        find_sources returns a dict mapping each extension in extensions to
+        the list of files under base_path with that extension, as full paths
+        with forward slashes.
+        '''
+        source_lists = dict((extension, []) for extension in extensions)
+        pending = [base_path.replace("\\", "/")]
+        while pending:
+            path = pending.pop(0)
+            entry = self.list_directory(path)
+            if entry is None:
+                continue
+            for name in entry['files']:
+                extension = os.path.splitext(name)[1]
+                if extension in source_lists:
+                    source_lists[extension].append(path + "/" + name)
+            pending[0:0] = [path + "/" + name for name in entry['dirs']]
+        return source_lists
+
+    def save(self):
+        if self.index_file:
+            store_json_file(self.index_file, self.directories)
@@ -0,0 +1,151 @@
+#!/bin/python
+import os
+import os.path
+import re
+import sys
+import tempfile
+import time
+
+# Stub_Tool stands in for the whole toolchain (compiler, archiver, linker,
+#  objcopy and uploader) on the synthetic platforms Synthetic_Platform makes,
+#  so Benchmark_Suite can time everything *we* do in a build without a real
+#  compiler on the machine, or a board plugged in. Each command just writes
+#  the files the real tool would have written. The compiler also writes a
+#  proper dependency file, following #includes through the -I paths the way
+#  gcc would, so our incremental build checks have real work to do.
+#
+#  python Stub_Tool.py cc|ar|ld|objcopy|upload arguments...
+#
+# To try out uploads to lots of ports without any boards, the stub uploader
+#  listens to two environment variables:
+#  STUB_UPLOAD_SECONDS - how long each upload takes (default: no time at all)
+#  STUB_UPLOAD_FAIL    - a comma-separated list of ports whose uploads fail;
+#                        port:N fails the first N tries on that port and then
+#                        works (the count is kept in STUB_UPLOAD_STATE, a
+#                        folder, or the temp folder)
+
+Include_re = re.compile(r'^\s*#\s*include\s*[<"]([^>"]+)[>"]', re.M)
+
+def find_headers(source_file, include_paths):
+    header_list = []
+    seen = set()
+    pending = [source_file]
+    while pending:
+        file_name = pending.pop(0)
+        try:
+            with open(file_name) as f:
+                contents = f.read()
+        except IOError:
+            continue
+        search_paths = [os.path.dirname(file_name)] + include_paths
+        for include in Include_re.findall(contents):
+            for path in search_paths:
+                header = os.path.join(path, include)
+                if os.path.isfile(header):
+                    if header not in seen:
+                        seen.add(header)
+                        header_list.append(header)
+                        pending.append(header)
+                    break
+    return header_list
+
+def compile_file(args):
+    out_file = args[args.index("-o") + 1]
+    include_paths = [arg[2:] for arg in args if arg.startswith("-I")]
+    # Skip over the values of the options that take one, so an -include'd
+    #  header isn't mistaken for the source.
+    values = set(index + 1 for index, arg in enumerate(args)
+                 if arg in ("-o", "-MF", "-include", "-x"))
+    source_file = [arg for index, arg in enumerate(args)
+                   if index not in values and os.path.splitext(arg)[1] in
+                   ('.c', '.cpp', '.s', '.S', '.h')][-1]
+    forced_includes = [args[index] for index in values
+                       if args[index - 1] == "-include"]
+    with open(out_file, 'w') as f:
+        f.write("stub object for " + source_file + "\n")
+    if "-MF" in args:
+        # Like gcc, leave out whatever came in through a precompiled header.
+        dependency_list = [source_file] + forced_includes
+        precompiled = set()
+        for header in forced_includes:
+            if os.path.exists(header + ".gch"):
+                precompiled.update(find_headers(header, include_paths))
+        for header in find_headers(source_file, include_paths):
+            if header not in precompiled:
+                dependency_list.append(header)
+        with open(args[args.index("-MF") + 1], 'w') as f:
+            f.write(out_file + ":")
+            for dependency in dependency_list:
+                f.write(" \\\n " + dependency.replace(" ", "\\ "))
+            f.write("\n")
+
+def archive(args):
+    archive_file = [arg for arg in args if arg.endswith(".a")][0]
+    with open(archive_file, 'a') as f:
+        for arg in args:
+            if arg.endswith(".o"):
+                f.write(arg + "\n")
+
+def link(args):
+    with open(args[args.index("-o") + 1], 'w') as f:
+        for arg in args:
+            if arg.endswith(".o") or arg.endswith(".a"):
+                f.write(arg + "\n")
+
+def objcopy(args):
+    with open(args[-2]) as f_in:
+        contents = f_in.read()
+    with open(args[-1], 'w') as f_out:
+        f_out.write(contents)
+
+def upload(args):
+    # Nothing to flash, but say what would have gone where, so a test can
+    #  tell whether an upload ran.
+    port = "?"
+    hex_file = "?"
+    for arg in args:
+        if arg.startswith("-P"):
+            port = arg[2:]
+        elif arg.startswith("-Uflash:w:"):
+            hex_file = arg[len("-Uflash:w:"):].rsplit(":", 1)[0]
+    time.sleep(float(os.environ.get("STUB_UPLOAD_SECONDS", 0)))
+    for fail_spec in os.environ.get("STUB_UPLOAD_FAIL", "").split(","):
+        fail_port, colon, fail_count = fail_spec.rpartition(":")
+        if not colon or not fail_count.isdigit():
+            fail_port, fail_count = fail_spec, None
+        if fail_port != port:
+            continue
+        if fail_count is None:
+            print "Stub_Tool: no answer from " + port
+            sys.exit(1)
+        state_file = os.path.join(
+            os.environ.get("STUB_UPLOAD_STATE", tempfile.gettempdir()),
+            "stub_upload_" + re.sub(r"[^A-Za-z0-9]", "_", port))
+        try:
+            with open(state_file) as f:
+                tries = int(f.read())
+        except (IOError, ValueError):
+            tries = 0
+        with open(state_file, 'w') as f:
+            f.write(str(tries + 1))
+        if tries < int(fail_count):
+            print "Stub_Tool: no answer from " + port
+            sys.exit(1)
+    print "Stub_Tool: uploaded %s to %s" % (hex_file, port)
+
+if __name__ == '__main__':
+    tool = sys.argv[1]
+    args = sys.argv[2:]
+    if tool == "cc":
+        compile_file(args)
+    elif tool == "ar":
+        archive(args)
+    elif tool == "ld":
+        link(args)
+    elif tool == "objcopy":
+        objcopy(args)
+    elif tool == "upload":
+        upload(args)
+    else:
+        sys.stderr.write("Stub_Tool: unknown tool " + tool + "\n")
+        sys.exit(1)
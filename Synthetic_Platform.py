@@ -0,0 +1,253 @@
+#!/bin/python
+import os
+import os.path
+import sys
+
+# Synthetic_Platform writes out a complete, made-up Arduino setup for
+#  Benchmark_Suite to build: an IDE folder holding a platform (platform.txt,
+#  boards.txt, a core, variants and libraries) and a sketchbook holding a
+#  sketch. Every knob that matters to how long our own code takes (the
+#  number of boards, libraries, core files and sketch lines) can be turned
+#  up or down. The recipes all run Stub_Tool, so nothing here needs a real
+#  compiler.
+
+stub_script = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                           "Stub_Tool.py")
+
+def write_file(filename, contents):
+    directory = os.path.dirname(filename)
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+    with open(filename, 'w') as f:
+        f.write(contents)
+
+def platform_txt():
+    lines = ["name=Synthetic Benchmark Platform",
+             "version=1.0.0",
+             "",
+             "stub.python=" + sys.executable.replace("\\", "/"),
+             "stub.script=" + stub_script.replace("\\", "/"),
+             "compiler.path={stub.python}",
+             "compiler.warning_flags=-w",
+             "compiler.c.flags=-c -g -Os {compiler.warning_flags} "
+             "-std=gnu11 -ffunction-sections -fdata-sections -MMD",
+             "compiler.cpp.flags=-c -g -Os {compiler.warning_flags} "
+             "-std=gnu++11 -fpermissive -fno-exceptions "
+             "-ffunction-sections -fdata-sections -fno-threadsafe-statics "
+             "-MMD",
+             "compiler.S.flags=-c -g -x assembler-with-cpp",
+             "compiler.ar.flags=rcs",
+             "compiler.c.elf.flags=-Os -g -Wl,--gc-sections",
+             "compiler.c.extra_flags=",
+             "compiler.cpp.extra_flags=",
+             "compiler.S.extra_flags=",
+             "compiler.ar.extra_flags=",
+             "build.extra_flags=",
+             ""]
+    # A real platform.txt has plenty of variables the build never looks at;
+    #  they still have to be parsed.
+    for index in range(60):
+        lines.append("tools.unused%d.path={runtime.tools.unused%d.path}" %
+                     (index, index))
+        lines.append("tools.unused%d.cmd=unused%d" % (index, index))
+    lines.extend([
+        "",
+        'recipe.c.o.pattern="{compiler.path}" "{stub.script}" cc '
+        '{compiler.c.flags} -mmcu={build.mcu} -DF_CPU={build.f_cpu} '
+        '-DARDUINO={runtime.ide.version} -DARDUINO_{build.board} '
+        '{compiler.c.extra_flags} {build.extra_flags} {includes} '
+        '"{source_file}" -o "{object_file}"',
+        'recipe.cpp.o.pattern="{compiler.path}" "{stub.script}" cc '
+        '{compiler.cpp.flags} -mmcu={build.mcu} -DF_CPU={build.f_cpu} '
+        '-DARDUINO={runtime.ide.version} -DARDUINO_{build.board} '
+        '{compiler.cpp.extra_flags} {build.extra_flags} {includes} '
+        '"{source_file}" -o "{object_file}"',
+        'recipe.S.o.pattern="{compiler.path}" "{stub.script}" cc '
+        '{compiler.S.flags} -mmcu={build.mcu} -DF_CPU={build.f_cpu} '
+        '{compiler.S.extra_flags} {build.extra_flags} {includes} '
+        '"{source_file}" -o "{object_file}"',
+        'recipe.ar.pattern="{compiler.path}" "{stub.script}" ar '
+        '{compiler.ar.flags} {compiler.ar.extra_flags} '
+        '"{build.path}/{archive_file}" "{object_file}"',
+        'recipe.c.combine.pattern="{compiler.path}" "{stub.script}" ld '
+        '{compiler.c.elf.flags} -mmcu={build.mcu} '
+        '-o "{build.path}/{build.project_name}.elf" {object_files} '
+        '"{build.path}/{archive_file}" "-L{build.path}" -lm',
+        'recipe.objcopy.hex.pattern="{compiler.path}" "{stub.script}" '
+        'objcopy -O ihex -R .eeprom "{build.path}/{build.project_name}.elf" '
+        '"{build.path}/{build.project_name}.hex"',
+        "",
+        "tools.stubup.path={runtime.platform.path}",
+        "tools.stubup.cmd.linux={stub.python}",
+        "tools.stubup.cmd.macosx={stub.python}",
+        "tools.stubup.cmd.windows={stub.python}",
+        'tools.stubup.upload.pattern="{cmd}" "{stub.script}" upload '
+        '-P{serial.port} "-Uflash:w:{build.path}/{build.project_name}.hex:i"',
+        ""])
+    return "\n".join(lines)
+
+def boards_txt(board_count):
+    lines = ["menu.cpu=Processor", "menu.speed=Speed", ""]
+    for index in range(board_count):
+        board = "board%d" % index
+        lines.extend([
+            "%s.name=Synthetic Board %d" % (board, index),
+            "%s.vid.0=0x2341" % board,
+            "%s.pid.0=0x%04x" % (board, index),
+            "%s.upload.tool=stubup" % board,
+            "%s.upload.protocol=arduino" % board,
+            "%s.upload.maximum_size=32256" % board,
+            "%s.upload.speed=115200" % board,
+            "%s.bootloader.tool=stubup" % board,
+            "%s.bootloader.low_fuses=0xFF" % board,
+            "%s.bootloader.high_fuses=0xDE" % board,
+            "%s.build.board=SYNTH_%d" % (board, index),
+            "%s.build.core=synth" % board,
+            "%s.build.variant=%s" % (board, board),
+            "%s.build.mcu=synth%d" % (board, index % 4),
+            "%s.build.f_cpu=16000000L" % board])
+        for cpu in range(3):
+            lines.extend([
+                "%s.menu.cpu.cpu%d=CPU %d" % (board, cpu, cpu),
+                "%s.menu.cpu.cpu%d.build.mcu=synthcpu%d" % (board, cpu, cpu),
+                "%s.menu.cpu.cpu%d.upload.maximum_size=%d" %
+                (board, cpu, 16384 << cpu)])
+        for speed in [8, 16]:
+            lines.extend([
+                "%s.menu.speed.%dmhz=%d MHz" % (board, speed, speed),
+                "%s.menu.speed.%dmhz.build.f_cpu=%d000000L" %
+                (board, speed, speed)])
+        lines.append("")
+    return "\n".join(lines)
+
+def write_core(core_path, core_files):
+    write_file(core_path + "/Arduino.h",
+               "#ifndef Arduino_h\n#define Arduino_h\n"
+               "#include <pins_arduino.h>\n" +
+               "".join('#include "core%d.h"\n' % index
+                       for index in range(0, core_files, 4)) +
+               "void setup();\nvoid loop();\n#endif\n")
+    for index in range(core_files):
+        write_file(core_path + "/core%d.h" % index,
+                   "#pragma once\nint core_function_%d(int x);\n" % index)
+        # Mostly C++, some C, and the odd assembler file, like a real core.
+        if index % 10 == 9:
+            extension = ".S"
+            contents = "#include \"core%d.h\"\n.global stub%d\n" % (index,
+                                                                     index)
+        elif index % 3 == 2:
+            extension = ".c"
+            contents = "#include \"Arduino.h\"\n#include \"core%d.h\"\n" \
+                       "int core_function_%d(int x) { return x + %d; }\n" % \
+                       (index, index, index)
+        else:
+            extension = ".cpp"
+            contents = "#include \"Arduino.h\"\n#include \"core%d.h\"\n" \
+                       "int core_function_%d(int x) { return x * %d; }\n" % \
+                       (index, index, index)
+        write_file(core_path + "/core%d%s" % (index, extension), contents)
+
+def write_library(library_path, name, new_format):
+    # Half of the libraries use the 1.5 layout (library.properties and a
+    #  src/ folder), the other half the old flat one.
+    if new_format:
+        write_file(library_path + "/library.properties",
+                   "name=%s\nversion=1.0.0\nauthor=Benchmark\n" % name)
+        source_path = library_path + "/src"
+    else:
+        source_path = library_path
+    write_file(source_path + "/" + name + ".h",
+               "#pragma once\n#include <Arduino.h>\n"
+               "class %s { public: int run(int x); };\n" % name)
+    write_file(source_path + "/" + name + ".cpp",
+               "#include \"%s.h\"\nint %s::run(int x) { return x; }\n" %
+               (name, name))
+    write_file(source_path + "/utility/" + name + "_util.c",
+               "int %s_util(int x) { return x; }\n" % name)
+    write_file(library_path + "/examples/Example/Example.ino",
+               "#include <%s.h>\nvoid setup() {}\nvoid loop() {}\n" % name)
+
+def sketch_ino(library_names, sketch_lines):
+    lines = ["#include <%s.h>" % name for name in library_names]
+    lines.extend(["", "// Synthetic benchmark sketch", "int counter = 0;", ""])
+    index = 0
+    while len(lines) < sketch_lines:
+        lines.extend([
+            "/* function %d: does nothing much," % index,
+            "   but it { has braces } in its comment */",
+            "int function_%d(int value, const char *label)" % index,
+            "{",
+            "  if (value > %d) {" % index,
+            "    return value - %d; // }" % index,
+            "  }",
+            "  return function_%d(value + 1, \"{x}\");" %
+            max(index - 1, 0),
+            "}",
+            ""])
+        index += 1
+    lines.extend(["void setup() {", "  counter = function_0(1, \"setup\");", "}", "",
+                  "void loop() {", "  counter++;", "}", ""])
+    return "\n".join(lines)
+
+def generate_platform(root, boards=50, libraries=20, core_files=40,
+                      sketch_lines=2000, sketch_libraries=None):
+    '''
+    generate_platform writes a synthetic IDE folder and sketchbook under
+    root, and returns the settings Arduino_Builder_Loader needs to build the
+    sketch in it, as a dict of its module variables. The sketch includes
+    sketch_libraries of the libraries (all of them, by default).
+    '''
+    root = os.path.abspath(root).replace("\\", "/")
+    ide_path = root + "/ide"
+    platform_path = ide_path + "/hardware/synthetic/synth"
+    sketchbook_path = root + "/sketchbook"
+    sketch_path = sketchbook_path + "/Bench"
+
+    write_file(platform_path + "/platform.txt", platform_txt())
+    write_file(platform_path + "/boards.txt", boards_txt(boards))
+    write_core(platform_path + "/cores/synth", core_files)
+    for index in range(boards):
+        write_file(platform_path + "/variants/board%d/pins_arduino.h" %
+                   index, "#pragma once\n#define LED_BUILTIN %d\n" % index)
+    # One variant gets a source file of its own, like some real ones do.
+    write_file(platform_path + "/variants/board0/variant.cpp",
+               "#include <Arduino.h>\nint variant_init() { return 0; }\n")
+
+    library_names = []
+    for index in range(libraries):
+        name = "SynthLib%d" % index
+        # The first few live with the platform, the rest in the sketchbook,
+        #  the way they'd be spread out on a real machine.
+        if index < libraries // 4:
+            library_root = platform_path + "/libraries"
+        else:
+            library_root = sketchbook_path + "/libraries"
+        write_library(library_root + "/" + name, name, index % 2 == 0)
+        library_names.append(name)
+    if sketch_libraries is None:
+        sketch_libraries = libraries
+    write_file(sketch_path + "/Bench.ino",
+               sketch_ino(library_names[0:sketch_libraries], sketch_lines))
+    write_file(sketch_path + "/helpers.ino",
+               "int helper(int x) {\n  return x * 2;\n}\n")
+    write_file(sketch_path + "/extra.cpp",
+               "#include <Arduino.h>\nint extra() { return 1; }\n")
+
+    return {'sketch_path': sketch_path,
+            'serial_port': "/dev/null",
+            'vendor': "synthetic",
+            'platform': "synth",
+            'board': "board0",
+            'runtime_ide_path': ide_path,
+            'sketchbook_path': sketchbook_path,
+            'runtime_platform_path': platform_path}
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print "usage: Synthetic_Platform.py folder [boards libraries " \
+              "core_files sketch_lines]"
+        sys.exit(1)
+    counts = [int(arg) for arg in sys.argv[2:6]]
+    settings = generate_platform(sys.argv[1], *counts)
+    for name, value in sorted(settings.items()):
+        print "%s = %r" % (name, value)
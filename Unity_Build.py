@@ -0,0 +1,152 @@
+#!/bin/python
+import fnmatch
+import json
+import os.path
+
+from Cache_Store import hash_string, load_json_file, native_strings, \
+        store_json_file
+
+# A unity (or "jumbo") build compiles a whole folder's worth of sources as a
+#  handful of big files instead of dozens of small ones. A core is mostly
+#  small files that all read the same headers, and starting the compiler and
+#  parsing those headers again for every one of them is where most of a
+#  clean build goes. Only .c and .cpp files are grouped; assembly files have
+#  nothing to share.
+unity_extensions = ('.c', '.cpp')
+
+class Unity_Rules:
+    ''' Unity_Rules decides which sources may go into a unity build. Some
+    files just don't get along with the rest of their folder once they're
+    glued together, and there are two ways we find out about them.
+
+    The first is a rules file (JSON) that says so, per platform:
+
+        {"*/hardware/arduino/avr": {"deny": ["WInterrupts.c"]},
+         "*/hardware/simblee/*": {"allow": ["*/cores/*"],
+                                  "deny": ["*/libraries/*/utility/*"]}}
+
+    Each key is matched against the platform folder, and the rules of every
+    key that matches apply. A pattern is matched against both the whole path
+    of the source and just its name. A file matching a "deny" pattern is
+    never grouped; if there are any "allow" patterns, only files matching
+    one of them are.
+
+    The second is the build itself: a group that won't compile is built one
+    file at a time instead (see Unity_Builder), and if every one of its files
+    builds fine on its own, we write them down in fallback_file and don't
+    group them again. Delete that file to give them another try.
+    '''
+    def __init__(self, fallback_file):
+        self.fallback_file = fallback_file
+        fallback_list = load_json_file(fallback_file, [])
+        if not isinstance(fallback_list, list):
+            fallback_list = []
+        self.fallback_set = set(fallback_list)
+        self.rules_files = {}
+        self.changed = False
+
+    def fetch_rules(self, rules_file, platform_path):
+        '''
+        fetch_rules returns the allow and deny patterns for platform_path in
+        rules_file (either can be empty). Unlike our cache files, a rules file
+        somebody wrote by hand is worth complaining about if it's missing or
+        broken, so that raises.
+        '''
+        if not rules_file:
+            return [], []
+        if rules_file not in self.rules_files:
+            with open(rules_file) as f:
+                self.rules_files[rules_file] = native_strings(json.load(f))
+        allow = []
+        deny = []
+        for pattern, rules in sorted(self.rules_files[rules_file].items()):
+            if fnmatch.fnmatch(platform_path, pattern):
+                allow.extend(rules.get('allow', []))
+                deny.extend(rules.get('deny', []))
+        return allow, deny
+
+    def make_filter(self, rules_file, platform_path):
+        '''
+        make_filter returns a function that takes a source file and tells
+        whether it may go into a unity build on platform_path.
+        '''
+        allow, deny = self.fetch_rules(rules_file, platform_path)
+
+        def matches(source_file, pattern_list):
+            name = os.path.basename(source_file)
+            return any(fnmatch.fnmatch(source_file, pattern) or
+                       fnmatch.fnmatch(name, pattern)
+                       for pattern in pattern_list)
+
+        def is_allowed(source_file):
+            if source_file in self.fallback_set:
+                return False
+            if allow and not matches(source_file, allow):
+                return False
+            return not matches(source_file, deny)
+        return is_allowed
+
+    def record_fallback(self, source_file_list):
+        new_files = set(source_file_list) - self.fallback_set
+        if new_files:
+            self.fallback_set.update(new_files)
+            self.changed = True
+
+    def save(self):
+        if self.changed:
+            store_json_file(self.fallback_file, sorted(self.fallback_set))
+            self.changed = False
+
+
+def group_sources(source_lists, source_roots, group_count, is_allowed):
+    '''
+    group_sources splits source_lists (as Source_Index.find_sources() hands
+    them back) into unity groups: for each (root, folder) pair in
+    source_roots, and each of unity_extensions, the files under root that
+    is_allowed() lets in are split into up to group_count groups. It returns
+    the groups, as (folder, extension, index, source_file_list), and
+    source_lists with those files taken out; what's left gets built one file
+    at a time like always.
+
+    Which group a file goes in is decided by a hash of its path under root,
+    not by where it falls in the folder's file list. So adding or removing a
+    file changes only the group it's in, and the other groups (and their
+    objects) stay just as they were. That holds as long as the number of
+    groups stays put. A group of one is no better than no group, so a folder
+    with fewer than two files to a group gets fewer groups, and a folder
+    with only one file none; a group the hash leaves with fewer than two
+    files isn't made, and its file gets built on its own.
+    '''
+    # Longest root first, so a root inside another root wins, just like in
+    #  make_builders().
+    source_roots = sorted(source_roots, key=lambda item: len(item[0]),
+                          reverse=True)
+    remaining_lists = dict((extension, list(file_list)) for extension,
+                           file_list in source_lists.items())
+    groups = []
+    for extension in unity_extensions:
+        claimed = set()
+        for root, folder in source_roots:
+            file_list = sorted(source_file for source_file in
+                               remaining_lists.get(extension, [])
+                               if source_file.startswith(root + "/") and
+                               source_file not in claimed and
+                               is_allowed(source_file))
+            claimed.update(file_list)
+            count = min(group_count, len(file_list) // 2)
+            if not count:
+                continue
+            buckets = [[] for index in range(count)]
+            for source_file in file_list:
+                name = source_file[len(root) + 1:]
+                buckets[int(hash_string(name)[0:8], 16) % count].append(
+                        source_file)
+            file_set = set()
+            for index, bucket in enumerate(buckets):
+                if len(bucket) >= 2:
+                    groups.append((folder, extension, index + 1, bucket))
+                    file_set.update(bucket)
+            remaining_lists[extension] = [source_file for source_file in
+                    remaining_lists[extension]
+                    if source_file not in file_set]
+    return remaining_lists, groups
@@ -0,0 +1,174 @@
+#!/bin/python
+import glob
+import subprocess
+import sys
+import threading
+import time
+
+import Build_Trace
+
+class Upload_Error(EnvironmentError):
+    pass
+
+def expand_ports(port_list):
+    '''
+    expand_ports turns a list of ports and globs (like /dev/ttyACM*) into a
+    list of ports, in order, each one just once. A glob that matches nothing
+    is an error; we'd rather hear about a hub that's come unplugged than
+    flash no boards at all and call it a success.
+    '''
+    ports = []
+    for pattern in port_list:
+        if glob.has_magic(pattern):
+            matches = sorted(glob.glob(pattern))
+            if not matches:
+                raise Upload_Error("No serial ports match " + pattern)
+        else:
+            matches = [pattern]
+        for port in matches:
+            if port not in ports:
+                ports.append(port)
+    return ports
+
+class Upload_Farm:
+    ''' Upload_Farm flashes one target's firmware onto the boards on a whole
+    list of serial ports at once, the way a production line with a hub full
+    of boards wants it. The upload recipe is expanded once, and filled in
+    with each port in turn.
+
+    Up to max_jobs uploads run at the same time. A board that fails to take
+    its firmware is tried again, up to retries more times, after a short
+    wait (boards on a busy hub sometimes need a moment to show up again
+    after a reset). Each upload's output is printed in one piece, tagged
+    with its port, once it's done, and at the end we print how every port
+    went.
+    '''
+    def __init__(self, port_list, max_jobs=8, retries=2, retry_delay=1.0):
+        self.port_list = port_list
+        self.max_jobs = max(1, max_jobs)
+        self.retries = max(0, retries)
+        self.retry_delay = retry_delay
+        self.lock = threading.Lock()
+
+    def upload(self, target, upload_record=None, force=False):
+        '''
+        upload flashes target onto every port. Ports the Upload_Record says
+        already have this firmware are skipped, unless force is set. If any
+        port fails every attempt, it raises Upload_Error once the rest are
+        done.
+        '''
+        target.step("Uploading to %d ports..." % len(self.port_list),
+                    "Uploading")
+        start_time = time.time()
+        firmware_hash = target.fetch_firmware_hash()
+        board_id = target.fetch_board_id()
+        upload_recipe = target.fetch_upload_recipe()
+
+        # One result per port: [result, attempts, seconds].
+        self.results = {}
+        self.pending = []
+        for port in self.port_list:
+            if upload_record and not force and \
+               upload_record.is_current(port, firmware_hash, board_id):
+                self.results[port] = ["skipped", 0, 0.0]
+            else:
+                self.pending.append(port)
+
+        def upload_port(port):
+            cmd = target.fetch_upload_cmd(upload_recipe, port)
+            if upload_record:
+                upload_record.forget(port)
+            if self.run_with_retry(port, cmd, target.name) and upload_record:
+                upload_record.remember(port, firmware_hash, board_id,
+                                       target.name)
+
+        workers = []
+        for index in range(min(self.max_jobs, len(self.pending))):
+            worker = threading.Thread(target=self._worker,
+                                      args=(upload_port,))
+            worker.daemon = True
+            worker.start()
+            workers.append(worker)
+        # Thread.join() with no timeout blocks Ctrl-C in Python 2.
+        for worker in workers:
+            while worker.is_alive():
+                worker.join(0.1)
+        target.end_step()
+
+        self.print_report(time.time() - start_time)
+        failed_ports = [port for port in self.port_list
+                        if self.results[port][0] == "FAILED"]
+        if failed_ports:
+            raise Upload_Error("Upload failed on %d of %d ports: %s" %
+                               (len(failed_ports), len(self.port_list),
+                                ", ".join(failed_ports)))
+
+    def _worker(self, upload_port):
+        while True:
+            with self.lock:
+                if not self.pending:
+                    return
+                port = self.pending.pop(0)
+            start_time = time.time()
+            try:
+                upload_port(port)
+            except Exception as e:
+                # Whatever went wrong (an upload command we couldn't put
+                #  together, an upload record we couldn't write), it went
+                #  wrong for this port alone. The rest of the ports still get
+                #  their turn, and this one shows up as failed in the report.
+                with self.lock:
+                    sys.stdout.write("[%s] Upload failed: %s\n" %
+                                     (port, str(e) or e.__class__.__name__))
+                    attempts = self.results.get(port, [None, 0])[1]
+                    self.results[port] = ["FAILED", attempts,
+                                          time.time() - start_time]
+
+    def run_with_retry(self, port, cmd, target_name):
+        # Returns True once the upload works, False if it never does.
+        start_time = time.time()
+        for attempt in range(1, self.retries + 2):
+            if attempt > 1:
+                time.sleep(self.retry_delay)
+            job_start = time.time()
+            try:
+                process = subprocess.Popen(cmd, stdout=subprocess.PIPE,
+                                           stderr=subprocess.STDOUT)
+                output = process.communicate()[0]
+                status = process.returncode
+            except OSError as e:
+                output = str(e) + "\n"
+                status = None
+            if Build_Trace.fetch_trace():
+                Build_Trace.fetch_trace().add_job(
+                        "upload " + port, cmd, job_start, time.time(),
+                        status, target=target_name)
+
+            with self.lock:
+                for line in output.splitlines():
+                    sys.stdout.write("[%s] %s\n" % (port, line))
+                if status != 0:
+                    sys.stdout.write("[%s] Upload attempt %d of %d failed "
+                                     "(exit status %s)\n" %
+                                     (port, attempt, self.retries + 1,
+                                      status))
+                self.results[port] = ["ok" if status == 0 else "FAILED",
+                                      attempt, time.time() - start_time]
+            if status == 0:
+                return True
+        return False
+
+    def print_report(self, wall_time):
+        print
+        port_width = max([len(port) for port in self.port_list] + [4])
+        print "%-*s  %-7s  %8s  %8s" % (port_width, "Port", "Result",
+                                         "Attempts", "Time (s)")
+        counts = {}
+        for port in self.port_list:
+            result, attempts, seconds = self.results[port]
+            counts[result] = counts.get(result, 0) + 1
+            print "%-*s  %-7s  %8d  %8.2f" % (port_width, port, result,
+                                              attempts, seconds)
+        print "%d ports: %d ok, %d skipped, %d failed, in %.2f s" % (
+              len(self.port_list), counts.get("ok", 0),
+              counts.get("skipped", 0), counts.get("FAILED", 0), wall_time)
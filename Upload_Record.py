@@ -0,0 +1,61 @@
+#!/bin/python
+import os
+import os.path
+import threading
+import time
+
+from Cache_Store import load_json_file, store_json_file
+
+class Upload_Record:
+    ''' Upload_Record remembers what we last flashed onto the board on each
+    serial port: a hash of the firmware files and which board (and board
+    options) they were built for. If a build comes out the same as what the
+    board already has, there's no point sitting through another upload.
+
+    Of course, we only know about the uploads *we* did. If somebody flashed
+    the board with something else since (the IDE, say), or swapped the board
+    on that port for another of the same kind, we can't tell; that's what
+    forcing the upload is for.
+
+    A port's entry is dropped before each upload and written back only once
+    the upload has succeeded, so a failed or interrupted upload never leaves
+    us thinking the board is up to date. Several uploads can be going at
+    once (see Upload_Farm), so every change goes through a lock.
+    '''
+    def __init__(self, record_file):
+        self.record_file = record_file
+        self.ports = load_json_file(record_file, {})
+        if not isinstance(self.ports, dict):
+            self.ports = {}
+        self.lock = threading.Lock()
+
+    def port_key(self, port):
+        # /dev/serial/by-id/... and friends are links to the real device;
+        #  whichever name we were given, it's the same board. Windows COM
+        #  ports aren't files, so they're left as they are.
+        if os.path.exists(port):
+            return os.path.realpath(port)
+        return port
+
+    def is_current(self, port, firmware_hash, board):
+        entry = self.ports.get(self.port_key(port))
+        return entry is not None and firmware_hash is not None and \
+               entry['firmware'] == firmware_hash and entry['board'] == board
+
+    def forget(self, port):
+        with self.lock:
+            if self.ports.pop(self.port_key(port), None) is not None:
+                self.save()
+
+    def remember(self, port, firmware_hash, board, target_name):
+        if firmware_hash is None:
+            return
+        with self.lock:
+            self.ports[self.port_key(port)] = {
+                'firmware': firmware_hash, 'board': board,
+                'target': target_name,
+                'time': time.strftime("%Y-%m-%d %H:%M:%S")}
+            self.save()
+
+    def save(self):
+        store_json_file(self.record_file, self.ports)
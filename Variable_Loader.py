@@ -1,6 +1,65 @@
 #!/bin/python27
 import re
 import copy
+import shlex
+
+# Use this RegEx to identify variables within a string: a name made of word
+#  characters and dots, wrapped in braces.
+Variable_re = re.compile('\{([\w.]+)\}')
+
+def read_variable_file(filename, board_name=None):
+    '''
+    read_variable_file scans all the lines in a file and returns a list of
+    [name, value] pairs for the ones that fit the variable RegEx below, in the
+    order they appear. If board_name is given, only that board's variables
+    are returned, with the board name taken off the front.
+    '''
+
+    # Comment lines must be any amount of whitespace at the beginning of 
+    #  the line, followed by a sharp. We can just ignore these.
+    Comment_re = re.compile('\A\s*#')
+
+    # A "variable" can be invoked later by surrounding its name in braces
+    # in another string. It looks a lot like a pattern, EXCEPT it doesn't
+    # have "pattern" at the end of it.
+    if board_name:
+        Variable_name_string = "(?<=^" + board_name + \
+                "\.)[\w.]*(?!pattern)(?=\s*=\s*)"
+    else:
+        Variable_name_string = "^\s*[\w.]*(?!pattern)(?=\s*=\s*)"
+
+    Variable_name_re = re.compile(Variable_name_string)
+    Variable_string_re = re.compile(
+        '((?:^\s*)[.\w]*(?!pattern)\s*=\s*)(?P<the_variable>[^#]*)')
+
+    variable_list = []
+    with open(filename) as file:
+
+        # Now, we'll iterate over the lines from our file check each one
+        # for a match to any of our regular expressions, and sort them away
+        # as appropriate.
+
+        for line in file:
+
+            # If this line is a comment, just skip it.
+            if Comment_re.match(line) != None:
+                continue
+
+            # If this line has a variable in it, file it.
+            match = Variable_name_re.search(line)
+            if match != None:
+                variable_string = Variable_string_re.match(line).\
+                                group('the_variable').strip()
+                variable_list.append([match.group(0), variable_string])
+                continue
+
+    return variable_list
+
+class Variable_Cycle_Error(ValueError):
+    ''' Raised when a variable ends up referring to itself, directly or
+    through other variables, so expanding it would never finish.
+    '''
+    pass
 
 class Variable_Manager:
     ''' Variable_Manager is a class that parses a file and finds all of the
@@ -8,132 +67,400 @@ class Variable_Manager:
     the existence of a "parse" fuction, and has a getter function that will
     return the variable value for a name passed to it, or None, if no variable
     matches.
+
+    Variables live in layers, and a variable set in a later layer overrides
+    the same variable in an earlier one:
+        platform - defaults from platform.txt
+        boards   - the board's own settings from boards.txt
+        ide      - things the IDE (that's us) provides, via add_variable()
+    The boards layer beats platform.txt because that's how the Arduino IDE
+    does it: platform.txt holds the defaults, and boards.txt tailors them.
+    Within one file, the first definition of a name wins.
+
+    Expanded values are remembered, along with every variable they were
+    built out of, so changing any one of those throws away just the
+    expansions that used it.
     '''
-    def __init__(self, filename, board_name=None):
+
+    layer_order = ['platform', 'boards', 'ide']
+
+    def __init__(self, filename=None, board_name=None, cache=None):
         """ 
         Class constructor. This gathers the data from filename (a platform.txt,
         boards.txt, or arduino.txt file) and parses it to enable the main
         program to call other functions later to handle the steps required to
-        produce the HEX file.  
+        produce the HEX file. If cache (a Platform_Cache) is given, parsed
+        files are loaded from and saved to it. With no filename, we start out
+        empty, and variables can be added with load_variables().
         """
-        self.Variables = []
-        self.parse_file(filename, board_name)
-
-    def parse_file(self, filename, board_name=None):
+        self.Layers = {}
+        for layer in self.layer_order:
+            self.Layers[layer] = {}
+
+        # Variables is the merged view: for each name, the value from the
+        #  highest layer that sets it. Expanded holds the fully expanded
+        #  values we've worked out so far, and Dependents maps each name to the
+        #  expansions that would need redoing if it changed.
+        self.Variables = {}
+        self.Expanded = {}
+        self.Dependents = {}
+        self.cache = cache
+
+        if filename:
+            self.parse_file(filename, board_name)
+
+    def parse_file(self, filename, board_name=None, layer=None):
         '''
-        parse_file scans all the lines in a file and adds any that fit the
-        variable RegEx above. We won't do more than capture them here; any
-        post-processing will occur later.
+        parse_file adds the variables in filename to one of our layers, from
+        the cache if we have a current copy there, or by reading the file if
+        not. Unless told otherwise, a file parsed for a particular board goes
+        in the boards layer, and anything else in the platform layer.
         '''
-
-        # Comment lines must be any amount of whitespace at the beginning of 
-        #  the line, followed by a sharp. We can just ignore these.
-        Comment_re = re.compile('\A\s*#')
-
-        # A "variable" can be invoked later by surrounding its name in braces
-        # in another string. It looks a lot like a pattern, EXCEPT it doesn't
-        # have "pattern" at the end of it.
-        if board_name:
-            Variable_name_string = "(?<=^" + board_name + \
-                    "\.)[\w.]*(?!pattern)(?=\s*=\s*)"
+        if layer is None:
+            if board_name:
+                layer = 'boards'
+            else:
+                layer = 'platform'
+
+        if self.cache:
+            variable_list = self.cache.load(filename, 'variables',
+                    lambda: read_variable_file(filename, board_name),
+                    board_name or "")
         else:
-            Variable_name_string = "^\s*[\w.]*(?!pattern)(?=\s*=\s*)"
+            variable_list = read_variable_file(filename, board_name)
+
+        self.load_variables(variable_list, layer)
+
+    def load_variables(self, variable_list, layer):
+        # variable_list is a list of [name, value] pairs; as in a file, the
+        #  first one for any given name wins.
+        for variable_name, variable_string in variable_list:
+            if variable_name not in self.Layers[layer]:
+                self.set_variable(variable_name, variable_string, layer)
+
+    def set_variable(self, variable_name, value, layer='ide'):
+        self.Layers[layer][variable_name] = value
+
+        # Work out what the merged value is now; setting a name in a low
+        #  layer doesn't change anything if a higher layer already has it.
+        merged_value = None
+        for layer_name in self.layer_order:
+            if variable_name in self.Layers[layer_name]:
+                merged_value = self.Layers[layer_name][variable_name]
+        if self.Variables.get(variable_name) != merged_value:
+            self.Variables[variable_name] = merged_value
+            self.invalidate(variable_name)
+
+    def invalidate(self, variable_name):
+        self.Expanded.pop(variable_name, None)
+        for dependent in self.Dependents.pop(variable_name, ()):
+            self.Expanded.pop(dependent, None)
 
-        Variable_name_re = re.compile(Variable_name_string)
-        Variable_string_re = re.compile(
-            '((?:^\s*)[.\w]*(?!pattern)\s*=\s*)(?P<the_variable>[^#]*)')
+    def fetch_variable(self, variable_name):
+        return self.Variables.get(variable_name)
 
-        with open(filename) as file:
+    def fetch_variable_list(self):
+        return [[name, value] for name, value in self.Variables.items()]
 
-            # Now, we'll iterate over the lines from our file check each one
-            # for a match to any of our regular expressions, and sort them away
-            # as appropriate.
+    def add_variable(self, new_variable):
+        self.set_variable(new_variable[0], new_variable[1], 'ide')
 
-            for line in file:
+    def expand_variable(self, variable_name, stack=()):
+        '''
+        expand_variable returns the value of variable_name with every
+        variable inside it replaced, all the way down, or None if there's no
+        such variable. The stack is the chain of names we're in the middle
+        of expanding; running into one of them again means a cycle.
+        '''
+        if variable_name in self.Expanded:
+            return self.Expanded[variable_name][0]
+        if variable_name not in self.Variables:
+            return None
+
+        value, dependencies = self.expand_string(
+                self.Variables[variable_name], stack + (variable_name,))
+        self.Expanded[variable_name] = (value, dependencies)
+        for dependency in dependencies:
+            self.Dependents.setdefault(dependency, set()).add(variable_name)
+        return value
+
+    def expand_string(self, incomplete_pattern, stack=(), slot_names=()):
+        # Returns the expanded string and the set of every variable name it
+        #  depended on, including ones that aren't defined (yet). Those stay
+        #  in the string as-is: {source_file} and friends get filled in later.
+        #  So do any names in slot_names, even if they *are* defined.
+        dependencies = set()
+
+        def replace_match(match):
+            var_to_replace = match.group(1)
+            if var_to_replace in slot_names:
+                return match.group(0)
+            if var_to_replace in stack:
+                raise Variable_Cycle_Error("variable cycle: " + \
+                        " -> ".join(stack + (var_to_replace,)))
+            dependencies.add(var_to_replace)
+            replacement_var = self.expand_variable(var_to_replace, stack)
+            if replacement_var is None:
+                return match.group(0)
+            dependencies.update(self.Expanded[var_to_replace][1])
+            return replacement_var
+
+        return Variable_re.sub(replace_match, incomplete_pattern), dependencies
 
-                # If this line is a comment, just skip it.
-                if Comment_re.match(line) != None:
-                    continue
+    def replace_variables(self, incomplete_pattern):
+        return self.expand_string(incomplete_pattern)[0]
 
-                # If this line has a variable in it, file it.
-                if Variable_name_re.search(line) != None:
-                    tempList = []
-                    for match in Variable_name_re.findall(line):
-                        tempList.append(match)
+    def compile_recipe(self, incomplete_pattern,
+                       slot_names=('source_file', 'object_file')):
+        '''
+        compile_recipe expands every variable in a pattern except the ones
+        named in slot_names and returns the result as a Recipe_Template,
+        ready to be filled in over and over. Returns None if there's no
+        pattern to compile.
+        '''
+        if not incomplete_pattern:
+            return None
+        return Recipe_Template(self.expand_string(incomplete_pattern,
+                                                  slot_names=slot_names)[0],
+                               slot_names)
 
-                    variable_string = Variable_string_re.match(line).\
-                                    group('the_variable').strip()
-                    tempList.append(variable_string)
+    def find_variable(self, search_string):
+        for name, value in self.Variables.items():
+            if search_string in name:
+                return value
+        return None
 
-                    self.Variables.append(tempList)
+class Recipe_Template:
+    ''' Recipe_Template is an expanded recipe, already split into the argument
+    list we'll hand to subprocess, with a few named slots (like {source_file}
+    and {object_file}) left to fill in. The expensive part, expanding the
+    variables and tokenizing the string, happens once per recipe; each
+    builder then only has to drop its own file names into the slots.
+    '''
+    def __init__(self, expanded_recipe, slot_names):
+        # Patterns come out of Pattern_Manager with two levels of quoting:
+        #  every quote is escaped (\") so it survives a first split, which
+        #  leaves the quotes that used to be handed to the OS as part of one
+        #  big command line. Splitting a second time applies those quotes
+        #  too, leaving exactly the arguments the program would have seen.
+        #  (Quotes that were doubly escaped, like the ones around -D string
+        #  values, come out of this as plain quotes, which is what gcc needs
+        #  to see.)
+        self.argv = shlex.split(" ".join(shlex.split(expanded_recipe)))
+
+        # For each argument with a slot in it, remember where it is and which
+        #  slots it holds, so fill() doesn't need to look at the rest.
+        self.slot_args = []
+        for index, arg in enumerate(self.argv):
+            arg_slots = [name for name in slot_names
+                         if "{" + name + "}" in arg]
+            if arg_slots:
+                self.slot_args.append((index, arg_slots))
+
+    def fill(self, slot_values):
+        '''
+        fill returns a fresh argument list with the slots replaced by the
+        values in the slot_values dict. A value can also be a list: if its
+        slot is an argument all on its own, each item becomes an argument of
+        its own (that's how we pass lists of object files); otherwise the
+        items are joined with spaces. Slots not in slot_values are left as
+        they are.
+        '''
+        argv = list(self.argv)
+        # Go from the back, so splicing in a list doesn't move the arguments
+        #  we still have to get to.
+        for index, arg_slots in reversed(self.slot_args):
+            arg = argv[index]
+            for name in arg_slots:
+                if name not in slot_values:
                     continue
+                value = slot_values[name]
+                if isinstance(value, list):
+                    if arg == "{" + name + "}":
+                        argv[index:index + 1] = value
+                        break
+                    value = " ".join(value)
+                arg = arg.replace("{" + name + "}", value)
+            else:
+                argv[index] = arg
+        return argv
+
+    def is_lone_slot(self, slot_name):
+        # True if slot_name shows up exactly once, as an argument by itself,
+        #  meaning fill() can splice a whole list of values in there.
+        matches = [index for index, arg_slots in self.slot_args
+                   if slot_name in arg_slots]
+        return len(matches) == 1 and \
+               self.argv[matches[0]] == "{" + slot_name + "}"
 
-    def fetch_variable(self, variable_name):
-        for item in self.Variables:
-            if item[0] == variable_name:
-                return item[1]
-        return None
+## End Variable_Manager class definition
+###############################################################################
 
-    def fetch_variable_list(self):
-        return self.Variables
+class Boards_Index:
+    ''' Boards_Index reads a boards.txt file once and indexes everything in
+    it: every board, every menu (menu.cpu, menu.speed, and so on) and every
+    option in those menus. Working out the variables for any board with any
+    set of menu choices is then a dictionary lookup, so we can build against
+    as many boards and options as we like without going back to the file.
 
-    def add_variable(self, new_variable):
-        self.Variables.append(new_variable)
+    The index is plain lists and dicts, so a Platform_Cache can keep it on
+    disk between runs.
+    '''
+    # One regex for every line: a dotted name, an equal sign, and a value
+    #  that runs up to the end of the line or a sharp.
+    Board_line_re = re.compile('^\s*(?P<name>[\w.-]+)\s*=\s*(?P<value>[^#]*)')
+
+    def __init__(self, filename, cache=None):
+        if cache:
+            self.index = cache.load(filename, 'boards_index',
+                                    lambda: self.read_boards(filename))
+        else:
+            self.index = self.read_boards(filename)
 
-    def replace_variables(self, incomplete_pattern):
+        # Each board/option combination we've been asked for, resolved.
+        self.resolved = {}
 
-        # Use this RegEx to identify variables within the string.
-        Variable_re = re.compile('(?<=\{)[\w.]+(?=\})')
-        ## Make a list of the variables to look for in this item.
-        vars_in_object = Variable_re.findall(incomplete_pattern)
+    def read_boards(self, filename):
+        '''
+        read_boards makes the single pass over boards.txt and returns the
+        index. For each board we keep its own variables, and for each of its
+        menus, the options in the order they're listed (the first one is the
+        default, like in the IDE), their labels, and the variables each
+        option sets.
+        '''
+        index = {'menus': {}, 'boards': {}, 'board_order': []}
 
+        with open(filename) as file:
+            for line in file:
+                match = self.Board_line_re.match(line)
+                if match is None:
+                    continue
+                name = match.group('name')
+                value = match.group('value').strip()
 
-        ## If that list is empty, bail. We should *probably* not get here,
-        ##  since the user probably won't call this unless necessary, but
-        ##  still, it's good to check.
-        if vars_in_object == []:
-            return incomplete_pattern
+                if "." not in name:
+                    continue
+                board_name, key = name.split(".", 1)
 
-        ## Iterate over the list of variables, scanning for each one in the
-        ##  lists of avaialble variables passed to this object.
-        for var_to_replace in vars_in_object:
-            replacement_var = self.fetch_variable(var_to_replace)
-            if replacement_var:
-                if (Variable_re.search(replacement_var) != None):
-                    replacement_var = self.replace_variables(replacement_var)
-                incomplete_pattern = \
-                    incomplete_pattern.replace("{" + var_to_replace + "}",\
-                                                   replacement_var)                    
+                # "menu.cpu=Processor" names a menu; it isn't a board.
+                if board_name == "menu":
+                    index['menus'][key] = value
+                    continue
 
-        return incomplete_pattern
+                if board_name not in index['boards']:
+                    index['boards'][board_name] = {'variables': [],
+                                                   'menus': {}}
+                    index['board_order'].append(board_name)
+                board = index['boards'][board_name]
 
-    def find_variable(self, search_string):
-        for var in Variables:
-            if search_string in var[0]:
-                return var[1]
-        return None
+                if not key.startswith("menu."):
+                    board['variables'].append([key, value])
+                    continue
+
+                # board.menu.<menu>.<option>=Label, or
+                #  board.menu.<menu>.<option>.<variable>=value
+                key_parts = key.split(".", 3)
+                if len(key_parts) < 3:
+                    continue
+                menu = board['menus'].setdefault(key_parts[1],
+                        {'options': [], 'labels': {}, 'variables': {}})
+                option = key_parts[2]
+                if option not in menu['variables']:
+                    menu['options'].append(option)
+                    menu['variables'][option] = []
+                if len(key_parts) == 3:
+                    menu['labels'][option] = value
+                else:
+                    menu['variables'][option].append([key_parts[3], value])
+
+        return index
+
+    def fetch_board_list(self):
+        return self.index['board_order']
+
+    def fetch_menu_options(self, board_name):
+        # Returns a dict mapping each of the board's menus to its options.
+        board = self.index['boards'][board_name]
+        return dict((menu_name, list(menu['options']))
+                    for menu_name, menu in board['menus'].items())
+
+    def resolve(self, board_name, options=None):
+        '''
+        resolve returns a dict of the variables for board_name with the menu
+        choices in options (a dict like {"cpu": "atmega328"}) applied. A menu
+        that isn't mentioned in options gets its first option, which is what
+        the IDE does too. The result is worked out once per combination and
+        shared after that, so don't change it.
+        '''
+        options = options or {}
+        resolved_key = (board_name, tuple(sorted(options.items())))
+        if resolved_key in self.resolved:
+            return self.resolved[resolved_key]
+
+        if board_name not in self.index['boards']:
+            raise ValueError("no board named '" + board_name + "' in " + \
+                             "boards.txt")
+        board = self.index['boards'][board_name]
+
+        # Within the file, the first definition of a name wins, the same as
+        #  with every other file we parse. Menu choices override the board's
+        #  own settings, though; that's the whole point of them.
+        variables = {}
+        for variable_name, value in board['variables']:
+            variables.setdefault(variable_name, value)
+
+        for menu_name, option in options.items():
+            if menu_name not in board['menus'] or \
+                    option not in board['menus'][menu_name]['variables']:
+                raise ValueError("board '" + board_name + "' has no option '" +
+                                 option + "' in menu '" + menu_name + "'")
+
+        for menu_name, menu in board['menus'].items():
+            if not menu['options']:
+                continue
+            option = options.get(menu_name, menu['options'][0])
+            option_variables = {}
+            for variable_name, value in menu['variables'][option]:
+                option_variables.setdefault(variable_name, value)
+            variables.update(option_variables)
+
+        self.resolved[resolved_key] = variables
+        return variables
 
-## End Variable_Manager class definition
-###############################################################################
 
 class Pattern_Manager:
 
-    def __init__(self, filename):
+    def __init__(self, filename, cache=None):
         """ 
         Class constructor. This gathers the data from filename (a platform.txt,
         boards.txt, or arduino.txt file) and parses it to enable the main
         program to call other functions later to handle the steps required to
-        produce the HEX file.  
+        produce the HEX file. If cache (a Platform_Cache) is given, parsed
+        files are loaded from and saved to it.
         """
         self.Patterns = []
+        self.cache = cache
         self.parse_file(filename)
 
     def parse_file(self, filename):
         '''
-        parse_file scans all the lines in a file and adds any that fit the
-        variable RegEx above. We won't do more than capture them here; any
-        post-processing will occur later.
+        parse_file adds the patterns in filename to our list, from the cache
+        if we have a current copy there, or by reading the file if not.
+        '''
+        if self.cache:
+            self.Patterns.extend(self.cache.load(filename, 'patterns',
+                    lambda: self.read_patterns(filename)))
+        else:
+            self.Patterns.extend(self.read_patterns(filename))
+
+    def read_patterns(self, filename):
+        '''
+        read_patterns scans all the lines in a file and returns a list of any
+        that fit the pattern RegEx below. We won't do more than capture them
+        here; any post-processing will occur later.
         '''
+        pattern_list = []
+
         # Comment lines must be any amount of whitespace at the beginning of 
         #  the line, followed by a sharp. We can just ignore these.
         Comment_re = re.compile('\A\s*#')
@@ -176,9 +503,11 @@ class Pattern_Manager:
                     if Define_Flag_Assignment_re.search(a_pattern):
                         a_pattern = Define_Flag_Assignment_re.sub(R'\1\\\"\2\\\"', a_pattern)
                     tempList.append(a_pattern.replace(R'"',R'\"'))
-                    self.Patterns.append(tempList)
+                    pattern_list.append(tempList)
                     continue
 
+        return pattern_list
+
     def fetch_pattern(self, pattern_name):
         for item in self.Patterns:
             if item[0] == pattern_name:
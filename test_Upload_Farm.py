@@ -0,0 +1,180 @@
+#!/bin/python
+import os
+import os.path
+import shutil
+import subprocess
+import tempfile
+import unittest
+
+import Arduino_Builder_Loader
+from Build_Matrix import Build_Matrix
+from Synthetic_Platform import generate_platform
+from Upload_Farm import Upload_Farm, Upload_Error, expand_ports
+from Upload_Record import Upload_Record
+
+# These tests flash a sketch onto a bunch of make-believe serial ports. The
+#  sketch gets built once, on a tiny synthetic platform (see
+#  Synthetic_Platform), and every upload goes through Stub_Tool's uploader,
+#  which we tell which ports should fail, and how often, through its
+#  STUB_UPLOAD_FAIL variable. Run them like so:
+#
+#  python -m unittest test_Upload_Farm
+
+class Upload_Test(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.root = tempfile.mkdtemp(prefix="upload_test_")
+        platform_settings = generate_platform(cls.root, boards=1,
+                                              libraries=1, core_files=2,
+                                              sketch_lines=20)
+        for name, value in platform_settings.items():
+            setattr(Arduino_Builder_Loader, name, value)
+        settings = Arduino_Builder_Loader.default_settings()
+        Matrix = Build_Matrix([settings], cls.root + "/cache",
+                              settings['build_path'] + "/source_index.json")
+        if not Matrix.run():
+            raise AssertionError("The test sketch didn't build")
+        cls.target = Matrix.targets[0]
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.root)
+
+    def setUp(self):
+        # Every test gets its own ports, upload record and count of failed
+        #  tries, so nothing one test does shows up in the next.
+        self.path = tempfile.mkdtemp(dir=self.root)
+        self.record = Upload_Record(self.path + "/uploads.json")
+        self.saved_environ = dict(os.environ)
+        os.environ['STUB_UPLOAD_STATE'] = self.path
+        os.environ['STUB_UPLOAD_FAIL'] = ""
+
+    def tearDown(self):
+        os.environ.clear()
+        os.environ.update(self.saved_environ)
+
+    def make_ports(self, *names):
+        # Ports that exist, so there's something for a glob to match.
+        port_list = []
+        for name in names:
+            port = self.path + "/" + name
+            open(port, 'w').close()
+            port_list.append(port)
+        return port_list
+
+    def make_farm(self, port_list, retries=2):
+        return Upload_Farm(port_list, max_jobs=4, retries=retries,
+                           retry_delay=0)
+
+    def test_expand_ports(self):
+        port_list = self.make_ports("ttyACM1", "ttyACM0", "ttyUSB0")
+        self.assertEqual(expand_ports([self.path + "/ttyACM*",
+                                       port_list[2], port_list[0]]),
+                         sorted(port_list[0:2]) + [port_list[2]])
+
+    def test_glob_that_matches_nothing(self):
+        self.make_ports("ttyACM0")
+        self.assertRaises(Upload_Error, expand_ports,
+                          [self.path + "/ttyACM*", self.path + "/ttyUSB*"])
+
+    def test_every_port_uploads(self):
+        port_list = self.make_ports("ttyACM0", "ttyACM1", "ttyACM2")
+        Farm = self.make_farm(port_list)
+        Farm.upload(self.target, self.record)
+        for port in port_list:
+            self.assertEqual(Farm.results[port][0:2], ["ok", 1])
+            self.assertTrue(self.record.is_current(
+                    port, self.target.fetch_firmware_hash(),
+                    self.target.fetch_board_id()))
+
+    def test_port_that_works_after_a_retry(self):
+        port_list = self.make_ports("ttyACM0", "ttyACM1")
+        os.environ['STUB_UPLOAD_FAIL'] = port_list[1] + ":1"
+        Farm = self.make_farm(port_list)
+        Farm.upload(self.target, self.record)
+        self.assertEqual(Farm.results[port_list[0]][0:2], ["ok", 1])
+        self.assertEqual(Farm.results[port_list[1]][0:2], ["ok", 2])
+
+    def test_port_that_never_works(self):
+        port_list = self.make_ports("ttyACM0", "ttyACM1", "ttyACM2")
+        os.environ['STUB_UPLOAD_FAIL'] = port_list[1]
+        Farm = self.make_farm(port_list, retries=1)
+        self.assertRaises(Upload_Error, Farm.upload, self.target,
+                          self.record)
+        # The other ports still got their firmware, and only they are
+        #  remembered as having it.
+        self.assertEqual(Farm.results[port_list[0]][0:2], ["ok", 1])
+        self.assertEqual(Farm.results[port_list[1]][0:2], ["FAILED", 2])
+        self.assertEqual(Farm.results[port_list[2]][0:2], ["ok", 1])
+        firmware_hash = self.target.fetch_firmware_hash()
+        board_id = self.target.fetch_board_id()
+        self.assertTrue(self.record.is_current(port_list[0], firmware_hash,
+                                               board_id))
+        self.assertFalse(self.record.is_current(port_list[1], firmware_hash,
+                                                board_id))
+
+    def test_port_with_no_upload_command(self):
+        # If the upload command can't even be put together for a port, that
+        #  port fails, and the ports queued up behind it still get uploaded.
+        port_list = self.make_ports("ttyACM0", "ttyACM1", "ttyACM2")
+        Farm = Upload_Farm(port_list, max_jobs=1, retries=2, retry_delay=0)
+        self.assertRaises(Upload_Error, Farm.upload,
+                          Broken_Target(self.target, port_list[0]),
+                          self.record)
+        self.assertEqual(Farm.results[port_list[0]][0:2], ["FAILED", 0])
+        self.assertEqual(Farm.results[port_list[1]][0:2], ["ok", 1])
+        self.assertEqual(Farm.results[port_list[2]][0:2], ["ok", 1])
+
+    def test_ports_that_already_have_the_firmware(self):
+        port_list = self.make_ports("ttyACM0", "ttyACM1")
+        self.make_farm(port_list[0:1]).upload(self.target, self.record)
+
+        # A port whose upload would fail is a port we didn't upload to.
+        os.environ['STUB_UPLOAD_FAIL'] = port_list[0]
+        Farm = self.make_farm(port_list)
+        Farm.upload(self.target, self.record)
+        self.assertEqual(Farm.results[port_list[0]][0], "skipped")
+        self.assertEqual(Farm.results[port_list[1]][0:2], ["ok", 1])
+
+        # Forced, it's uploaded to again (and fails this time).
+        Farm = self.make_farm(port_list, retries=0)
+        self.assertRaises(Upload_Error, Farm.upload, self.target,
+                          self.record, True)
+        self.assertEqual(Farm.results[port_list[0]][0:2], ["FAILED", 1])
+
+    def test_single_port_skip_and_force(self):
+        # The plain upload to settings['serial_port'] keeps an Upload_Record
+        #  the same way.
+        port = self.target.settings['serial_port']
+        self.target.upload(self.record)
+        self.assertTrue(self.record.is_current(
+                port, self.target.fetch_firmware_hash(),
+                self.target.fetch_board_id()))
+
+        os.environ['STUB_UPLOAD_FAIL'] = port
+        self.target.upload(self.record)
+        self.assertRaises(subprocess.CalledProcessError, self.target.upload,
+                          self.record, True)
+        # A failed upload means we no longer know what's on the board.
+        self.assertFalse(self.record.is_current(
+                port, self.target.fetch_firmware_hash(),
+                self.target.fetch_board_id()))
+
+class Broken_Target:
+    # A target whose upload recipe can't be filled in for broken_port, as if
+    #  it needed a variable that port doesn't have; otherwise it's target.
+    def __init__(self, target, broken_port):
+        self.target = target
+        self.broken_port = broken_port
+
+    def __getattr__(self, name):
+        return getattr(self.target, name)
+
+    def fetch_upload_cmd(self, upload_recipe, port):
+        if port == self.broken_port:
+            raise KeyError("serial.port.file")
+        return self.target.fetch_upload_cmd(upload_recipe, port)
+
+if __name__ == '__main__':
+    unittest.main()